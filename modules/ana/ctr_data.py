@@ -264,6 +264,10 @@ class CtrData:
             if scan.image._is_integrated == False:
                 scan.image.integrate()
             npts = int(scan.dims[0])
+            # get F, the corrections are computed for all points at once
+            d = image_scan_F(scan,I=I,Inorm=Inorm,
+                             Ierr=Ierr,Ibgr=Ibgr,
+                             corr_params=corr_params)
             for j in range(npts):
                 data['scan_index'].append((scan_idx,j))
                 data['I_lbl'].append(I)
@@ -276,17 +280,13 @@ class CtrData:
                 data['H'].append(scan['H'][j])
                 data['K'].append(scan['K'][j])
                 data['L'].append(scan['L'][j])
-                # get F
-                d = image_point_F(scan,j,I=I,Inorm=Inorm,
-                                  Ierr=Ierr,Ibgr=Ibgr,
-                                  corr_params=corr_params)
-                data['I'].append(d['I'])
-                data['Inorm'].append(d['Inorm'])
-                data['Ierr'].append(d['Ierr'])
-                data['Ibgr'].append(d['Ibgr'])
-                data['ctot'].append(d['ctot'])
-                data['F'].append(d['F'])
-                data['Ferr'].append(d['Ferr'])
+                data['I'].append(d['I'][j])
+                data['Inorm'].append(d['Inorm'][j])
+                data['Ierr'].append(d['Ierr'][j])
+                data['Ibgr'].append(d['Ibgr'][j])
+                data['ctot'].append(d['ctot'][j])
+                data['F'].append(d['F'][j])
+                data['Ferr'].append(d['Ferr'][j])
         return data
 
     ##########################################################################
@@ -945,6 +945,71 @@ def image_point_F(scan,point,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
     
     return d
 
+def image_scan_F(scan,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
+                 corr_params={}):
+    """
+    compute F for all points in an image scan
+
+    This gives the same results as calling image_point_F
+    for each point, but the correction factors are computed
+    for the whole scan at once (see CtrScanCorrectionPsic).
+    Returns a dictionary of arrays (one value per point)
+    """
+    npts = int(scan.dims[0])
+    d = {}
+    d['I']     = num.array(scan[I],dtype=float)
+    d['Inorm'] = num.array(scan[Inorm],dtype=float)
+    d['Ierr']  = num.array(scan[Ierr],dtype=float)
+    d['Ibgr']  = num.array(scan[Ibgr],dtype=float)
+    d['ctot']  = num.ones(npts)
+    d['alpha'] = num.zeros(npts)
+    d['beta']  = num.zeros(npts)
+    if corr_params == None:
+        scale = 1.0
+    else:
+        # compute correction factors
+        scale  = corr_params.get('scale')
+        if scale == None: scale = 1.
+        scale  = float(scale)
+        corr = _get_scan_corr(scan,corr_params)
+        if corr != None:
+            d['ctot']  = corr.ctot_stationary()
+            d['alpha'] = corr.alpha
+            d['beta']  = corr.beta
+
+    # compute F, zero where I or Inorm are not positive
+    d['F']    = num.zeros(npts)
+    d['Ferr'] = num.zeros(npts)
+    idx = num.logical_not((d['I'] <= 0.0) | (d['Inorm'] <= 0.0))
+    yn     = scale*d['I'][idx]/d['Inorm'][idx]
+    yn_err = yn * num.sqrt( (d['Ierr'][idx]/d['I'][idx])**2. +
+                            1./d['Inorm'][idx] )
+    d['F'][idx]    = num.sqrt(d['ctot'][idx]*yn)
+    d['Ferr'][idx] = num.sqrt(d['ctot'][idx]*yn_err)
+
+    return d
+
+##############################################################################
+def _get_scan_corr(scan,corr_params):
+    """
+    get CtrScanCorrectionPsic instance for all points in a scan
+    """
+    geom   = corr_params.get('geom','psic')
+    beam   = corr_params.get('beam_slits',{})
+    det    = corr_params.get('det_slits')
+    sample = corr_params.get('sample')
+    # the gonio (and UB) is computed once for the scan
+    if geom == 'psic':
+        gonio  = gonio_psic.psic_from_spec(scan['G'])
+        angles = _psic_scan_angles(scan)
+        corr   = CtrScanCorrectionPsic(gonio=gonio,angles=angles,
+                                       beam_slits=beam,det_slits=det,
+                                       sample=sample)
+    else:
+        print "Geometry %s not implemented" % geom
+        corr = None
+    return corr
+
 ##############################################################################
 def _get_corr(scan,point,corr_params):
     """
@@ -1180,6 +1245,38 @@ def _update_psic_angles(gonio,scan,point,verbose=True):
     gonio.set_angles(phi=phi,chi=chi,eta=eta,
                      mu=mu,nu=nu,delta=delta)
 
+##############################################################################
+def _psic_scan_angles(scan,verbose=True):
+    """
+    given a scandata object return a dictionary of
+    psic angle arrays, one value for each scan point.
+    Missing angles are returned as None (see _update_psic_angles)
+    """
+    try:
+        npts = int(scan.dims[0])
+    except:
+        npts = scan.get('dims', (1,0))[0]
+    try: 
+        scan_name = scan.name
+    except: 
+        scan_name = ''
+    angles = {}
+    for (key,lbl) in (('phi','phi'),('chi','chi'),('eta','eta'),
+                      ('mu','mu'),('nu','nu'),('delta','del')):
+        try:
+            if type(scan[lbl]) == types.FloatType:
+                val = scan[lbl]*num.ones(npts)
+            elif len(scan[lbl]) == npts:
+                val = num.array(scan[lbl],dtype=float)
+            else:
+                val = None
+        except:
+            val = None
+        if val is None and verbose==True:
+            print "Warning no %s angle" % lbl, scan_name
+        angles[key] = val
+    return angles
+
 ##############################################################################
 class CtrCorrectionPsic:
     """
@@ -1456,6 +1553,120 @@ class CtrCorrectionPsic:
             
         return ca
 
+##############################################################################
+class CtrScanCorrectionPsic:
+    """
+    Correction factors for all points of a stationary (image)
+    scan in Psic geometry
+
+    Notes:
+    ------
+    The correction factors are the same as those computed by
+    CtrCorrectionPsic (see that class for the definition of the
+    slits and the sample description).  However, the gonio
+    (and orientation matrix) is set up once for the scan and the
+    rotation matricies, Q and the alpha/beta psuedo angles are
+    computed for all points at once (see gonio_psic.Psic.scan_arrays).
+    Therefore the polarization and Lorentz factors are returned
+    as arrays.  Only the active area needs the per point geometry.
+    """
+    def __init__(self,gonio=None,angles={},beam_slits={},det_slits=None,
+                 sample={}):
+        """
+        Initialize
+
+        Parameters:
+        -----------
+        * gonio is a goniometer instance holding the orientation
+          matrix for the scan
+        * angles is a dictionary of angle arrays, ie
+          {'phi':[],'chi':[],'eta':[],'mu':[],'nu':[],'delta':[]}
+          angles that are missing or None are taken from gonio
+        * beam_slits are dictionary defining the incident beam aperature
+        * det_slits are a dictionary defining the detector aperature
+        * sample is a dictionary describing the sample geometry
+        """
+        self.gonio      = gonio
+        if self.gonio.calc_psuedo == False:
+            self.gonio.calc_psuedo = True
+            self.gonio._update_psuedo()
+        self.beam_slits = beam_slits
+        self.det_slits  = det_slits
+        self.sample     = sample
+        # fraction horz polarization
+        self.fh         = 1.0
+        # angles and psuedo angles for all points
+        self.arrays = self.gonio.scan_arrays(**angles)
+        self.npts   = len(self.arrays['alpha'])
+        self.angles = {}
+        for key in ('phi','chi','eta','mu','nu','delta'):
+            val = angles.get(key)
+            if val is None: val = self.gonio.angles[key]
+            self.angles[key] = num.asarray(val,dtype=float)*num.ones(self.npts)
+        self.alpha = self.arrays['alpha']
+        self.beta  = self.arrays['beta']
+
+    ##########################################################################
+    def ctot_stationary(self):
+        """
+        correction factors for stationary measurements (e.g. images)
+        """
+        cp = self.polarization()
+        cl = self.lorentz_stationary()
+        ca = self.active_area()
+        return (cp)*(cl)*(ca)
+
+    ##########################################################################
+    def lorentz_stationary(self):
+        """
+        Lorentz factor array for stationary (image) measurements,
+        see CtrCorrectionPsic.lorentz_stationary
+        """
+        return sind(self.beta)
+
+    ##########################################################################
+    def polarization(self):
+        """
+        Polarization correction array, see CtrCorrectionPsic.polarization
+        """
+        fh    = self.fh
+        delta = self.angles['delta']
+        nu    = self.angles['nu']
+        p = 1. - ( cosd(delta) * sind(nu) )**2.
+        if fh != 1.0:
+            p = fh * p + (1.-fh)*(1.0 - (sind(delta))**2.)
+        cp = num.zeros(self.npts)
+        idx = (p != 0.)
+        cp[idx] = 1./p[idx]
+        return cp
+
+    ##########################################################################
+    def active_area(self):
+        """
+        Active area correction array, see CtrCorrectionPsic.active_area.
+        Points with negative alpha or beta are zero'd
+        """
+        if self.beam_slits == {} or self.beam_slits == None:
+            print "Warning beam slits not specified"
+            return num.ones(self.npts)
+        corr = CtrCorrectionPsic(gonio=self.gonio,beam_slits=self.beam_slits,
+                                 det_slits=self.det_slits,sample=self.sample)
+        ca = num.zeros(self.npts)
+        for j in range(self.npts):
+            if self.alpha[j] < 0.0:
+                print 'alpha is less than 0.0'
+            elif self.beta[j] < 0.0:
+                print 'beta is less than 0.0'
+            else:
+                self.gonio.set_angles(phi=self.angles['phi'][j],
+                                      chi=self.angles['chi'][j],
+                                      eta=self.angles['eta'][j],
+                                      mu=self.angles['mu'][j],
+                                      nu=self.angles['nu'][j],
+                                      delta=self.angles['delta'][j])
+                ca[j] = corr.active_area()
+        return ca
+
 ##############################################################################
 ##############################################################################
 def test1():
@@ -286,6 +286,10 @@ class RasdData:
             if scan.image._is_integrated == False:
                 scan.image.integrate()
             npts = int(scan.dims[0])
+            # get F, the corrections are computed for all points at once
+            d = image_scan_F(scan,I=I,Inorm=Inorm,
+                             Ierr=Ierr,Ibgr=Ibgr,
+                             corr_params=corr_params)
             for j in range(npts):
                 data['scan_index'].append((scan_idx,j))
                 data['I_lbl'].append(I)
@@ -299,17 +303,13 @@ class RasdData:
                 data['K'].append(scan['K'][j])
                 data['L'].append(scan['L'][j])
                 data['E'].append(scan.state['ENERGY'][0])
-                # get F
-                d = image_point_F(scan,j,I=I,Inorm=Inorm,
-                                  Ierr=Ierr,Ibgr=Ibgr,
-                                  corr_params=corr_params)
-                data['I'].append(d['I'])
-                data['Inorm'].append(d['Inorm'])
-                data['Ierr'].append(d['Ierr'])
-                data['Ibgr'].append(d['Ibgr'])
-                data['ctot'].append(d['ctot'])
-                data['F'].append(d['F'])
-                data['Ferr'].append(d['Ferr'])
+                data['I'].append(d['I'][j])
+                data['Inorm'].append(d['Inorm'][j])
+                data['Ierr'].append(d['Ierr'][j])
+                data['Ibgr'].append(d['Ibgr'][j])
+                data['ctot'].append(d['ctot'][j])
+                data['F'].append(d['F'][j])
+                data['Ferr'].append(d['Ferr'][j])
         return data
 
     ##########################################################################
@@ -14,6 +14,7 @@ Todo:
 ########################################################################
 
 import sys
+import time
 import types
 import string
 import copy
@@ -22,6 +23,7 @@ import numpy as num
 from  tdl.modules.spectra import medfile_cars
 from  tdl.modules.spectra import medfile_emsa
 from  tdl.modules.spectra import calibration as calib
+from  tdl.modules.xrf import xrf_peaks
 from  tdl.modules.xrf.xrf_model import Xrf
 from  tdl.modules.ana.med_data import read, read_files   
 
@@ -186,6 +188,268 @@ def fit(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,verbose=Tru
         xrf[j].fit()
     return
 
+#################################################################################
+def fit_batch(xrf,xrf_params={},fit_init=0,guess=False,workers=1,chunk=0,
+              areas=None,verbose=True):
+    """
+    Fit a (list of) xrf objects, seeding all the fits from one reference fit
+
+    Parameters:
+    -----------
+    * xrf_params should have the same format as returned
+      by Xrf.get_params.  If passed these are used to init the
+      reference spectrum before it is fit.
+    * fit_init is the index of the reference spectrum.  This is fit
+      first and its fit parameters (Xrf.get_params) are used as the
+      starting values for all the other spectra.
+    * guess: if True the initial amplitudes (and free fwhm's) are guessed
+      from the data of each spectrum, otherwise the fits start from the
+      seed values
+    * workers is the number of processes used for fitting.  If workers > 1
+      the spectra are fit by a process pool, otherwise (or if the pool
+      can't be started) they are fit one at a time.
+    * chunk: if chunk > 1 the spectra are split into blocks of chunk
+      consecutive spectra.  Within a block each fit is seeded from
+      the previous one (as with fit(use_prev_fit=True)), the first of
+      each block is seeded from the reference fit and the blocks are
+      fit in parallel.  If chunk <= 1 every spectrum is seeded from
+      the reference fit.
+    * areas: optional dictionary that is filled with an array of the
+      peak areas (one value per spectrum) for each peak label
+    * verbose: print the fit status of each spectrum and the throughput
+
+    Outputs:
+    --------
+    * dictionary with arrays of the per spectrum fit 'status',
+      'chisqr' and 'n_iter', a list of the 'failed' indicies,
+      the total fit 'time' and the 'rate' (spectra/sec).
+
+    Notes:
+    ------
+    Only the data, channels and parameter dictionaries are sent to the
+    workers.  The xrf objects are updated with the fitted parameters,
+    predicted spectrum and background when the results come back.
+    """
+    if type(xrf) != types.ListType:
+        xrf = [xrf]
+    npts = len(xrf)
+    t0 = time.time()
+
+    # reference fit
+    fit_init = max(0,min(fit_init,npts-1))
+    if len(xrf_params) > 0:
+        xrf[fit_init].init(params=xrf_params,guess=guess)
+    xrf[fit_init].fit()
+    params = xrf[fit_init].get_params()
+    if not xrf[fit_init].bgr:
+        # otherwise init would create a default background
+        params['bgr'] = None
+
+    info = {'status':num.zeros(npts,dtype=int),
+            'chisqr':num.zeros(npts,dtype=float),
+            'n_iter':num.zeros(npts,dtype=int),
+            'failed':[]}
+    if areas != None:
+        areas.clear()
+        for pk in params['pk']:
+            areas[pk['label']] = num.zeros(npts,dtype=float)
+    _store_fit(xrf,fit_init,None,info,areas,verbose)
+
+    # fit jobs.  each job is a list of consecutive spectra
+    idx = [j for j in range(npts) if j != fit_init]
+    chain = chunk > 1
+    if chain == False:
+        chunk = max(1,len(idx)/(4*max(workers,1)))
+    jobs = []
+    for k in range(0,len(idx),chunk):
+        spectra = [(j,xrf[j].data,xrf[j].channels) for j in idx[k:k+chunk]]
+        jobs.append((params,guess,chain,spectra))
+
+    pool = None
+    if workers > 1 and len(jobs) > 1:
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes=workers)
+        except:
+            print "Unable to start process pool, fitting serially"
+            pool = None
+    try:
+        if pool != None:
+            results = pool.imap_unordered(_fit_chunk,jobs)
+        else:
+            results = (_fit_chunk(job) for job in jobs)
+        for res in results:
+            for (j,result) in res:
+                _store_fit(xrf,j,result,info,areas,verbose)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    info['failed'].sort()
+    _fit_summary(info,npts,t0,verbose)
+    return info
+
+def _fit_summary(info,npts,t0,verbose):
+    """
+    Add the total fit 'time' and 'rate' (spectra/sec)
+    to info and print them if verbose
+    """
+    info['time'] = time.time() - t0
+    info['rate'] = npts/max(info['time'],1.e-9)
+    if verbose:
+        sys.__stdout__.write("Fit %d spectra in %.2f sec (%.2f spectra/sec), %d failed\n"
+                             % (npts,info['time'],info['rate'],len(info['failed'])))
+
+def _store_fit(xrf,j,result,info,areas,verbose):
+    """
+    Update xrf[j] from a _fit_chunk result and
+    fill in the status info and peak areas.
+    result == None means xrf[j] is already up to date
+    """
+    x = xrf[j]
+    if result != None:
+        if result[0] == None:
+            info['failed'].append(j)
+            info['status'][j] = 0
+            if verbose:
+                sys.__stdout__.write("Fit index = %d failed: %s\n" % (j,result[1]))
+            return
+        (params,stats,predicted,bgr) = result
+        x.init(params=params)
+        (x.status,x.chisqr,x.n_iter,x.n_eval,x.err_string) = stats
+        x.predicted = predicted
+        if x.bgr and (bgr is not None): x.bgr.bgr = bgr
+    info['status'][j] = x.status
+    info['chisqr'][j] = x.chisqr
+    info['n_iter'][j] = x.n_iter
+    if (x.status <= 0) or (num.isfinite(x.chisqr) == False):
+        info['failed'].append(j)
+    if areas != None:
+        for pk in x.peaks:
+            if areas.has_key(pk.label):
+                areas[pk.label][j] = pk.area
+    if verbose:
+        sys.__stdout__.write("Fit index = %d, status = %d, chisqr = %g\n"
+                             % (j,x.status,x.chisqr))
+
+def _fit_chunk(args):
+    """
+    Fit a list of spectra (process pool worker for fit_batch).
+    args = (params,guess,chain,spectra), spectra is a list of
+    (idx,data,chans).  If chain is True each fit is seeded
+    from the previous successful fit, otherwise all are seeded
+    from params.  Returns a list of (idx,result) where result
+    is (params,stats,predicted,bgr), or (None,error message)
+    if the fit fails
+    """
+    (params,guess,chain,spectra) = args
+    seed = params
+    results = []
+    for (j,data,chans) in spectra:
+        try:
+            x = Xrf(data=data,chans=chans,params=seed,guess=guess)
+            x.fit(guess=guess)
+            fit_params = x.get_params()
+            if x.bgr:
+                bgr = x.bgr.bgr
+            else:
+                # otherwise init would create a default background
+                fit_params['bgr'] = None
+                bgr = None
+            stats = (x.status,x.chisqr,x.n_iter,x.n_eval,x.err_string)
+            results.append((j,(fit_params,stats,x.predicted,bgr)))
+            if chain and (x.status > 0) and num.isfinite(x.chisqr):
+                seed = fit_params
+        except:
+            results.append((j,(None,str(sys.exc_info()[1]))))
+    return results
+
+#################################################################################
+def fit_fixed(xrf,ref=0,nonneg=True,areas=None,block=4096,verbose=True):
+    """
+    Fit only the peak amplitudes of a (list of) xrf objects.  The peak
+    energies and widths, energy calibration and background parameters
+    are taken from a reference spectrum that has already been fit, eg
+    the summed spectrum of a map.
+
+    Parameters:
+    -----------
+    * ref is the reference xrf object, or the index of the reference
+      in the list.  All spectra must have the same channels as ref
+    * nonneg: if True the amplitudes are constrained to be >= 0
+    * areas: optional dictionary that is filled with an array of the
+      peak areas (one value per spectrum) for each peak label
+    * block is the max number of spectra solved at once
+    * verbose: print the throughput
+
+    Outputs:
+    --------
+    * dictionary with arrays of the per spectrum fit 'status' and
+      'chisqr', a list of the 'failed' indicies, the total fit 'time'
+      and the 'rate' (spectra/sec), see fit_batch.
+
+    Notes:
+    ------
+    With the peak shapes fixed the model is linear in the amplitudes,
+    so the spectra are fit as a 2D data block with one (non-negative)
+    least squares solve per block (see xrf_peaks.fit_amplitudes) rather
+    than a nonlinear fit per spectrum.  Each xrf object is updated with
+    the reference parameters and its own amplitudes, areas, predicted
+    spectrum and background.
+    """
+    if type(xrf) != types.ListType:
+        xrf = [xrf]
+    npts = len(xrf)
+    t0 = time.time()
+    if type(ref) == types.IntType:
+        ref = xrf[ref]
+    for x in xrf:
+        if x.nchan != ref.nchan:
+            print "Error: spectra must have the same channels as the reference"
+            return None
+
+    params = ref.get_params()
+    if not ref.bgr:
+        params['bgr'] = None
+    info = {'status':num.ones(npts,dtype=int),
+            'chisqr':num.zeros(npts,dtype=float),
+            'n_iter':num.zeros(npts,dtype=int),
+            'failed':[]}
+    if areas != None:
+        areas.clear()
+        for pk in params['pk']:
+            areas[pk['label']] = num.zeros(npts,dtype=float)
+
+    for k in range(0,npts,block):
+        data = num.array([x.data for x in xrf[k:k+block]],dtype=float)
+        res  = xrf_peaks.fit_amplitudes(ref,data,nonneg=nonneg)
+        for i in range(len(data)):
+            j = k + i
+            pk_par = []
+            for p in range(len(params['pk'])):
+                par = params['pk'][p].copy()
+                par['ampl'] = res['ampl'][i,p]
+                par['area'] = res['area'][i,p]
+                pk_par.append(par)
+                if areas != None:
+                    areas[par['label']][j] = par['area']
+            x = xrf[j]
+            x.init(params={'fit':params['fit'],'bgr':params['bgr'],'pk':pk_par})
+            x.predicted = res['predicted'][i]
+            if x.bgr and (res['bgr'] is not None):
+                x.bgr.bgr = res['bgr'][i]
+            x.chisqr = res['chisqr'][i]
+            x.status = 1
+            if num.isfinite(x.chisqr) == False:
+                x.status = 0
+                info['status'][j] = 0
+                info['failed'].append(j)
+            info['chisqr'][j] = x.chisqr
+
+    _fit_summary(info,npts,t0,verbose)
+    return info
+
 #################################################################################
 def peak_areas(xrf,line):
     """
@@ -357,6 +621,33 @@ class XrfScan:
             fit_init=fit_init,guess=guess,verbose=verbose)
         self._update_peaks()
 
+    ################################################################
+    def fit_batch(self,xrf_params={},fit_init=0,guess=False,workers=1,
+                  chunk=0,verbose=True):
+        """
+        fit xrf, seeding all fits from the fit of
+        index fit_init (see fit_batch for details).
+        Returns the fit status info from fit_batch
+        """
+        info = fit_batch(self.xrf,xrf_params=xrf_params,fit_init=fit_init,
+                         guess=guess,workers=workers,chunk=chunk,
+                         areas=self.peaks,verbose=verbose)
+        self.lines = [pk.label for pk in self.xrf[0].peaks]
+        return info
+
+    ################################################################
+    def fit_fixed(self,ref=0,nonneg=True,verbose=True):
+        """
+        fit only the peak amplitudes, using the peak shapes of the
+        reference xrf object (or index) ref (see fit_fixed for details).
+        Returns the fit status info from fit_fixed
+        """
+        info = fit_fixed(self.xrf,ref=ref,nonneg=nonneg,areas=self.peaks,
+                         verbose=verbose)
+        if info != None:
+            self.lines = [pk.label for pk in self.xrf[0].peaks]
+        return info
+
     ################################################################
     def _update_peaks(self,):
         """
@@ -371,6 +662,115 @@ class XrfScan:
             p = peak_areas(self.xrf,l)
             self.peaks[l] = p
 
+##############################################################################
+def _sim_spectra(npts,nchans,ampl=0.):
+    """
+    Simulate a scan of npts xrf spectra for the benchmarks.  Returns
+    (chans,fit_par,lines,spectra), fit_par are the 'fit' parameters
+    of the simulated energy and fwhm calibration and lines are the
+    peak energies.  The peak amplitudes vary from ampl to ampl+300
+    over the scan
+    """
+    from tdl.modules.xrf import _test_data as test_dat
+    chans = num.arange(nchans)
+    slope = 20./nchans
+    en    = 1.0 + slope*chans
+    lines = [3.69,4.51,5.41,6.40,7.06,8.05,8.64,9.57]
+    spectra = []
+    for j in range(npts):
+        data = 50. + test_dat.gauss(en,15.,100.,10.)
+        for e in lines:
+            a = ampl + 300.*num.sin(j*e/npts)**2
+            data = data + test_dat.gauss(en,e,a,.1+.04*num.sqrt(e))
+        spectra.append(num.random.poisson(data))
+    fit_par = {'energy_offset':1.0,'energy_slope':slope,
+               'fwhm_offset':.12,'fwhm_slope':.03}
+    return (chans,fit_par,lines,spectra)
+
+def _sim_xrf(data,chans,fit_par,lines,bgr=True):
+    """
+    Xrf object for a simulated spectrum (see _sim_spectra)
+    """
+    x = Xrf(data=data,chans=chans,params={'fit':fit_par.copy()})
+    if bgr: x.init_bgr()
+    x.init_lines(lines)
+    return x
+
+def _bench_fit_batch(npts=32,nchans=2048,workers=2,chunk=8):
+    """
+    Compare fit and fit_batch on a simulated scan of xrf spectra
+    """
+    (chans,fit_par,lines,spectra) = _sim_spectra(npts,nchans,ampl=200.)
+    def make_scan(bgr=True):
+        xrf = [_sim_xrf(data,chans,fit_par,lines,bgr=bgr) for data in spectra]
+        return XrfScan(xrf)
+    scan = make_scan()
+    t = time.time()
+    scan.fit(fit_init=0,verbose=False)
+    t_fit = time.time() - t
+    ref = scan.peaks
+    result = {}
+    for (w,c) in ((1,0),(workers,0),(workers,chunk)):
+        scan = make_scan()
+        info = scan.fit_batch(fit_init=0,workers=w,chunk=c,verbose=False)
+        diff = max([num.abs(scan.peaks[l] - ref[l]).max()/num.abs(ref[l]).max()
+                    for l in scan.lines])
+        result[(w,c)] = info
+        print "fit_batch workers=%i chunk=%i: %.3f sec (%.2f spectra/sec), n_iter = %i, max rel area diff = %g" % \
+              (w,c,info['time'],info['rate'],info['n_iter'].sum(),diff)
+    print "fit: %.3f sec (%.2f spectra/sec)" % (t_fit,npts/t_fit)
+    # without a background the fits must stay background free,
+    # chained or not
+    chisqr = {}
+    for c in (0,chunk):
+        scan = make_scan(bgr=False)
+        info = scan.fit_batch(fit_init=0,workers=1,chunk=c,verbose=False)
+        nbgr = len([x for x in scan.xrf if x.bgr is not None])
+        chisqr[c] = info['chisqr']
+        print "fit_batch no bgr chunk=%i: %i spectra with a bgr" % (c,nbgr)
+    print "no bgr max rel chisqr diff (chunk=%i vs 0) = %g" % \
+          (chunk,(num.abs(chisqr[chunk]-chisqr[0])/chisqr[0]).max())
+    return result
+
+##############################################################################
+def _bench_fit_fixed(npts=400,nchans=2048,nfit=20):
+    """
+    Compare fit_fixed with fitting each spectrum (with the peak
+    shapes held fixed) on a simulated map of xrf spectra.  Only
+    the first nfit spectra are fit one at a time.
+    """
+    (chans,fit_par,lines,spectra) = _sim_spectra(npts,nchans)
+    fit_par['chi_exp'] = .5
+    # reference fit to the summed spectrum
+    ref = _sim_xrf(num.sum(spectra,axis=0),chans,fit_par,lines)
+    ref.fit()
+    params = ref.get_params()
+    xrf = []
+    for data in spectra:
+        x = Xrf(data=data,chans=chans,params=params)
+        xrf.append(x)
+    scan = XrfScan(xrf)
+    info = scan.fit_fixed(ref=ref,verbose=False)
+    # nonlinear fits with fixed shapes
+    params['fit']['energy_flag'] = 1
+    params['fit']['fwhm_flag']   = 1
+    for pk in params['pk']:
+        pk['energy_flag'] = 1
+        if pk['fwhm_flag'] == 0: pk['fwhm_flag'] = 2
+    t = time.time()
+    diff = 0.
+    for j in range(nfit):
+        x = Xrf(data=spectra[j],chans=chans,params=params)
+        x.fit()
+        for pk in x.peaks:
+            diff = max(diff,abs(pk.area - scan.peaks[pk.label][j]))
+    t_fit = (time.time() - t)/nfit
+    print "fit_fixed: %i spectra in %.3f sec (%.1f spectra/sec)" % \
+          (npts,info['time'],info['rate'])
+    print "fit:       %.4f sec per spectrum (%.1f spectra/sec)" % (t_fit,1./t_fit)
+    print "max area difference (first %i spectra): %g" % (nfit,diff)
+    return info
+
 ##############################################################################
 ##############################################################################
 if __name__ == "__main__":
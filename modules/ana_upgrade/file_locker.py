@@ -3,25 +3,50 @@ File Locker
 Author: Evan Fosmark
 http://www.evanfosmark.com/2009/01/cross-platform-file-locking-support-in-python
 Last modified: 7.16.2012 by Craig Biwer (cbiwer@uchicago.edu)
+
+Notes:
+------
+Where fcntl is available (posix) the lock is an flock on the lock
+file.  This is atomic, waits in the kernel rather than polling,
+supports shared (reader) and exclusive (writer) locks and is released
+by the OS if the process dies, so locks are never left stale.
+
+Otherwise the lock file is created with O_CREAT|O_EXCL (atomic) and
+holds the pid and host of the owner.  A lock file left by a dead
+process on this host is removed.  These locks are always exclusive.
 """
 
 
 import os
 import time
 import errno
+import socket
+import signal
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class FileLockException(Exception):
     pass
 
+class _LockTimeout(Exception):
+    pass
+
 class FileLock(object):
     """ A file locking mechanism that has context-manager support so
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+        you can use it in a with statement. Uses fcntl.flock where
+        available, otherwise an atomically created lock file.
     """
 
-    def __init__(self, file_name, timeout=10, delay=.05):
+    def __init__(self, file_name, timeout=10, delay=.05, shared=False):
         """ Prepare the file locker. Specify the file to lock and optionally
             the maximum timeout and the delay between each attempt to lock.
+            If timeout is None wait until the lock is free.  If shared is
+            True take a shared (reader) lock, many processes can hold
+            a shared lock at once but not while an exclusive lock is held.
         """
         self.is_locked = False
         #self.lockfile = os.path.join(os.getcwd(), "%s.lock" % file_name)
@@ -29,40 +54,129 @@ class FileLock(object):
         self.file_name = file_name
         self.timeout = timeout
         self.delay = delay
+        self.shared = shared
+        self.fd = None
 
 
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `wait` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws
-            an exception.
+        """ Acquire the lock, if possible. If the lock is in use, wait
+            until it is free or `timeout` seconds have passed, in which
+            case it throws an exception.
         """
-        start_time = time.time()
         lockfile = os.path.abspath(self.lockfile)
         lockdir  = os.path.dirname(lockfile)
         if not os.access(lockdir, os.W_OK):
             raise FileLockException("Cannot write to %s." % lockdir)
+        if fcntl != None:
+            self._acquire_flock(lockfile)
+        else:
+            self._acquire_excl(lockfile)
+        self.is_locked = True
+
+    def _acquire_flock(self, lockfile):
+        """ Lock with flock, waiting in the kernel for the lock.  A
+            timeout is applied with an alarm in the main thread, other
+            threads retry a non-blocking lock every `delay` seconds.
+        """
+        fd = os.open(lockfile, os.O_CREAT|os.O_RDWR)
+        if self.shared:
+            op = fcntl.LOCK_SH
+        else:
+            op = fcntl.LOCK_EX
+        try:
+            if self.timeout == None:
+                fcntl.flock(fd, op)
+            elif not self._flock_wait(fd, op):
+                raise FileLockException("Timeout occured waiting for lockfile.")
+        except:
+            os.close(fd)
+            raise
+        if not self.shared:
+            # record the owner (informational only)
+            os.ftruncate(fd, 0)
+            os.write(fd, '\n'.join(_owner()))
+        self.fd = fd
 
-        dat = [os.environ.get('USERNAME', ''),
-               os.environ.get('COMPUTERNAME', '')]
+    def _flock_wait(self, fd, op):
+        """ Try to flock fd within timeout, return True if locked
+        """
+        try:
+            fcntl.flock(fd, op|fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if self.timeout <= 0:
+            return False
+        if isinstance(threading.current_thread(), threading._MainThread) \
+           and hasattr(signal, 'setitimer'):
+            def timeout(signum, frame):
+                raise _LockTimeout()
+            old = signal.signal(signal.SIGALRM, timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+            try:
+                try:
+                    fcntl.flock(fd, op)
+                    return True
+                except _LockTimeout:
+                    return False
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, old)
+        start_time = time.time()
         while (time.time() - start_time) < self.timeout:
-            if os.path.exists(lockfile):
+            time.sleep(self.delay)
+            try:
+                fcntl.flock(fd, op|fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return False
+
+    def _acquire_excl(self, lockfile):
+        """ Lock by atomically creating the lock file, removing
+            lock files left by dead processes on this host.
+        """
+        start_time = time.time()
+        while True:
+            try:
+                fd = os.open(lockfile, os.O_CREAT|os.O_EXCL|os.O_RDWR)
+                os.write(fd, '\n'.join(_owner()))
+                self.fd = fd
+                return
+            except OSError as e:
+                if e.errno != errno.EEXIST and e.errno != errno.EACCES:
+                    raise
+                if e.errno == errno.EEXIST and _is_stale(lockfile):
+                    try:
+                        os.unlink(lockfile)
+                    except OSError:
+                        pass
+                    continue
+                if self.timeout != None and \
+                   (time.time() - start_time) >= self.timeout:
+                    if e.errno == errno.EEXIST:
+                        raise FileLockException("Timeout occured waiting for lockfile.")
+                    else:
+                        raise FileLockException("Access denied.")
                 time.sleep(self.delay)
-                continue
-            dat.extend([time.ctime(), ''])
-            with open(self.lockfile, 'w') as fh:
-                fh.write('\n'.join(dat))
-            self.is_locked = True
-            return
-        raise FileLockException("Timeout occured waiting for lockfile.")
 
     def release(self):
-        """ Get rid of the lock by deleting the lockfile.
-            When working in a `with` statement, this gets automatically
-            called at the end.
+        """ Release the lock.  With flock the lock file is left in
+            place (removing it would let a waiting process lock a
+            file that is no longer the lock file), otherwise it is
+            deleted. When working in a `with` statement, this gets
+            automatically called at the end.
         """
         if self.is_locked:
-            os.unlink(self.lockfile)
+            if fcntl != None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+            else:
+                os.close(self.fd)
+                os.unlink(self.lockfile)
+            self.fd = None
             self.is_locked = False
 
 
@@ -88,3 +202,46 @@ class FileLock(object):
             lying around.
         """
         self.release()
+
+def _owner():
+    """ Return the lock file contents [pid, host, user, time]
+    """
+    return [str(os.getpid()), socket.gethostname(),
+            os.environ.get('USERNAME', os.environ.get('USER', '')),
+            time.ctime()]
+
+def _is_stale(lockfile):
+    """ True if lockfile was written by a process on this
+        host that is no longer running
+    """
+    try:
+        fh = open(lockfile)
+        dat = fh.read().split('\n')
+        fh.close()
+        pid = int(dat[0])
+        host = dat[1]
+    except (IOError, ValueError, IndexError):
+        return False
+    if host != socket.gethostname():
+        return False
+    return not _pid_alive(pid)
+
+def _pid_alive(pid):
+    """ True if process pid is running on this host
+    """
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        # 259 = STILL_ACTIVE
+        return code.value == 259
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
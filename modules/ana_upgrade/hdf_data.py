@@ -179,13 +179,70 @@ DET_ATT_KEYS = ['data',
                 'name']
 
 VERSIONED_KEYS = []
+
+# Detector keys that are read from the file only when accessed
+IMAGE_KEYS = ['image_data',
+              'corrected_image']
                     
+##############################################################################
+class _DetDict(dict):
+    """
+    Detector dictionary of a point.  The image keys (IMAGE_KEYS)
+    are read from the file and corrected the first time they are
+    accessed.  Copies share the decoded images.
+    """
+    def __init__(self,group,*arg,**kw):
+        dict.__init__(self,*arg,**kw)
+        self._group  = group
+        self._images = {}
+
+    def __missing__(self,key):
+        if key not in IMAGE_KEYS or self._group == None:
+            raise KeyError(key)
+        if len(self._images) == 0:
+            self._read_images()
+        if 'bad_pixel_map' in self._images:
+            self['bad_pixel_map'] = self._images['bad_pixel_map']
+        try:
+            self[key] = self._images[key]
+        except KeyError:
+            raise KeyError(key)
+        return self._images[key]
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        det = _DetDict(self._group,self)
+        det._images = self._images
+        return det
+
+    def _read_images(self):
+        try:
+            point_image = numpy.array(self._group['image_data'])
+            self._images['image_data'] = point_image
+            point_mask = str(self['bad_pixel_map'])
+            if not point_mask.startswith('(') and \
+               not point_mask.startswith('['):
+                point_mask = str(image_data.read_pixel_map(point_mask))
+                self._images['bad_pixel_map'] = point_mask
+            self._images['corrected_image'] = \
+                    image_data.correct_image(point_image,point_mask)
+        except:
+            pass
+
 ##############################################################################
 class HdfDataFile:
     """
     Container for data stored in HDF files
+
+    The file is opened 'r+' with an exclusive lock, or with mode='r'
+    read only with a shared lock so many readers can open it at once.
     """
-    def __init__(self,fname):
+    def __init__(self,fname,ncache=16,mode='r+'):
         # Initialize variables
         self.fname = fname
         self.point = 0
@@ -193,13 +250,22 @@ class HdfDataFile:
         self.version = 1
         self.file = None
         self.all_items = None
+        # cache of recently read points
+        self.ncache = ncache
+        self._cache = {}
+        self._lru   = []
+        # cache of values datasets as columns (see _get_rows)
+        self._index   = None
+        self._rows    = {}
+        self._columns = {}
         
-        self.lock_file = file_locker.FileLock(self.fname)
+        self.lock_file = file_locker.FileLock(self.fname,
+                                              shared=(mode == 'r'))
         print 'Attempting to lock file...'
         self.lock_file.acquire()
         print 'Lock acquired'
         try:
-            self.file = h5py.File(self.fname,'r+')
+            self.file = h5py.File(self.fname,mode)
         except:
             print 'Error: unable to open file'
             raise
@@ -276,6 +342,9 @@ class HdfDataFile:
         try:
             self.point = 0
             self.point_dict = {}
+            self._cache = {}
+            self._lru   = []
+            self._uncache_columns()
             self.file.flush()
             self.file.close()
             self.lock_file.release()
@@ -295,6 +364,8 @@ class HdfDataFile:
     def delete(self, item):
         """Delete a point from the file."""
         
+        self._uncache(item)
+        self._uncache_columns()
         del self.file[item]
     
     def get(self, num, default=None):
@@ -335,12 +406,9 @@ class HdfDataFile:
         #for point in points:
         if isinstance(key, basestring):
             if key in GEN_KEYS:
-                key_loc = GEN_KEYS[key]
-                for point in points:
-                    all_results[point] = \
-                            self.file[point][key_loc[0]][key_loc[1]]
-                if self.point in points:
-                    all_results[self.point] = self.point_dict[key]
+                values = self.get_column(key, points)
+                for (point, value) in zip(points, values):
+                    all_results[point] = value
             elif key in ATT_KEYS:
                 if key.startswith('hist'):
                     key = key + '.' + str(self.version)
@@ -357,17 +425,13 @@ class HdfDataFile:
                 if self.point in points:
                     all_results[self.point] = self.point_dict[key]
             else:
+                pos = self._get_labeled('position', key, points)
+                sca = self._get_labeled('scaler', key, points)
                 for point in points:
-                    if key in self.file[point]['position_labels']:
-                        key_loc = \
-                          list(self.file[point]['position_labels']).index(key)
-                        all_results[point] = \
-                                self.file[point]['position_values'][key_loc]
-                    elif key in self.file[point]['scaler_labels']:
-                        key_loc = \
-                          list(self.file[point]['scaler_labels']).index(key)
-                        all_results[point] = \
-                                self.file[point]['scaler_values'][key_loc]
+                    if point in pos:
+                        all_results[point] = pos[point]
+                    elif point in sca:
+                        all_results[point] = sca[point]
                     else:
                         print 'Unrecognized Key Error: ' , key
                 if self.point in points and key in self.point_dict.keys():
@@ -376,13 +440,9 @@ class HdfDataFile:
             det_name = key[0]
             key = key[1]
             if key in DET_KEYS:
-                key_loc = DET_KEYS[key]
-                key_loc_path = key_loc[0].split('/')[1] % self.version
-                for point in points:
-                    all_results[point] = \
-                            self.file[point][det_name][key_loc_path][key_loc[1]]
-                if self.point in points:
-                    all_results[self.point] = self.point_dict[det_name][key]
+                values = self.get_column((det_name, key), points)
+                for (point, value) in zip(points, values):
+                    all_results[point] = value
             elif key in DET_ATT_KEYS:
                 for point in points:
                     all_results[point] = self.file[point][det_name].attrs[key]
@@ -420,6 +480,223 @@ class HdfDataFile:
             print 'Error: unknown key type'
         return all_results
         
+    def get_column(self, key, points=None):
+        """
+        Gets the value of key for every point in points as an
+        array (in the order of points).  If points is None, gets
+        the value for every point in the file.  To tunnel, pass a
+        tuple to key, eg HdfObject.get_column(('det_0', 'I'))
+
+        Keys stored in the values datasets (GEN_KEYS, DET_KEYS and
+        the position / scaler labels) are taken from cached columns,
+        so the file is only read the first time a dataset is used.
+        Other keys are read with get_all.  As with get_all the current
+        point's value is taken from the current dictionary.
+        
+        """
+        if points == None:
+            points = self._get_index()[0]
+        loc = self._column_loc(key)
+        if loc == None:
+            if isinstance(key, basestring) and key not in ATT_KEYS and \
+               key not in MISC_KEYS:
+                pos = self._get_labeled('position', key, points)
+                sca = self._get_labeled('scaler', key, points)
+                pos.update(sca)
+                result = [pos.get(point) for point in points]
+            else:
+                all_results = self.get_all(key, points)
+                result = [all_results.get(point) for point in points]
+            values = numpy.empty(len(result), dtype=object)
+            for (j, value) in enumerate(result):
+                values[j] = value
+            if len(result) > 0 and numpy.ndim(result[0]) == 0:
+                values = numpy.array(result)
+            result = values
+        else:
+            rows = self._get_rows(loc[0], points)
+            result = self._get_columns(loc[0])[rows, loc[1]]
+        if result.dtype.kind in 'SU':
+            result = result.astype(object)
+        if self.point in points:
+            try:
+                if isinstance(key, tuple):
+                    value = self.point_dict[key[0]][key[1]]
+                else:
+                    value = self.point_dict[key]
+                result[list(points).index(self.point)] = value
+            except (KeyError, ValueError):
+                pass
+        return result
+
+    def set_column(self, key, values, points=None):
+        """
+        Sets the value of key for every point in points, where values
+        is either a single value or a sequence with one value per
+        point.  If points is None, sets the value for every point in
+        the file.  To tunnel, pass a tuple to key,
+        eg HdfObject.set_column(('det_0', 'I'), I)
+
+        For keys stored in the values datasets the cached columns
+        are updated with one assignment, the file is written point
+        by point. Other keys are set with set_all.
+        
+        """
+        if points == None:
+            points = self._get_index()[0]
+        if numpy.ndim(values) == 0:
+            self.set_all(key, values, points)
+            return
+        if len(values) != len(points):
+            print 'Error: number of values and points differ'
+            return
+        loc = self._column_loc(key)
+        if loc == None:
+            for (point, value) in zip(points, values):
+                self.set_all(key, value, [point])
+            return
+        self._uncache(points)
+        if self.point in points:
+            value = values[list(points).index(self.point)]
+            if isinstance(key, tuple):
+                self.point_dict[key[0]][key[1]] = value
+            else:
+                self.point_dict[key] = value
+        for (point, value) in zip(points, values):
+            try:
+                self.file[point][loc[0]][loc[1]] = value
+            except IOError:
+                self.file[point][loc[0]][loc[1]] = numpy.float(value)
+        self._set_columns(loc[0], points, loc[1], values)
+
+    def _get_index(self):
+        """
+        Return (points, index) where points is the list of
+        points in the file and index maps a point to its row in
+        the cached columns
+        """
+        if self._index == None:
+            points = [item for item in self.file.keys()]
+            index = {}
+            for (j, point) in enumerate(points):
+                index[point] = j
+            self._index = (points, index)
+        return self._index
+
+    def _column_loc(self, key):
+        """
+        Return (path, idx) of key in the values datasets, eg
+        ('det_0/result_values.1', 6) for ('det_0','I'), or None
+        if key isnt in a fixed position of a values dataset
+        """
+        if isinstance(key, tuple):
+            if key[1] in DET_KEYS:
+                key_loc = DET_KEYS[key[1]]
+                path = key_loc[0].split('/')[1] % self.version
+                return (key[0] + '/' + path, key_loc[1])
+        elif key in GEN_KEYS:
+            return tuple(GEN_KEYS[key])
+        return None
+
+    def _get_rows(self, path, points):
+        """
+        Return the row index (in the cached columns) of each point,
+        reading the dataset path of every point in the file into
+        self._rows if it hasnt been read yet
+        """
+        (all_points, index) = self._get_index()
+        if path not in self._rows:
+            rows = []
+            for point in all_points:
+                try:
+                    rows.append(self.file[point][path][...])
+                except KeyError:
+                    rows.append(None)
+            self._rows[path] = rows
+        return [index[point] for point in points]
+
+    def _get_columns(self, path):
+        """
+        Return the cached rows of dataset path as a 2D array
+        (one row per point in the file)
+        """
+        if path not in self._columns:
+            rows = self._rows[path]
+            good = [row for row in rows if row is not None]
+            dtype = numpy.dtype(float)
+            if len(good) > 0:
+                dtype = good[0].dtype
+            for row in good:
+                dtype = numpy.promote_types(dtype, row.dtype)
+            width = max([len(row) for row in good] + [0])
+            columns = numpy.zeros((len(rows), width), dtype=dtype)
+            if dtype.kind == 'f':
+                columns[:] = numpy.nan
+            for (j, row) in enumerate(rows):
+                if row is not None:
+                    columns[j, :len(row)] = row
+            self._columns[path] = columns
+        return self._columns[path]
+
+    def _get_labeled(self, name, key, points):
+        """
+        Return a dictionary of the value of key in the 'name'_values
+        dataset (eg name = 'position') for each of the points that
+        has key in its 'name'_labels
+        """
+        rows = self._get_rows(name + '_values', points)
+        self._get_rows(name + '_labels', points)
+        labels = self._rows[name + '_labels']
+        values = self._rows[name + '_values']
+        results = {}
+        for (point, row) in zip(points, rows):
+            if labels[row] is None:
+                continue
+            loc = numpy.nonzero(labels[row] == key)[0]
+            if len(loc) > 0:
+                results[point] = values[row][loc[0]]
+        return results
+
+    def _set_columns(self, path, points, idx, value):
+        """
+        Update the cached columns of dataset path after value has
+        been written to element idx of points
+        """
+        if path not in self._rows:
+            return
+        if path in self._columns and self._columns[path].dtype.kind in 'SU':
+            # strings may not fit, re-read them when needed
+            self._uncache_columns([path])
+            return
+        rows = self._get_rows(path, points)
+        if numpy.ndim(value) == 0:
+            value = [value]*len(rows)
+        try:
+            if path in self._columns:
+                self._columns[path][rows, idx] = value
+            for (row, val) in zip(rows, value):
+                if self._rows[path][row].dtype.kind in 'SU':
+                    raise ValueError
+                self._rows[path][row][idx] = val
+        except:
+            self._uncache_columns([path])
+
+    def _uncache_columns(self, paths=None):
+        """
+        Remove the cached columns of the values datasets
+        in paths (all if paths is None)
+        """
+        if paths == None:
+            self._index   = None
+            self._rows    = {}
+            self._columns = {}
+            return
+        for path in paths:
+            if path in self._rows:
+                del self._rows[path]
+            if path in self._columns:
+                del self._columns[path]
+
     def read_point(self,num):
         """
         read data from the point to self
@@ -428,60 +705,91 @@ class HdfDataFile:
         
         num should be the whole serial number string,
         eg '000328'
+
+        Each values dataset is read once, the images are only
+        read when the detector 'image_data' or 'corrected_image'
+        is accessed, and recently read points are cached.
         
         """
         #self._check_file()
         self.point = num
-        self.point_dict = {}
+        if num in self._cache:
+            self._lru.remove(num)
+            self._lru.append(num)
+            self.point_dict = _copy_point(self._cache[num])
+            return
+        point_dict = {}
+        point = self.file[num]
+        values = {}
         for key in GEN_KEYS:
             key_loc = GEN_KEYS[key]
-            self.point_dict[key] = self.file[num][key_loc[0]][key_loc[1]]
-        for key in self.file[num]['position_labels']:
-            key_loc = list(self.file[num]['position_labels']).index(key)
-            self.point_dict[key] = self.file[num]['position_values'][key_loc]
-        for key in self.file[num]['scaler_labels']:
-            key_loc = list(self.file[num]['scaler_labels']).index(key)
-            self.point_dict[key] = self.file[num]['scaler_values'][key_loc]
+            if key_loc[0] not in values:
+                values[key_loc[0]] = point[key_loc[0]][...]
+            point_dict[key] = values[key_loc[0]][key_loc[1]]
+        for (lbls,vals) in (('position_labels','position_values'),
+                            ('scaler_labels','scaler_values')):
+            labels = point[lbls][...]
+            data   = point[vals][...]
+            key_loc = {}
+            for (j,key) in enumerate(labels):
+                key_loc.setdefault(key,j)
+            for key in key_loc:
+                point_dict[key] = data[key_loc[key]]
         for key in ATT_KEYS:
             if key.startswith('hist'):
                 key = key + '.' + str(self.version)
-                self.point_dict['hist'] = self.file[num].attrs[key]
+                point_dict['hist'] = point.attrs[key]
             else:
-                self.point_dict[key] = self.file[num].attrs[key]
+                point_dict[key] = point.attrs[key]
         for key in MISC_KEYS:
-            self.point_dict[key] = self.file[num][key]
+            point_dict[key] = point[key]
         current_det_num = 0
         while True:
             try:
                 det_str = 'det_%i' % current_det_num
-                current_det = self.file[num][det_str]
-                self.point_dict[det_str] = {}
-                for key in DET_KEYS:
-                    key_loc = DET_KEYS[key]
-                    key_loc_path = key_loc[0] % (current_det_num, self.version)
-                    self.point_dict[det_str][key] = \
-                            self.file[num][key_loc_path][key_loc[1]]
+                current_det = point[det_str]
+                point_dict[det_str] = _DetDict(current_det)
+                self._read_det_values(point,current_det_num,
+                                      point_dict[det_str])
                 for key in DET_ATT_KEYS:
-                    self.point_dict[det_str][key] = \
-                            self.file[num][det_str].attrs[key]
-                try:
-                    point_image = \
-                            numpy.array(self.file[num][det_str]['image_data'])
-                    self.point_dict[det_str]['image_data'] = point_image
-                    point_mask = str(self.point_dict[det_str]['bad_pixel_map'])
-                    if not point_mask.startswith('(') and \
-                       not point_mask.startswith('['):
-                        point_mask = str(image_data.read_pixel_map(point_mask))
-                        self.point_dict[det_str]['bad_pixel_map'] = point_mask
-                    corrected_image = image_data.correct_image(point_image,
-                                                               point_mask)
-                    self.point_dict[det_str]['corrected_image'] = \
-                                                                corrected_image
-                except:
-                    pass
+                    point_dict[det_str][key] = current_det.attrs[key]
                 current_det_num += 1
             except:
                 break
+        # cache
+        self._cache[num] = point_dict
+        self._lru.append(num)
+        if len(self._lru) > self.ncache:
+            del self._cache[self._lru.pop(0)]
+        self.point_dict = _copy_point(point_dict)
+
+    def _read_det_values(self,point,det_num,det_dict):
+        """
+        Read the DET_KEYS values of detector det_num into det_dict,
+        reading each values dataset once
+        """
+        values = {}
+        for key in DET_KEYS:
+            key_loc = DET_KEYS[key]
+            key_loc_path = key_loc[0] % (det_num, self.version)
+            if key_loc_path not in values:
+                values[key_loc_path] = point[key_loc_path][...]
+            det_dict[key] = values[key_loc_path][key_loc[1]]
+
+    def _uncache(self,points=None):
+        """
+        Remove points from the point cache (all if points is None)
+        """
+        if points == None:
+            self._cache = {}
+            self._lru   = []
+            return
+        if isinstance(points, basestring):
+            points = [points]
+        for point in points:
+            if point in self._cache:
+                del self._cache[point]
+                self._lru.remove(point)
     
     '''def set(self, num, key, value):
         """Overwrite key in num with value."""
@@ -507,6 +815,7 @@ class HdfDataFile:
             points = []
             for item in self.all_items:
                 points.append(item[0])
+        self._uncache(points)
         #for point in points:
         if isinstance(key, basestring):
             if key in GEN_KEYS:
@@ -515,6 +824,7 @@ class HdfDataFile:
                 key_loc = GEN_KEYS[key]
                 for point in points:
                     self.file[point][key_loc[0]][key_loc[1]] = value
+                self._set_columns(key_loc[0], points, key_loc[1], value)
             elif key in self.file[self.point]['position_labels']:
                 if self.point in points:
                     self.point_dict[key] = value
@@ -522,6 +832,7 @@ class HdfDataFile:
                        list(self.file[self.point]['position_labels']).index(key)
                 for point in points:
                     self.file[point]['position_values'][key_loc] = value
+                self._uncache_columns(['position_values'])
             elif key in self.file[self.point]['scaler_labels']:
                 if self.point in points:
                     self.point_dict[key] = value
@@ -529,6 +840,7 @@ class HdfDataFile:
                        list(self.file[self.point]['scaler_labels']).index(key)
                 for point in points:
                     self.file[point]['scaler_values'][key_loc] = value
+                self._uncache_columns(['scaler_values'])
             elif key in ATT_KEYS:
                 if self.point in points:
                     self.point_dict[key] = value
@@ -558,6 +870,8 @@ class HdfDataFile:
                     except IOError:
                         self.file[point][det_name][key_loc_path][key_loc[1]] = \
                                                               numpy.float(value)
+                self._set_columns(det_name + '/' + key_loc_path, points,
+                                  key_loc[1], value)
             elif key in DET_ATT_KEYS:
                 if self.point in points:
                     self.point_dict[det_name][key] = value
@@ -596,20 +910,31 @@ class HdfDataFile:
         write data to file 
         
         data is a dictionary 
+
+        If the point is cached only the values that differ
+        from the cached (file) values are written
         """
         #self._check_file()
         #
         if num is None:
             num = self.point
+        cached = self._cache.get(num, {})
+        changed = False
         for key in data:
             if key.startswith('hist'):
+                if _same(cached.get('hist'), data['hist']):
+                    continue
                 key = key + '.' + str(self.version)
                 self.file[num].attrs[key] = data['hist']
+                changed = True
             elif key.startswith('det_'):
                 det_dict = data[key]
+                cached_det = cached.get(key, {})
                 for det_key in det_dict:
                     try:
                         key_loc = DET_KEYS[det_key]
+                        if _same(cached_det.get(det_key), data[key][det_key]):
+                            continue
                         key_loc_path = key_loc[0].split('/')[1] % self.version
                         try:
                             self.file[num][key][key_loc_path][key_loc[1]] = \
@@ -617,10 +942,60 @@ class HdfDataFile:
                         except IOError:
                             self.file[num][key][key_loc_path][key_loc[1]] = \
                                                  numpy.float(data[key][det_key])
+                        changed = True
                     except KeyError:
                         pass
             else:
                 pass
+        # update the cached point with what is now in the file
+        if changed:
+            self._update_columns(num)
+        if changed and num in self._cache:
+            point = self.file[num]
+            cached['hist'] = point.attrs['hist.' + str(self.version)]
+            for key in cached:
+                if isinstance(cached[key], _DetDict):
+                    self._read_det_values(point,int(key[4:]),cached[key])
+
+    def _update_columns(self, num):
+        """
+        Re-read the cached detector values datasets of point num
+        """
+        if self._index == None or num not in self._index[1]:
+            return
+        row = self._index[1][num]
+        for path in self._rows.keys():
+            if path.startswith('det_'):
+                try:
+                    values = self.file[num][path][...]
+                    self._rows[path][row] = values
+                    if path in self._columns:
+                        self._columns[path][row, :len(values)] = values
+                except:
+                    self._uncache_columns([path])
+
+##############################################################################
+def _same(a,b):
+    """
+    True if a and b are equal scalar values
+    """
+    if a is None:
+        return False
+    try:
+        return bool(a == b)
+    except:
+        return False
+
+##############################################################################
+def _copy_point(point_dict):
+    """
+    Copy a point dictionary (and its detector dictionaries)
+    """
+    point_dict = point_dict.copy()
+    for key in point_dict:
+        if isinstance(point_dict[key], _DetDict):
+            point_dict[key] = point_dict[key].copy()
+    return point_dict
 
 ##############################################################################
 if __name__ == "__main__":
@@ -452,7 +452,7 @@ def line_sum_integral(image,sumflag='c',nbgr=0,width=0,pow=2.,
 
 ##############################################################################
 def image_bgr(image,lineflag='c',nbgr=3,width=100,pow=2.,tangent=False,
-              nline=1,filter=False,compress=1,plot=False):
+              nline=1,filter=False,compress=1,plot=False,vectorize=True):
     """
     Calculate a 2D background for the image.
 
@@ -486,6 +486,10 @@ def image_bgr(image,lineflag='c',nbgr=3,width=100,pow=2.,tangent=False,
       reduced.  This helps speed up the background fits.  
      
     * plot is a flag to indicate if a 'plot' should be made
+
+    * vectorize is a flag to indicate if the backgrounds of all lines
+      should be computed at once (see background.background), otherwise
+      the lines are fit one at a time
     """
     bgr_arr = num.zeros(image.shape)
 
@@ -496,8 +500,19 @@ def image_bgr(image,lineflag='c',nbgr=3,width=100,pow=2.,tangent=False,
         #print 'spline filter'
         image = ndimage.interpolation.spline_filter(image,order=3)
 
+    # fit all rows / cols at once
+    if vectorize:
+        if lineflag=='r':
+            lines = _line_average(image,nline=nline,axis=0)
+            bgr_arr = background(lines,nbgr=nbgr,width=width,pow=pow,
+                                 tangent=tangent,compress=compress,axis=1)
+        elif lineflag=='c':
+            lines = _line_average(image,nline=nline,axis=1)
+            bgr_arr = background(lines,nbgr=nbgr,width=width,pow=pow,
+                                 tangent=tangent,compress=compress,axis=0)
+
     # fit to rows
-    if lineflag=='r':
+    elif lineflag=='r':
         if nline > 1:
             ll = int(nline/2.)
             n = image.shape[0]
@@ -516,7 +531,7 @@ def image_bgr(image,lineflag='c',nbgr=3,width=100,pow=2.,tangent=False,
                                           tangent=tangent,compress=compress)
 
     # fit to cols
-    if lineflag=='c':
+    elif lineflag=='c':
         if nline > 1:
             ll = int(nline/2.)
             n = image.shape[1]
@@ -555,6 +570,28 @@ def image_bgr(image,lineflag='c',nbgr=3,width=100,pow=2.,tangent=False,
 
     return bgr_arr
 
+def _line_average(image,nline=1,axis=0):
+    """
+    Average each line of the image with its neighbors along axis,
+    ie line j is the average of lines j-nline/2 to j+nline/2 (truncated
+    at the image edges).  This is the line averaging used by image_bgr
+    computed for all lines at once from a cumulative sum.
+    """
+    if nline <= 1:
+        return image
+    ll   = int(nline/2.)
+    n    = image.shape[axis]
+    csum = num.cumsum(image,axis=axis,dtype=float)
+    csum = num.concatenate((num.zeros_like(num.take(csum,[0],axis=axis)),csum),
+                           axis=axis)
+    j    = num.arange(n)
+    lidx = num.maximum(0,j-ll)
+    ridx = num.minimum(n,j+ll+1)
+    shape = [1]*image.ndim
+    shape[axis] = n
+    npts = num.reshape(ridx - lidx,shape)
+    return (num.take(csum,ridx,axis=axis) - num.take(csum,lidx,axis=axis))/npts
+
 ################################################################################
 class ImageAna:
     """
@@ -719,14 +756,18 @@ class ImageAna:
                                         filter=self.filter,compress=self.compress,
                                         plot=False)
             else:
-                bgr_r = image_bgr(self.clpimg,lineflag='c',nbgr=self.cbgr['nbgr'],
+                # filter once and use for both directions
+                img = self.clpimg
+                if self.filter == True:
+                    img = ndimage.interpolation.spline_filter(img,order=3)
+                bgr_r = image_bgr(img,lineflag='c',nbgr=self.cbgr['nbgr'],
                                   width=self.cbgr['width'],pow=self.cbgr['pow'],
                                   tangent=self.cbgr['tan'],nline=self.nline,
-                                  filter=self.filter,compress=self.compress,plot=False)
-                bgr_c = image_bgr(self.clpimg,lineflag='r',nbgr=self.rbgr['nbgr'],
+                                  filter=False,compress=self.compress,plot=False)
+                bgr_c = image_bgr(img,lineflag='r',nbgr=self.rbgr['nbgr'],
                                   width=self.rbgr['width'],pow=self.rbgr['pow'],
                                   tangent=self.rbgr['tan'],nline=self.nline,
-                                  filter=self.filter,compress=self.compress,plot=False)
+                                  filter=False,compress=self.compress,plot=False)
                 # combine the two bgrs by taking avg
                 self.bgrimg = (bgr_r + bgr_c)/2.
                     
@@ -1028,6 +1069,7 @@ class ImageScan:
           archive['path'] = path for image archive
           archive['setname'] = set name for image archive
           archive['descr'] = description of data for image archive
+          archive['complevel'] = compression level (0-9) for image archive
         """
         if type(image) != types.ListType: image = [image]
         if archive != None:
@@ -1035,8 +1077,10 @@ class ImageScan:
             path    = archive.get('path')
             setname = archive.get('setname','S1')
             descr   = archive.get('descr','Scan Data Archive')
+            complevel = archive.get('complevel',0)
             self.image = _ImageList(image,file=file,path=path,
-                                    setname=setname,descr=descr)
+                                    setname=setname,descr=descr,
+                                    complevel=complevel)
         else:
             self.image = image
         self.rois     = None
@@ -1157,13 +1201,18 @@ class ImageScan:
                
     ################################################################
     def integrate(self,idx=[],roi=None,rotangle=None,bgr_params=None,
-                  bad_points=[],plot=False,fig=None):
+                  bad_points=[],plot=False,fig=None,workers=1):
         """
         integrate images
 
         Parameters:
         -----------
         * idx are the indicies to integrate
+        * workers is the number of processes used for the integrations.
+          If workers > 1 (and plot is False) the images are integrated
+          in parallel by a process pool, otherwise (or if the pool can't
+          be started) the images are integrated one at a time.
+          Points that fail in a worker are treated as bad points.
         * other parameters are same as on __init__ and can
           be updated here or pass as None to use existing values.
         """
@@ -1202,23 +1251,77 @@ class ImageScan:
                 for j in idx:
                     self.bgrpar[j] = copy.copy(bgr_params[j])
         # do integrations
+        if workers > 1 and plot == False:
+            good = [j for j in idx if j not in bad_points]
+            failed = self._integrate_parallel(good,workers=workers)
+            if failed == None:
+                workers = 1
+            else:
+                bad_points = list(bad_points) + failed
         for j in idx:
-            if j not in bad_points:
+            if j in bad_points:
+                self._zero_point(j)
+            elif workers <= 1 or plot == True:
                 self._integrate(idx=j,plot=plot,fig=fig)
-            else:
-                self.peaks['I'][j]      = 0.
-                self.peaks['Ierr'][j]   = 0.
-                self.peaks['Ibgr'][j]   = 0.
-                #
-                self.peaks['I_c'][j]    = 0.
-                self.peaks['Ierr_c'][j] = 0.
-                self.peaks['Ibgr_c'][j] = 0.
-                #
-                self.peaks['I_r'][j]    = 0.
-                self.peaks['Ierr_r'][j] = 0.
-                self.peaks['Ibgr_r'][j] = 0.
 
         self._is_integrated = True
+
+    ################################################################
+    def _zero_point(self,idx):
+        """
+        zero the results of a (bad) point
+        """
+        self.peaks['I'][idx]      = 0.
+        self.peaks['Ierr'][idx]   = 0.
+        self.peaks['Ibgr'][idx]   = 0.
+        #
+        self.peaks['I_c'][idx]    = 0.
+        self.peaks['Ierr_c'][idx] = 0.
+        self.peaks['Ibgr_c'][idx] = 0.
+        #
+        self.peaks['I_r'][idx]    = 0.
+        self.peaks['Ierr_r'][idx] = 0.
+        self.peaks['Ibgr_r'][idx] = 0.
+
+    ################################################################
+    def _integrate_parallel(self,idx,workers=2):
+        """
+        integrate the images in idx using a pool of worker processes.
+
+        Each worker is only sent the clipped roi and the background
+        parameters of the point, and the results are put into the
+        peaks dictionary in scan point order.  Returns a list of the
+        points that failed, or None if the pool could not be started
+        """
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes=workers)
+        except:
+            print "Unable to start process pool, integrating serially"
+            return None
+        def jobs():
+            for j in idx:
+                clpimg = clip_image(self.image[j],self.rois[j],
+                                    rotangle=self.rotangle[j],cp=True)
+                yield (clpimg,self.bgrpar[j])
+        failed = []
+        try:
+            results = pool.imap(_integrate_roi,jobs(),
+                                chunksize=max(1,len(idx)/(4*workers)))
+            for (j,res) in zip(idx,results):
+                if res == None:
+                    print "Error integrating scan point %i" % j
+                    failed.append(j)
+                    continue
+                (self.peaks['I'][j], self.peaks['Ierr'][j],
+                 self.peaks['Ibgr'][j], self.peaks['I_c'][j],
+                 self.peaks['Ierr_c'][j], self.peaks['Ibgr_c'][j],
+                 self.peaks['I_r'][j], self.peaks['Ierr_r'][j],
+                 self.peaks['Ibgr_r'][j]) = res
+        finally:
+            pool.close()
+            pool.join()
+        return failed
     
     ################################################################
     def _integrate(self,idx=0,plot=True,fig=None):
@@ -1249,10 +1352,34 @@ class ImageScan:
         self.peaks['Ierr_r'][idx] = img_ana.Ierr_r
         self.peaks['Ibgr_r'][idx] = img_ana.Ibgr_r
 
+################################################################
+def _integrate_roi(args):
+    """
+    integrate a clipped image (process pool worker for
+    ImageScan._integrate_parallel).  args = (clpimg,bgr_params).
+    Returns a tuple of the integrated intensities or None
+    if the integration fails
+    """
+    (clpimg,bgr_params) = args
+    try:
+        roi = [0,0,clpimg.shape[1],clpimg.shape[0]]
+        a = ImageAna(clpimg,roi=roi,rotangle=0.0,plot=False,**bgr_params)
+        return (a.I, a.Ierr, a.Ibgr, a.I_c, a.Ierr_c, a.Ibgr_c,
+                a.I_r, a.Ierr_r, a.Ibgr_r)
+    except:
+        return None
+
 ################################################################
 class _ImageList:
     """
     Keep images in a hdf file using pytables
+
+    The archive file is opened on first access and kept open, only
+    the requested frame (or slice) is read from the file and a small
+    cache of the most recently used frames is kept in memory.  The
+    images are written as a chunked array with one frame per chunk,
+    compressed if complevel > 0 (blosc if available, otherwise zlib).
+    Compression makes the archive smaller but writing much slower.
     
     Note an alternative is to use:
        num.savez(fname,image)
@@ -1260,40 +1387,111 @@ class _ImageList:
     """
     ################################################################
     def __init__(self,images,file='images.h5',path=None,
-                 setname='S000',descr='Scan data images'):
+                 setname='S000',descr='Scan data images',ncache=8,
+                 complevel=0):
         self.path = path
         self.file = file
         self.setname = setname
+        self.ncache  = ncache
+        self.nimages = None
+        self._h      = None
+        self._node   = None
+        self._cache  = {}
+        self._lru    = []
         #
         if images != None:
             self.nimages = len(images)
             try:
-                self._write_image_tables(images,setname,descr)
+                self._write_image_tables(images,setname,descr,complevel)
             except:
                 self._cleanup()
                 print "Unable to write images:"
                 print "   Setname %s, hdf file %s" % (file,setname) 
     
+    ################################################################
+    def __getstate__(self):
+        """
+        dont pickle the open file handle or the cache
+        """
+        state = self.__dict__.copy()
+        state['_h']     = None
+        state['_node']  = None
+        state['_cache'] = {}
+        state['_lru']   = []
+        return state
+
+    ################################################################
+    def __setstate__(self,state):
+        """
+        lists pickled before the file handle and cache
+        were added only have path, file and setname
+        """
+        self.ncache  = 8
+        self.nimages = None
+        self.__dict__.update(state)
+        self._h      = None
+        self._node   = None
+        self._cache  = {}
+        self._lru    = []
+
     ################################################################
     def _cleanup(self):
+        self._close()
         try:
             import tables
             tables.file.close_open_files()
         except:
             pass
 
+    ################################################################
+    def _close(self):
+        """
+        release the file handle and the frame cache
+        """
+        try:
+            if self._h != None and self._h.isopen:
+                self._h.close()
+        except:
+            pass
+        self._h     = None
+        self._node  = None
+        self._cache = {}
+        self._lru   = []
+
     ################################################################
     def __len__(self):
+        if self.nimages == None:
+            node = self._get_node()
+            if node == None: return 0
+            self.nimages = node.shape[0]
         return self.nimages
 
+    ################################################################
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
     ################################################################
     def __getitem__(self,arg):
         """
         Get item.  
         """
-        images = self._read_image_tables()
-        #return copy.copy(images[arg])
-        return images[arg]
+        if type(arg) not in (types.IntType,types.LongType) and \
+           not isinstance(arg,num.integer):
+            node = self._get_node()
+            if node == None: return None
+            return node[arg]
+        if arg < 0: arg = arg + len(self)
+        if arg in self._cache:
+            self._lru.remove(arg)
+        else:
+            node = self._get_node()
+            if node == None: return None
+            self._cache[arg] = node[arg]
+            if len(self._lru) >= self.ncache:
+                del self._cache[self._lru.pop(0)]
+        self._lru.append(arg)
+        return self._cache[arg].copy()
 
     ################################################################
     def __setitem__(self,arg):
@@ -1313,13 +1511,15 @@ class _ImageList:
         return fname
 
     ################################################################
-    def _write_image_tables(self,images,setname,descr):
+    def _write_image_tables(self,images,setname,descr,complevel=0):
         """
         Write images to file
         """
         import tables
         images = num.array(images)
         fname  = self._make_fname()
+        # close any handles open for reading
+        self._cleanup()
         if os.path.exists(fname):
             h    = tables.openFile(fname,mode="a")
             if not hasattr(h.root,'image_data'):
@@ -1337,29 +1537,107 @@ class _ImageList:
         else:
             h.createGroup('/image_data',setname,"Image Data")
             grp = '/image_data/' + setname
-            h.createArray(grp,'images',images,descr)
+            # one frame per chunk
+            atom    = tables.Atom.from_dtype(images.dtype)
+            if complevel > 0:
+                if tables.which_lib_version('blosc') != None:
+                    complib = 'blosc'
+                else:
+                    complib = 'zlib'
+                filters = tables.Filters(complevel=complevel,complib=complib)
+            else:
+                filters = None
+            node = h.createCArray(grp,'images',atom,images.shape,descr,
+                                  filters=filters,
+                                  chunkshape=(1,)+images.shape[1:])
+            node[:] = images
         h.close()
 
     ################################################################
-    def _read_image_tables(self,):
+    def _get_node(self):
+        """
+        Get the images node, opening the archive file if needed
+        """
+        if self._h != None and self._h.isopen:
+            return self._node
         import tables
+        self._close()
         fname = self._make_fname()
         if not os.path.exists(fname):
             print "Archive file not found:", fname
             return None
         grp = '/image_data/' + self.setname
         try:
-            h  = tables.openFile(fname,mode="r")
-            #n  = h.getNode('/images',self.setname)
-            n  = h.getNode(grp,'images')
-            im = n.read()
-            h.close()
-            return im
+            self._h    = tables.openFile(fname,mode="r")
+            self._node = self._h.getNode(grp,'images')
+            return self._node
         except:
             self._cleanup()
             print "Error reading image tables: %s" % grp
             return None
 
+    ################################################################
+    def _read_image_tables(self,):
+        """
+        Read all the images
+        """
+        node = self._get_node()
+        if node == None: return None
+        return node.read()
+
+################################################################################
+################################################################################
+def _bench_integrate(npts=200,workers=4):
+    """
+    compare serial and parallel ImageScan.integrate wall time
+    on a synthetic scan
+    """
+    import time
+    images = []
+    x = num.arange(487) - 243.
+    y = num.arange(195)[:,num.newaxis] - 97.
+    for j in range(npts):
+        peak = 500.*num.exp(-(x**2/50. + y**2/20.))
+        images.append(num.random.poisson(20.+peak).astype(float))
+    bgr = copy.copy(IMG_BGR_PARAMS)
+    bgr.update({'bgrflag':3,'cwidth':10,'rwidth':20})
+    scan = ImageScan(images,bgr_params=bgr)
+    t0 = time.time()
+    scan.integrate()
+    I  = scan.peaks['I'].copy()
+    t1 = time.time()
+    scan.integrate(workers=workers)
+    t2 = time.time()
+    print 'serial:   %.3f sec' % (t1-t0)
+    print 'parallel: %.3f sec (%i workers)' % (t2-t1,workers)
+    print 'max diff: %g' % num.abs(scan.peaks['I'] - I).max()
+
+def _bench_archive(nframes=500,shape=(195,487)):
+    """
+    time writing and iterating over the frames of an image
+    archive, uncompressed and compressed
+    """
+    import time, tempfile, shutil
+    path = tempfile.mkdtemp()
+    try:
+        images = [num.random.poisson(20.,size=shape) for j in range(nframes)]
+        for complevel in (0,1,5):
+            setname = 'S%i' % complevel
+            t0 = time.time()
+            ilist = _ImageList(images,file='bench.h5',path=path,
+                               setname=setname,complevel=complevel)
+            t1 = time.time()
+            tot = 0.
+            for im in ilist:
+                tot = tot + im[0,0]
+            t2 = time.time()
+            ilist._cleanup()
+            print 'complevel %i:' % complevel
+            print '   write %i frames: %.3f sec' % (nframes,t1-t0)
+            print '   iterate frames: %.3f sec' % (t2-t1)
+    finally:
+        shutil.rmtree(path)
+
 ################################################################################
 ################################################################################
 if __name__ == '__main__':
@@ -1369,6 +1647,10 @@ if __name__ == '__main__':
     except:
         print 'read_pilatus  tiff file'
         sys.exit()
+    if fname == '--bench':
+        _bench_archive()
+        _bench_integrate()
+        sys.exit()
     a = read(fname)
     image_show(a)
     
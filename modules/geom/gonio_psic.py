@@ -106,6 +106,7 @@ References:
 import numpy as num
 import types
 import copy
+from collections import OrderedDict
 
 from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
@@ -126,7 +127,8 @@ class Psic:
 
     """
     ###################################################
-    def __init__(self,a=10.,b=10.,c=10.,alpha=90.,beta=90.,gamma=90.,lam=1.0):
+    def __init__(self,a=10.,b=10.,c=10.,alpha=90.,beta=90.,gamma=90.,lam=1.0,
+                 init_UB=True):
         """
         Initialize
 
@@ -135,6 +137,9 @@ class Psic:
         * a,b,c in angstroms 
         * alpha, beta, gamma in degrees,
         * lambda in angstroms
+        * init_UB: if False the dummy orientation reflections and
+          UB are not set up, set_spec_G must be called to set the
+          orientation (see psic_from_spec)
         """
         # set lattice and lambda
         self.lattice = Lattice(a,b,c,alpha,beta,gamma,lam)
@@ -158,6 +163,13 @@ class Psic:
         self.kr = []
         self.h = [0.,0.,0.]
 
+        # Compute OR matricies
+        self.U = []
+        self.B = []
+        self.UB = []
+        self.UBinv = []
+        if not init_UB: return
+
         # dummy primary reflection
         tth = self.lattice.tth([0.,0.,1.],lam=lam)
         self.or0={'h':num.array([0.,0.,1.]),
@@ -169,11 +181,6 @@ class Psic:
         self.or1={'h':num.array([0.,1.,0.]),
                   'phi':0.0,'chi':0.0,'eta':tth/2.,'mu':0.0,
                   'nu':0.0,'delta':tth,'lam':lam}
-
-        # Compute OR matricies
-        self.U = []
-        self.B = []
-        self.UB = []
         self._calc_UB()
 
     ###################################################
@@ -228,11 +235,29 @@ class Psic:
                             beta=beta,gamma=gamma,lam=lam)
         self._calc_UB()
 
-    def set_spec_G(self,G,preparsed=False):
+    def set_spec_G(self,G,preparsed=False,update=True):
         """
         Take the spec G array for the psic geometry
         and set all the relevant orientation info...
+
+        If update is False and the G array is in the cache, h and
+        the psuedo angles are not recomputed (call set_angles)
         """
+        key = _G_key(G,preparsed)
+        if key in _G_CACHE:
+            # reuse the parsed G and orientation matrix
+            ((cell,or0,or1,n),(U,B,UB,UBinv)) = _G_CACHE.pop(key)
+            _G_CACHE[key] = ((cell,or0,or1,n),(U,B,UB,UBinv))
+            self.n   = n.copy()
+            self.or0 = _copy_or(or0)
+            self.or1 = _copy_or(or1)
+            self.lattice = Lattice(*cell)
+            self.U     = U.copy()
+            self.B     = B.copy()
+            self.UB    = UB.copy()
+            self.UBinv = UBinv.copy()
+            if update: self.set_angles()
+            return
         if not preparsed:
             (cell,or0,or1,n) = spec_psic_G(G)
         else:
@@ -242,6 +267,13 @@ class Psic:
         self.or1 = or1
         self.lattice = Lattice(*cell)
         self._calc_UB()
+        # store copies, the instance values may be changed later
+        if len(_G_CACHE) >= G_CACHE_SIZE:
+            _G_CACHE.popitem(last=False)
+        _G_CACHE[key] = ((num.array(cell,dtype=float),_copy_or(or0),
+                          _copy_or(or1),num.array(n,dtype=float)),
+                         (self.U.copy(),self.B.copy(),
+                          self.UB.copy(),self.UBinv.copy()))
 
     ################################################### 
     def set_or0(self,h=None,phi=None,chi=None,eta=None,
@@ -334,9 +366,9 @@ class Psic:
 
         # calc the phi frame coords for diffraction vectors
         # note divide out 2pi since the diffraction condition
-        # is 2pi*h = Q
-        vphi_1 = num.dot(num.linalg.inv(Z1), (Q1/(2.*num.pi)))
-        vphi_2 = num.dot(num.linalg.inv(Z2), (Q2/(2.*num.pi)))
+        # is 2pi*h = Q.  Z is a rotation so inv(Z) = Z^T
+        vphi_1 = num.dot(Z1.transpose(), (Q1/(2.*num.pi)))
+        vphi_2 = num.dot(Z2.transpose(), (Q2/(2.*num.pi)))
         
         #calc cartesian coords of h vectors
         hc_1 = num.dot(self.B, self.or0['h'])
@@ -370,8 +402,9 @@ class Psic:
         #self.U = num.dot(Tphi, Tc.transpose())
         self.U = num.dot(Tphi, num.linalg.inv(Tc))
 
-        # calc UB
-        self.UB = num.dot(self.U,self.B)
+        # calc UB, and store its inverse for calc of h
+        self.UB    = num.dot(self.U,self.B)
+        self.UBinv = num.linalg.inv(self.UB)
 
         #update h and psuedo angles...
         self.set_angles()
@@ -400,10 +433,11 @@ class Psic:
 
         Notes:
         ------
-        Solve for hphi using Z and lab frame Q:
+        This is the single point version of calc_h_array:
            hphi = inv(Z) * Q / (2*pi)
-        then calc h from
            h = inv(UB)*hphi
+        Z is a rotation matrix so inv(Z) = Z^T, and inv(UB)
+        is computed once when UB is set (see _calc_UB)
         """
         self.Z = calc_Z(phi=self.angles['phi'],chi=self.angles['chi'],
                         eta=self.angles['eta'],mu=self.angles['mu'])
@@ -414,10 +448,44 @@ class Psic:
         self.ki=ki
         self.kr=kr
         
-        hphi = num.dot(num.linalg.inv(self.Z),self.Q) / (2.*num.pi) 
-        h    = num.dot(num.linalg.inv(self.UB),hphi)
+        hphi = num.dot(self.Z.transpose(),self.Q) / (2.*num.pi) 
+        h    = num.dot(self.UBinv,hphi)
         self.h = h
         
+    ###################################################
+    def scan_arrays(self,phi=None,chi=None,eta=None,
+                    mu=None,nu=None,delta=None):
+        """
+        Compute h, Z, Q and the psuedo angles for a whole
+        set of angle settings (e.g. all points of a scan)
+        using the current UB and reference vector.
+
+        Parameters:
+        -----------
+        * phi, chi, eta, mu, nu, delta are arrays (or scalars)
+          of goniometer angles in degrees.  Angles that are None
+          are taken from the current instance settings
+
+        Returns:
+        --------
+        * dictionary of arrays with one entry per point:
+          'Z' (N,3,3), 'Q', 'ki', 'kr', 'h', 'nm' (N,3) and
+          the psuedo angles, 'tth', 'alpha', 'beta' etc.. (N,)
+          (see calc_h_array and calc_psuedo_array)
+
+        Notes:
+        ------
+        This does not change the instance angles.
+        """
+        ang = {'phi':phi,'chi':chi,'eta':eta,'mu':mu,'nu':nu,'delta':delta}
+        for key in ang.keys():
+            if ang[key] is None: ang[key] = self.angles[key]
+        a = calc_h_array(self.UB,lam=self.lattice.lam,UBinv=self.UBinv,**ang)
+        a.update(calc_psuedo_array(self.UB,self.n,a['Z'],a['Q'],a['kr'],
+                                   eta=ang['eta'],mu=ang['mu'],
+                                   nu=ang['nu'],delta=ang['delta']))
+        return a
+
     ###################################################
     def set_n(self,n=[0,0,1]):
         """
@@ -465,7 +533,7 @@ class Psic:
                            -sind(sig_az)*sind(tau_az), 
                                   cosd(sig_az)        ])
         # n in HKL
-        n_hkl = num.dot(num.linalg.inv(self.UB),n_phi)
+        n_hkl = num.dot(self.UBinv,n_phi)
         n_hkl = n_hkl/ num.max(num.abs(n_hkl))
         
         # note if l-component is negative, then its
@@ -492,6 +560,9 @@ class Psic:
         individual calls.  ie some psuedo angles depend on others
         so its important that the calc are executed in the correct
         order.  Also important is that _calc_h is called before this...
+
+        calc_psuedo_array does the same calcs for arrays of settings
+        (see _bench_set_angles for a check of the two)
         """
         self.pangles = {}
         if self.calc_psuedo == True:
@@ -696,14 +767,55 @@ class Psic:
         omega = cartesian_angle([Qpp[0], 0, Qpp[2]],Qpp)
         self.pangles['omega'] = omega
 
+##########################################################################
+# cache of parsed spec G arrays and orientation matricies, keyed by
+# the G values (see set_spec_G).  The oldest entries are dropped once
+# the cache holds G_CACHE_SIZE entries
+G_CACHE_SIZE = 64
+_G_CACHE = OrderedDict()
+
+def _G_key(G,preparsed=False):
+    """
+    Hashable key for a spec G array or a preparsed
+    (cell,or0,or1,n) tuple
+    """
+    if not preparsed:
+        return tuple(num.array(G,dtype=float).ravel())
+    (cell,or0,or1,n) = G
+    key = [tuple(num.array(cell,dtype=float).ravel()),
+           tuple(num.array(n,dtype=float).ravel())]
+    for orx in (or0,or1):
+        for lbl in sorted(orx.keys()):
+            key.append((lbl,tuple(num.array(orx[lbl],dtype=float).ravel())))
+    return tuple(key)
+
+def _copy_or(orx):
+    """
+    Copy of an orientation reflection dictionary
+    """
+    orx = dict(orx)
+    orx['h'] = num.array(orx['h'],dtype=float)
+    return orx
+
+def clear_G_cache():
+    """
+    Empty the cache of parsed G arrays / orientation matricies
+    """
+    _G_CACHE.clear()
+
 ##########################################################################
 def psic_from_spec(G,angles={},preparsed=False):
     """
     pass spec G array and dictionary of angles
     returns a psic instance
     """
-    gonio = Psic()
-    if G != None: gonio.set_spec_G(G, preparsed)
+    if G != None:
+        # skip the default orientation, h and the psuedo
+        # angles are only computed by set_angles below
+        gonio = Psic(init_UB=False)
+        gonio.set_spec_G(G, preparsed, update=False)
+    else:
+        gonio = Psic()
     gonio.set_angles(**angles)
     return gonio
 
@@ -810,18 +922,23 @@ def calc_Z(phi=0.0,chi=0.0,eta=0.0,mu=0.0):
     the lab frame coordinates of the vector => vm are given by:
          vm = Z*vphi
     """
-    P = num.array([[ cosd(phi), sind(phi), 0.],
-                   [-sind(phi), cosd(phi), 0.],
-                   [  0.,          0.,     1.]],float)
-    X = num.array([[ cosd(chi), 0., sind(chi)],
-                   [   0.,      1.,    0.],
-                   [-sind(chi), 0., cosd(chi)]],float)
-    H = num.array([[ cosd(eta), sind(eta), 0.],
-                   [-sind(eta), cosd(eta), 0.],
-                   [   0.,         0.,     1.]],float)
-    M  = num.array([[  1.,         0.,     0.      ],
-                    [  0.,      cosd(mu), -sind(mu)],
-                    [  0.,      sind(mu), cosd(mu)]],float)
+    # each sin/cos is evaluated once
+    (cp,sp) = (cosd(phi),sind(phi))
+    (cc,sc) = (cosd(chi),sind(chi))
+    (ce,se) = (cosd(eta),sind(eta))
+    (cm,sm) = (cosd(mu),sind(mu))
+    P = num.array([[ cp, sp, 0.],
+                   [-sp, cp, 0.],
+                   [ 0., 0., 1.]],float)
+    X = num.array([[ cc, 0., sc],
+                   [ 0., 1., 0.],
+                   [-sc, 0., cc]],float)
+    H = num.array([[ ce, se, 0.],
+                   [-se, ce, 0.],
+                   [ 0., 0., 1.]],float)
+    M  = num.array([[ 1., 0., 0.],
+                    [ 0., cm,-sm],
+                    [ 0., sm, cm]],float)
     Z = num.dot(num.dot(num.dot(M,H),X),P)
     return Z
 
@@ -848,11 +965,218 @@ def calc_kvecs(nu=0.0,delta=0.0,lam=1.0):
     """
     k  = (2.* num.pi / lam)
     ki = k * num.array([0.,1.,0.],dtype=float)
+    cdel = cosd(delta)
     kr = k * num.array([sind(delta),
-                        cosd(nu)*cosd(delta),
-                        sind(nu)*cosd(delta)],dtype=float)
+                        cosd(nu)*cdel,
+                        sind(nu)*cdel],dtype=float)
     return (ki,kr)
 
+##########################################################################
+def calc_Z_array(phi=0.0,chi=0.0,eta=0.0,mu=0.0):
+    """
+    Calculate the psic rotation matrix Z for arrays
+    of the 4 sample angles (degrees).  The angles are
+    broadcast against each other and the result is
+    a stack of matricies with shape (N,3,3), ie
+    Z[j] == calc_Z(phi[j],chi[j],eta[j],mu[j])
+    """
+    (phi,chi,eta,mu) = num.broadcast_arrays(
+                           num.atleast_1d(num.asarray(phi,dtype=float)),
+                           num.atleast_1d(num.asarray(chi,dtype=float)),
+                           num.atleast_1d(num.asarray(eta,dtype=float)),
+                           num.atleast_1d(num.asarray(mu,dtype=float)))
+    npts = len(phi)
+    P = num.zeros((npts,3,3))
+    P[:,0,0] =  cosd(phi); P[:,0,1] = sind(phi)
+    P[:,1,0] = -sind(phi); P[:,1,1] = cosd(phi)
+    P[:,2,2] =  1.
+    X = num.zeros((npts,3,3))
+    X[:,0,0] =  cosd(chi); X[:,0,2] = sind(chi)
+    X[:,1,1] =  1.
+    X[:,2,0] = -sind(chi); X[:,2,2] = cosd(chi)
+    H = num.zeros((npts,3,3))
+    H[:,0,0] =  cosd(eta); H[:,0,1] = sind(eta)
+    H[:,1,0] = -sind(eta); H[:,1,1] = cosd(eta)
+    H[:,2,2] =  1.
+    M = num.zeros((npts,3,3))
+    M[:,0,0] =  1.
+    M[:,1,1] =  cosd(mu);  M[:,1,2] = -sind(mu)
+    M[:,2,1] =  sind(mu);  M[:,2,2] = cosd(mu)
+    Z = num.einsum('nij,njk->nik',M,H)
+    Z = num.einsum('nij,njk->nik',Z,X)
+    Z = num.einsum('nij,njk->nik',Z,P)
+    return Z
+
+##########################################################################
+def calc_Q_array(nu=0.0,delta=0.0,lam=1.0,ret_k=False):
+    """
+    Calculate psic Q in the cartesian lab frame for arrays
+    of nu and delta (degrees).  Returns arrays of shape (N,3)
+
+    if ret_k == True return tuple -> (Q,ki,kr)
+    """
+    (nu,delta) = num.broadcast_arrays(
+                     num.atleast_1d(num.asarray(nu,dtype=float)),
+                     num.atleast_1d(num.asarray(delta,dtype=float)))
+    k  = (2.* num.pi / lam)
+    ki = num.zeros((len(nu),3))
+    ki[:,1] = k
+    kr = k * num.array([sind(delta),
+                        cosd(nu)*cosd(delta),
+                        sind(nu)*cosd(delta)],dtype=float).transpose()
+    Q = kr - ki
+    if ret_k == True:
+        return (Q,ki,kr)
+    else:
+        return Q
+
+##########################################################################
+def calc_h_array(UB,phi=0.0,chi=0.0,eta=0.0,mu=0.0,nu=0.0,delta=0.0,
+                 lam=1.0,UBinv=None):
+    """
+    Calculate the hkl values of the vectors in the diffraction
+    condition for arrays of goniometer angles
+
+    Parameters:
+    -----------
+    * UB is the orientation matrix (see Psic)
+    * phi, chi, eta, mu, nu, delta are arrays (or scalars) of
+      angles in degrees, these are broadcast against each other
+    * lam is the wavelength in angstroms
+    * UBinv is inv(UB), computed if not passed
+
+    Returns:
+    --------
+    * dictionary with 'h' (N,3), ie the h, k and l values
+      are h[:,0], h[:,1] and h[:,2], and 'Z' (N,3,3),
+      'Q', 'ki', 'kr' (N,3)
+
+    Notes:
+    ------
+    Solve for hphi using Z and lab frame Q:
+       hphi = inv(Z) * Q / (2*pi)
+    then calc h from
+       h = inv(UB)*hphi
+    Z is a rotation matrix so inv(Z) = Z^T
+    """
+    if UBinv is None: UBinv = num.linalg.inv(UB)
+    Z = calc_Z_array(phi=phi,chi=chi,eta=eta,mu=mu)
+    (Q,ki,kr) = calc_Q_array(nu=nu,delta=delta,lam=lam,ret_k=True)
+    npts = max(len(Z),len(Q))
+    if len(Z) != npts: Z = Z*num.ones((npts,1,1))
+    if len(Q) != npts:
+        Q  = Q*num.ones((npts,1))
+        ki = ki*num.ones((npts,1))
+        kr = kr*num.ones((npts,1))
+    hphi = num.einsum('nji,nj->ni',Z,Q) / (2.*num.pi)
+    h    = num.dot(hphi,UBinv.transpose())
+    return {'h':h,'Z':Z,'Q':Q,'ki':ki,'kr':kr}
+
+##########################################################################
+def calc_psuedo_array(UB,n,Z,Q,kr,eta=0.0,mu=0.0,nu=0.0,delta=0.0):
+    """
+    Calculate the psuedo angles for arrays of settings
+
+    Parameters:
+    -----------
+    * UB is the orientation matrix
+    * n is the reference vector (hkl) for the psuedo angles
+    * Z (N,3,3), Q and kr (N,3) are from calc_h_array
+    * eta, mu, nu and delta are the angles (degrees) used
+      to compute Z and Q
+
+    Returns:
+    --------
+    * dictionary with 'nm' (N,3), the normalized reference
+      vector in the rotated lab frame, and (N,) arrays of
+      'tth','sigma_az','tau_az','naz','alpha','beta',
+      'tau','psi','qaz','omega'
+
+    Notes:
+    ------
+    * tth = 2Theta, the scattering angle
+    * sigma_az = angle between the z-axis and n in the phi frame
+    * tau_az = angle between the projection of n in the
+      xy-plane and the x-axis in the phi frame
+    * naz = angle btwn the reference vector n and the yz plane
+    * alpha = incidence angle, ie angle btwn -1*k_in (which is
+      parallel to lab-y) and the plane perp to n
+    * beta = exit angle, ie angle btwn k_r and the plane perp to n
+      (= arcsind(2*sind(tth/2)*cosd(tau)-sind(alpha)))
+    * tau = angle btwn n and the scattering-plane defined by
+      ki and kr, ie the angle between n and Q
+    * psi = azmuthal angle of n wrt Q. ie for tau != 0, psi is
+      the rotation of n about Q (zero if tau or tth/2 is 90)
+    * qaz = angle btwn Q and the yz plane
+    * omega = angle between Q and the plane which is
+      perpendicular to the axis of the chi circle.  For nu=mu=0
+      this is the same as the four circle def:
+      omega = 0.5*TTH - TH, where TTH is the detector motor (=del)
+      and TH is the sample circle (=eta).
+    """
+    eta   = num.asarray(eta,dtype=float)
+    mu    = num.asarray(mu,dtype=float)
+    nu    = num.asarray(nu,dtype=float)
+    delta = num.asarray(delta,dtype=float)
+    Z  = num.asarray(Z,dtype=float).reshape((-1,3,3))
+    Q  = num.asarray(Q,dtype=float).reshape((-1,3))
+    kr = num.asarray(kr,dtype=float).reshape((-1,3))
+    npts = max(len(Z),len(Q),eta.size,mu.size,nu.size,delta.size)
+    ones = num.ones(npts)
+    if len(Q) != npts:
+        Q  = Q*ones[:,num.newaxis]
+        kr = kr*ones[:,num.newaxis]
+    (cd,sd) = (cosd(delta),sind(delta))
+    p = {}
+    # tth
+    p['tth'] = arccosd(cd*cosd(nu))*ones
+    # nm = Z*UB*n normalized
+    n_phi = num.dot(UB,n)
+    nm = num.dot(Z,n_phi)*ones[:,num.newaxis]
+    nm = nm / num.sqrt((nm**2).sum(axis=1))[:,num.newaxis]
+    p['nm'] = nm
+    # sigma_az and tau_az only depend on n in the phi frame
+    n_phi = n_phi/cartesian_mag(n_phi)
+    p['sigma_az'] = arccosd(n_phi[2])*ones
+    p['tau_az']   = num.degrees(num.arctan2(-n_phi[1],n_phi[0]))*ones
+    # naz, alpha, beta
+    p['naz']   = num.degrees(num.arctan2(nm[:,0],nm[:,2]))
+    p['alpha'] = arcsind(-nm[:,1])
+    kr_n = kr / num.sqrt((kr**2).sum(axis=1))[:,num.newaxis]
+    p['beta']  = arcsind((nm*kr_n).sum(axis=1))
+    # tau
+    p['tau'] = _vector_angle(Q,nm)
+    # psi
+    xx    = cosd(p['tau'])*sind(p['tth']/2.) - sind(p['alpha'])
+    denom = sind(p['tau'])*cosd(p['tth']/2.)
+    zero  = (denom == 0.)
+    p['psi'] = num.where(zero,0.,arccosd(xx/num.where(zero,1.,denom)))
+    # qaz
+    p['qaz'] = num.degrees(num.arctan2(sd,cd*sind(nu)))*ones
+    # omega, Qpp = M^T * H^T * Q
+    (ce,se) = (cosd(eta),sind(eta))
+    (cm,sm) = (cosd(mu),sind(mu))
+    v1  = se*Q[:,0] + ce*Q[:,1]
+    Qpp = num.empty((npts,3))
+    Qpp[:,0] =  ce*Q[:,0] - se*Q[:,1]
+    Qpp[:,1] =  cm*v1 + sm*Q[:,2]
+    Qpp[:,2] = -sm*v1 + cm*Q[:,2]
+    Qxz = Qpp.copy()
+    Qxz[:,1] = 0.
+    p['omega'] = _vector_angle(Qxz,Qpp)
+    return p
+
+def _vector_angle(u,v):
+    """
+    Angles (degrees) between the rows of u and v,
+    (N,3) arrays. See mathutil.cartesian_angle
+    """
+    denom = num.sqrt((u**2).sum(axis=1)*(v**2).sum(axis=1))
+    zero  = (denom == 0.)
+    arg   = (u*v).sum(axis=1)/num.where(zero,1.,denom)
+    arg   = num.clip(arg,-1.,1.)
+    return num.where(zero,0.,arccosd(arg))
+
 ##########################################################################
 def calc_D(nu=0.0,delta=0.0):
     """
@@ -1073,6 +1397,24 @@ def test1():
     return psic
 
 ##########################################################################
+# spec G array used by test2 and _bench_set_angles
+_TEST_G = [0.0, 0.0, 1.0, 0.0039915744589999998, 0.00075650941450000001, 1.0, 0.0, 0.0, 0.0, 0.0,
+           0.0, 0.0, 50.0, 0.0, 0.0, 1.0, 4.0, 4.0, 5.0, 4.0, 0.0, 0.0, 8.0939999999999994,
+           4.9880000000000004, 6.0709999999999997, 90.0, 90.0, 90.0, 0.77627690969999996,
+           1.2596602459999999, 1.034950635, 90.0, 90.0, 90.0, 0.0, 0.0, 4.0, 2.0, 0.0,
+           2.4809999999999999, -0.00089999999999999998, 0.00080000000000000004, -0.1244,
+           175.2192, 31.965, 16.27375, 15.090299999999999, 7.5477999999999996, 11.9002,
+           -96.048199999999994, 17.594249999999999, 0.35625000000000001, 0.83580100000000002,
+           0.83580100000000002, -0.23926186720000001, 1.1983306439999999, -0.0026481987470000001,
+           -0.73847260000000003, -0.38826052760000002, -0.0050577973450000001, -0.004221190899,
+           0.001168841303, 1.034934888, -0.00011346681140000001, 0.0002801762336, 5.9400141580000003,
+           0.83580100000000002, 23.955432519999999, 24.314067479999999, 0.28474999779999999,
+           48.269500000000001, 0.075104988760000005, 0.17931763710000001, -0.00040199175790000001,
+           -0.00014478299110000001, 0.48309999999999997, 108.00069999999999, 2.0, 0.0, 0.0, 0.0, 0.0,
+           12.0, 0.0, 0.0, 2.0802999999999998, 123.1461, 0.0, 0.0, 0.0, 0.0, -180.0, -180.0, -180.0,
+           -180.0, -180.0, -180.0, -180.0, -180.0, -180.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+           0.0, 0.0, 0.0, 0.0]
+
 def test2(show=True):
     """
     G parsing from specfile.py
@@ -1089,22 +1431,7 @@ def test2(show=True):
     76. TAU_AZ=0    # Q[13], Angle to specify reference vector, = -flat_phi
     """
     psic = Psic()
-    G = [0.0, 0.0, 1.0, 0.0039915744589999998, 0.00075650941450000001, 1.0, 0.0, 0.0, 0.0, 0.0,
-         0.0, 0.0, 50.0, 0.0, 0.0, 1.0, 4.0, 4.0, 5.0, 4.0, 0.0, 0.0, 8.0939999999999994,
-         4.9880000000000004, 6.0709999999999997, 90.0, 90.0, 90.0, 0.77627690969999996,
-         1.2596602459999999, 1.034950635, 90.0, 90.0, 90.0, 0.0, 0.0, 4.0, 2.0, 0.0,
-         2.4809999999999999, -0.00089999999999999998, 0.00080000000000000004, -0.1244,
-         175.2192, 31.965, 16.27375, 15.090299999999999, 7.5477999999999996, 11.9002,
-         -96.048199999999994, 17.594249999999999, 0.35625000000000001, 0.83580100000000002,
-         0.83580100000000002, -0.23926186720000001, 1.1983306439999999, -0.0026481987470000001,
-         -0.73847260000000003, -0.38826052760000002, -0.0050577973450000001, -0.004221190899,
-         0.001168841303, 1.034934888, -0.00011346681140000001, 0.0002801762336, 5.9400141580000003,
-         0.83580100000000002, 23.955432519999999, 24.314067479999999, 0.28474999779999999,
-         48.269500000000001, 0.075104988760000005, 0.17931763710000001, -0.00040199175790000001,
-         -0.00014478299110000001, 0.48309999999999997, 108.00069999999999, 2.0, 0.0, 0.0, 0.0, 0.0,
-         12.0, 0.0, 0.0, 2.0802999999999998, 123.1461, 0.0, 0.0, 0.0, 0.0, -180.0, -180.0, -180.0,
-         -180.0, -180.0, -180.0, -180.0, -180.0, -180.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-         0.0, 0.0, 0.0, 0.0]
+    G = _TEST_G
     psic.set_spec_G(G)
 
     # diffr. angles:
@@ -1149,6 +1476,42 @@ def test2(show=True):
 
     return psic
     
+##########################################################################
+def _bench_set_angles(npts=100000,nspec=1000,ncheck=1000):
+    """
+    Time npts calls to set_angles and nspec calls to
+    psic_from_spec with the same G array (cached UB), and
+    check the scalar (set_angles) and array (scan_arrays)
+    calcs agree for the first ncheck settings
+    """
+    import time
+    psic = test2(show=False)
+    G    = _TEST_G
+    ang  = num.random.uniform(-10.,10.,(npts,6))
+    ang[:,4] = ang[:,4] + 20.
+    a = psic.scan_arrays(phi=ang[:ncheck,0],chi=ang[:ncheck,1],
+                         eta=ang[:ncheck,2],mu=ang[:ncheck,3],
+                         nu=ang[:ncheck,4],delta=ang[:ncheck,5])
+    t = time.time()
+    for j in range(npts):
+        psic.set_angles(phi=ang[j,0],chi=ang[j,1],eta=ang[j,2],
+                        mu=ang[j,3],nu=ang[j,4],delta=ang[j,5])
+        if j < ncheck:
+            diff = num.abs(psic.h - a['h'][j]).max()
+            for key in psic.pangles.keys():
+                diff = max(diff,abs(psic.pangles[key] - a[key][j]))
+            if diff > 1.e-8:
+                print "set_angles and scan_arrays differ at %i: %g" % (j,diff)
+    t_set = time.time() - t
+    clear_G_cache()
+    t = time.time()
+    for j in range(nspec):
+        gonio = psic_from_spec(G)
+    t_spec = time.time() - t
+    print "%i set_angles calls: %.3f sec" % (npts,t_set)
+    print "%i psic_from_spec calls: %.3f sec" % (nspec,t_spec)
+    return (t_set,t_spec)
+
 ##########################################################################
 if __name__ == "__main__":
     """
@@ -1156,5 +1519,6 @@ if __name__ == "__main__":
     """
     psic = test1()
     psic = test2()
+    _bench_set_angles()
     
 
@@ -29,20 +29,30 @@ def linear_background(data,nbgr=0):
       background line. If your data has uneven spacing then you
       should use a spline to regrid it before calling this routine
     * ngr is the number of end points to use in the fit.
+      If data is 2D a line is fit to each row
 
     Example:
     --------
     >>bgr = linear_background(data,nbgr=3)
     
     """
-    ndat = len(data)
+    ndat = num.shape(data)[-1]
     if nbgr <= 0:
-        return num.zeros(ndat)
+        return num.zeros(num.shape(data))
     if ndat < 2*nbgr + 1:
-        return num.zeros(ndat)
+        return num.zeros(num.shape(data))
     # calc linear bgr from end points
     xlin = num.arange(0,nbgr,1,dtype=float)
     xlin = num.append(xlin,num.arange(ndat-nbgr,ndat,1))
+    if num.ndim(data) > 1:
+        # least squares line for every row at once
+        ylin = num.concatenate((data[...,0:nbgr],data[...,ndat-nbgr:]),axis=-1)
+        ylin = num.array(ylin,dtype=float)
+        xm = xlin.mean()
+        dx = xlin - xm
+        m  = num.dot(ylin,dx)/num.dot(dx,dx)
+        b  = ylin.mean(axis=-1) - m*xm
+        return m[...,num.newaxis]*num.arange(ndat) + b[...,num.newaxis]
     ylin = num.array(data[0:nbgr],dtype=float)
     ylin = num.append(ylin,data[ndat-nbgr:])
     m, b, rval, pval, stderr = linregress(xlin, ylin)
@@ -50,7 +60,7 @@ def linear_background(data,nbgr=0):
 
 #######################################################################
 def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
-               compress=1,debug=False):
+               compress=1,debug=False,vectorize=False,axis=-1):
     """
     Calculate the background under a curve.
 
@@ -60,7 +70,9 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
       We assume that the data is on an
       evenly spaced grid so no abscica is used in calculating the
       background line. If your data has uneven spacing then you
-      should use a spline to regrid it before calling this routine
+      should use a spline to regrid it before calling this routine.
+      If data is 2D a background is computed for every line along
+      the axis given by 'axis' (see below)
 
     * nbgr is the number of end points to use for calculation of a linear
       background.  This part of the background is removed from the data
@@ -88,7 +100,16 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
       speed up the fitting and smooth the background
       
     * debug is a flag (True/False) to indicate if additional debug arrays
-      should be calculated
+      should be calculated (1D data only, uses the point by point loop)
+
+    * vectorize is a flag (True/False) to indicate if the polynomial
+      contact should be computed for all points at once (see
+      poly_contact) rather than with the point by point loop.  The
+      results are the same.  2D data is always vectorized.
+
+    * axis is the axis of 2D data along which the background lines run,
+      ie axis=-1 (or 1) computes the background of each row and axis=0
+      the background of each column.
     
     Notes:
     ------
@@ -112,12 +133,19 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
         print "Warning power is less than 0, changing it to positive"
         pow = -1.*pow
     if debug:
+        if num.ndim(data) > 1:
+            raise ValueError("Debug arrays are only available for 1D data")
         p = []
         d = []
+        vectorize = False
+    if num.ndim(data) > 1:
+        vectorize = True
+        data = num.swapaxes(data,axis,-1)
     
     # linear bgr subtract data
     linbgr = linear_background(data,nbgr=nbgr)
-    if width <= 0. or pow == 0.: return linbgr
+    if width <= 0. or pow == 0.:
+        return num.swapaxes(linbgr,axis,-1) if linbgr.ndim > 1 else linbgr
     y = data - linbgr
 
     # Compression
@@ -133,8 +161,8 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
         if width == 0: width = 1 
 
     # create bgr array
-    ndat = len(y)
-    bgr  = num.zeros(ndat)
+    ndat = y.shape[-1]
+    bgr  = num.zeros(y.shape)
     
     # calc polynomial (old)
     """
@@ -185,48 +213,51 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
     r     = 2*float(width)
     poly  = -1.*(pdelx/r)**(2.*pow)
     # renorm poly 
-    pnorm = (data[0:3].sum() + data[-3:].sum())/6.
-    poly  = poly*pnorm
+    pnorm = (data[...,0:3].sum(axis=-1) + data[...,-3:].sum(axis=-1))/6.
+    poly  = poly*num.asarray(pnorm)[...,num.newaxis]
     ## end edits
     
     # loop through each point
     # NOTE this loop is the bottleneck
     # in the background calculations!
-    # We should speed up this loop.  
+    # Use vectorize to compute all points at once
     #delta = num.zeros(len(poly))
     n = (npoly-1)/2
-    for j in range(ndat):
-        # data and polynomial indicies
-        dlidx = max(0,j-n)
-        dridx = min(ndat,j+n+1)
-        plidx = max(0,n-j)
-        pridx = min(npoly,ndat-j+n)
-        delta  = y[dlidx:dridx] - (y[j] + poly[plidx:pridx])
-        if tangent:
-            # calc avg val to l and r of center
-            # and use to calc avg slope
-            nl    = len(y[dlidx:j])
-            if nl == 0:
-                lyave = 0.0
-                lxave = 0.0
-            else:
-                lyave = num.sum(y[dlidx:j])/nl
-                lxave = num.sum(num.arange(dlidx,j))
-            nr    = len(y[j+1:dridx])
-            if nr == 0:
-                ryave = 0.0
-                rxave = 0.0
-            else:
-                ryave = num.sum(y[j+1:dridx])/nr
-                rxave = num.sum(num.arange(j+1,dridx))
-            slope = (ryave - lyave)/ num.abs(rxave - lxave)
-            delta = delta - slope*num.arange(-1*nl,nr+1)
-
-        bgr[j] = min(0, delta.min())
-        # debug arrays
-        if debug:
-            p.append((y[j] + poly[plidx:pridx] + line))
-            d.append(delta)
+    if vectorize:
+        bgr = poly_contact(y,poly,tangent=tangent)
+    else:
+        for j in range(ndat):
+            # data and polynomial indicies
+            dlidx = max(0,j-n)
+            dridx = min(ndat,j+n+1)
+            plidx = max(0,n-j)
+            pridx = min(npoly,ndat-j+n)
+            delta  = y[dlidx:dridx] - (y[j] + poly[plidx:pridx])
+            if tangent:
+                # calc avg val to l and r of center
+                # and use to calc avg slope
+                nl    = len(y[dlidx:j])
+                if nl == 0:
+                    lyave = 0.0
+                    lxave = 0.0
+                else:
+                    lyave = num.sum(y[dlidx:j])/nl
+                    lxave = num.sum(num.arange(dlidx,j))
+                nr    = len(y[j+1:dridx])
+                if nr == 0:
+                    ryave = 0.0
+                    rxave = 0.0
+                else:
+                    ryave = num.sum(y[j+1:dridx])/nr
+                    rxave = num.sum(num.arange(j+1,dridx))
+                slope = (ryave - lyave)/ num.abs(rxave - lxave)
+                delta = delta - slope*num.arange(-1*nl,nr+1)
+
+            bgr[j] = min(0, delta.min())
+            # debug arrays
+            if debug:
+                p.append((y[j] + poly[plidx:pridx] + line))
+                d.append(delta)
 
     # do another linbgr to get residual
     # note this seem important since the polynomials
@@ -240,17 +271,96 @@ def background(data,nbgr=0,width=0,pow=0.5,tangent=False,
     if compress > 1:
         bgr = expand_array(bgr,compress)
         if rem > 0:
-            temp = bgr[-1]*num.ones(rem,dtype=bgr.dtype)
-            bgr = num.append(bgr,temp)
+            temp = num.repeat(bgr[...,-1:],rem,axis=-1)
+            bgr = num.concatenate((bgr,temp),axis=-1)
 
     # Add back the original linear background / slope
     bgr = bgr + linbgr
+    if bgr.ndim > 1:
+        bgr = num.swapaxes(bgr,axis,-1)
     
     if debug:
         return (bgr,p,d,linbgr)
     else:
         return bgr
 
+############################################################################
+def poly_contact(y,poly,tangent=False):
+    """
+    Compute the polynomial contact for every point of y at once.
+
+    Parameters:
+    -----------
+    * y is the data, either 1D or 2D.  If 2D each row is treated
+      as a separate line
+    * poly is the (odd length) polynomial. If 2D it should have
+      one row per row of y
+    * tangent is a flag (True/False) to indicate if the average local
+      slope of the data is added to the polynomial (see background)
+
+    Returns:
+    --------
+    * array (same shape as y) of min(0, min(delta)) where delta is the
+      difference between the data and the polynomial centered on each
+      point, ie the (negative) contact value found by the loop in
+      background.
+
+    Notes:
+    ------
+    Rather than sliding the polynomial along the data, we loop over
+    the (short) polynomial and keep a running minimum of
+        delta[j] = y[j+k] - (y[j] + poly[k])
+    for all j at once.  The data are padded with inf so polynomial
+    points that fall off the ends of the data never make contact.
+    """
+    y    = num.asarray(y,dtype=float)
+    poly = num.asarray(poly,dtype=float)
+    ndat  = y.shape[-1]
+    npoly = poly.shape[-1]
+    n     = (npoly-1)/2
+    pad   = num.empty(y.shape[:-1]+(n,))
+    pad.fill(num.inf)
+    ypad  = num.concatenate((pad,y,pad),axis=-1)
+    if tangent:
+        slope = _local_slope(y,n)
+    dmin  = num.empty(y.shape)
+    dmin.fill(num.inf)
+    delta = num.empty(y.shape)
+    with num.errstate(invalid='ignore'):
+        for k in range(npoly):
+            num.add(y,poly[...,k:k+1],delta)
+            num.subtract(ypad[...,k:k+ndat],delta,delta)
+            if tangent:
+                delta = delta - slope*(k-n)
+            num.minimum(dmin,delta,dmin)
+        # note nan's (eg zero divide in the slope) give zero
+        # contact, as min(0,nan) does in the loop
+        dmin = num.where(dmin < 0, dmin, 0.)
+    return dmin
+
+def _local_slope(y,n):
+    """
+    Compute the average local slope used by the tangent option
+    of background for every point of y (1D or 2D rows), where n
+    is the polynomial half width
+    """
+    ndat  = y.shape[-1]
+    j     = num.arange(ndat)
+    lidx  = num.maximum(0,j-n)
+    ridx  = num.minimum(ndat,j+n+1)
+    nl    = j - lidx
+    nr    = ridx - j - 1
+    csum  = num.zeros(y.shape[:-1]+(ndat+1,))
+    csum[...,1:] = num.cumsum(y,axis=-1)
+    lyave = (csum[...,j] - csum[...,lidx])/num.maximum(nl,1)
+    ryave = (csum[...,ridx] - csum[...,j+1])/num.maximum(nr,1)
+    # sums of the point indicies to the l and r of center
+    lxave = ((lidx + j - 1)*nl/2).astype(float)
+    rxave = ((j + ridx)*nr/2).astype(float)
+    with num.errstate(divide='ignore',invalid='ignore'):
+        slope = (ryave - lyave)/num.abs(rxave - lxave)
+    return slope
+
 ############################################################################
 def show_bgr(data,nbgr=0,width=0,pow=0.5,tangent=False,compress=1):
     """
@@ -347,12 +457,18 @@ def compress_array(array, compress):
     points in the array will be compressed.  We simply resize the
     input array by chopping off the end so that its length becomes
     integer divisible by the compress factor.
+    If array is 2D each row is compressed.
     """
     compress = int(compress)
-    alen = len(array)
-    nlen = int(len(array)/compress)
+    alen = num.shape(array)[-1]
+    nlen = int(alen/compress)
     rem  = alen % compress
 
+    if num.ndim(array) > 1:
+        temp = array[...,0:nlen*compress]
+        temp = temp.reshape(array.shape[:-1] + (nlen, compress))
+        newarray = num.sum(temp, -1)/compress
+        return (newarray,rem)
     temp = num.resize(array, (nlen, compress))
     newarray = num.sum(temp, 1)/compress
     #ra = array[alen-rem:]
@@ -371,11 +487,23 @@ def expand_array(array, expand, sample=0, rem=0):
       created with sampling (ie no interpolation), if 0 then the new
       array is created via interpolation (default)
     * rem is not used... 
+
+    If array is 2D each row is expanded.
     """
 
-    alen = len(array)
+    alen = num.shape(array)[-1]
     if (expand == 1): return array
-    if (sample == 1): return num.repeat(array, expand)
+    if (sample == 1): return num.repeat(array, expand, axis=-1)
+    if num.ndim(array) > 1:
+        # moving average of the repeated rows
+        rep  = num.repeat(array, expand, axis=-1)
+        temp = num.zeros(rep.shape)
+        for j in range(expand):
+            temp[...,0:rep.shape[-1]-j] += rep[...,j:]/float(expand)
+        temp[...,rep.shape[-1]-expand+1:] = array[...,-1:]
+        if temp.dtype != array.dtype:
+            temp = num.array(temp,dtype=array.dtype)
+        return temp
 
     kernel = num.ones(expand)/float(expand)
     temp = num.convolve(num.repeat(array, expand), kernel, mode=2)
@@ -401,5 +529,21 @@ if __name__ == '__main__':
     r  = 2 * num.random.normal(size=npts)
     y  = r + x/25 + g1 + g2
 
+    # check the vectorized engine against the loop
+    for tangent in (False,True):
+        t0 = time.time()
+        bgr1 = background(y,nbgr=3,width=100,pow=1,tangent=tangent)
+        t1 = time.time()
+        bgr2 = background(y,nbgr=3,width=100,pow=1,tangent=tangent,
+                          vectorize=True)
+        t2 = time.time()
+        print 'tangent=%s: max diff = %g, loop = %.5f sec, vectorized = %.5f sec' % \
+              (tangent, num.abs(bgr1-bgr2).max(), t1-t0, t2-t1)
+    # and the 2D engine against the loop over rows
+    img  = num.array([r + y for r in 2*num.random.normal(size=(50,npts))])
+    bgr1 = num.array([background(line,nbgr=3,width=100,pow=1) for line in img])
+    bgr2 = background(img,nbgr=3,width=100,pow=1,axis=-1)
+    print '2D: max diff = %g' % num.abs(bgr1-bgr2).max()
+
     show_bgr(y, nbgr=3, width=100, pow=1, tangent=False, compress=1)
     
@@ -72,11 +72,11 @@ def spec_scan(spec,sc_num,geo='PSIC_APS_S13'):
     positioners = copy.copy(d['P'])
     for key in d['data'].keys():
         if key in positioners.keys():
-            positioners[key] = num.array(d['data'][key])
+            positioners[key] = num.asarray(d['data'][key])
         elif key in POSITIONER_KEYS:
-            positioners[key] = num.array(d['data'][key])
+            positioners[key] = num.asarray(d['data'][key])
         else:
-            scalers[key] = num.array(d['data'][key])
+            scalers[key] = num.asarray(d['data'][key])
     name  = d['file'] + ' Scan ' + str(int(sc_num))
     dims  = d['nrow']
     paxis = d['labels'][0]
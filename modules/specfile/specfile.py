@@ -77,26 +77,52 @@ psic geometry
 import numpy as num
 import os
 import types
+import zlib
+
+# version of the scan index written to the sidecar file
+INDEX_VERSION = 2
+# number of bytes at the end of the indexed part of the
+# file used for the checksum
+INDEX_TAIL = 4096
+# the index is stored by column, integer and string
+# (or None) entries of the scan summary
+INDEX_INTS = ('index','nl_start','ncols','lineno','offset',
+              'data_offset','nl_dat','aborted')
+INDEX_STRS = ('cmd','date','time','G','Q','mot_names','P',
+              'labels','atten','energy')
 
 #######################################################################
 class SpecFile:
     """
     A spec file
     """
-    def __init__(self, fname):
+    def __init__(self, fname, cache=True, cache_dir=None):
         """
         Initialize
 
         Parameters:
         -----------
         * fname is the specfile name (including full path)
+        * cache is a flag to keep the scan index in a sidecar
+          file so the spec file does not need to be re-indexed
+          the next time it is opened
+        * cache_dir is the directory for the sidecar file.  If
+          None the index is written next to the spec file
+          (as .fname.idx).  The index is a numpy .npz file of
+          plain arrays, it is never unpickled.
         """
         self.path, self.fname = os.path.split(fname)
         self.max_scan = 0
         self.min_scan = 0
+        self.cache     = cache
+        self.cache_dir = cache_dir
         self._mtime    = 0
-        self._lines    = []
+        self._size     = 0
         self._summary  = []
+        self._cols     = None
+        self._index    = {}
+        self._state    = None
+        self._nsaved   = 0
         self._ok       = False
         self.read()
 
@@ -107,41 +133,217 @@ class SpecFile:
         lout = "%s\nPath: %s" % (lout, os.path.join(self.path))
         lout = "%s\nFirst scan number: %i" % (lout,self.min_scan)
         lout = "%s\nLast scan number:  %i" % (lout,self.max_scan)
-        lout = "%s\nLast scan: %s" % (lout, self._summary[self.max_scan-1]['date'])
+        lout = "%s\nLast scan: %s" % (lout, self._entry(self.max_scan-1)['date'])
         return lout
 
     def read(self):
         """
         Read the specfile
 
-        This will re-read the file if its time stamp
-        has changed since the last read
+        This will re-read the file if its time stamp or size
+        has changed since the last read.  If the file has only
+        grown, just the appended part (from the start of the
+        last scan) is parsed.  On the first read the index is
+        loaded from the sidecar file if it is still valid.
         """
         try:
             fname = os.path.join(self.path, self.fname)
-            if os.path.getmtime(fname) != self._mtime:
+            mtime = os.path.getmtime(fname)
+            size  = os.path.getsize(fname)
+            if mtime != self._mtime or size != self._size:
                 #print "Reading spec file %s" % fname
-                #f  = Util.file_open(fname,default_path=self.path)
-                f  = open(fname)
-                self._mtime = os.path.getmtime(fname)
-                self._lines = f.readlines()
+                f  = open(fname,'rb')
+                if self.cache and self._size == 0:
+                    self._load_index(f, size, mtime)
+                if mtime != self._mtime or size != self._size:
+                    if size <= self._size or not self._resume_ok(f):
+                        self._summary = []
+                        self._cols    = None
+                        self._state   = None
+                        self._nsaved  = -1
+                    self._summarize(f)
+                    self._mtime = mtime
+                    self._size  = size
                 f.close()
-                self._summarize()
+                if self.cache and len(self._summary) != self._nsaved:
+                    self._save_index()
                 self._ok = True
         except IOError:
             print  '**Error reading file ', fname
             self._ok = False
 
-    def _summarize(self):
+    def _resume_ok(self, f):
+        """
+        check that the file still has the '#S' line of the last
+        scan at the same offset (ie the file was appended to)
+        """
+        if self._state == None: return False
+        f.seek(self._state['offset'])
+        return f.readline() == self._state['line']
+
+    def _index_file(self):
+        """
+        name of the sidecar file holding the scan index
+        """
+        if self.cache_dir == None:
+            return os.path.join(self.path, '.%s.idx' % self.fname)
+        # tag with the full path so files with the same
+        # name in different directories dont collide
+        fname = os.path.abspath(os.path.join(self.path, self.fname))
+        tag = zlib.crc32(fname) & 0xffffffff
+        return os.path.join(self.cache_dir, '%s_%08x.idx' % (self.fname, tag))
+
+    def _load_index(self, f, size, mtime):
+        """
+        load the scan index from the sidecar file.  The index
+        is used if the part of the spec file it covers has the
+        same checksum and the file is unchanged (same size and
+        time stamp) or appended to (larger and not older).
+
+        The summary entries are only made when a scan is
+        accessed (see _entry), until then they are None and
+        the values are kept by column in self._cols.
+        """
+        try:
+            idx = num.load(self._index_file(), allow_pickle=False)
+            try:
+                if int(idx['version'][0]) != INDEX_VERSION: return
+                isize  = int(idx['size'][0])
+                imtime = float(idx['mtime'][0])
+                if isize > size or imtime > mtime: return
+                if isize == size and imtime != mtime: return
+                if tuple(idx['tail'].tolist()) != _tail_sum(f, isize): return
+                cols = {}
+                for k in INDEX_INTS:
+                    cols[k] = idx['i_' + k].tolist()
+                for k in INDEX_STRS:
+                    cols[k] = idx['s_' + k].tostring().split('\n')
+                state = _unpack_state(idx['state_ints'], idx['state_strs'],
+                                      idx['state_lens'])
+            finally:
+                idx.close()
+            nscan = len(cols['index'])
+        except Exception:
+            # missing or bad index file
+            return
+        self._cols    = cols
+        self._summary = [None]*nscan
+        self._state   = state
+        self._mtime   = imtime
+        self._size    = isize
+        self._nsaved  = nscan
+        self._update_index()
+
+    def _entry(self, j):
+        """
+        get the j'th summary entry
+        """
+        s = self._summary[j]
+        if s == None:
+            s = {}
+            for k in INDEX_INTS:
+                s[k] = self._cols[k][j]
+            for k in INDEX_STRS:
+                s[k] = self._cols[k][j]
+                if s[k] == '\0': s[k] = None
+            s['aborted'] = bool(s['aborted'])
+            self._summary[j] = s
+        return s
+
+    def _save_index(self):
+        """
+        write the scan index to the sidecar file.  This is
+        skipped if the file cant be written (eg read only
+        data directories)
+        """
+        nscan = len(self._summary)
+        if self._cols != None:
+            ncol = min(nscan, len(self._cols['index']))
+        else:
+            ncol = 0
+        cols = {}
+        for k in INDEX_INTS + INDEX_STRS:
+            if ncol > 0:
+                cols[k] = self._cols[k][:ncol]
+            else:
+                cols[k] = []
+        for j in range(nscan):
+            s = self._summary[j]
+            if s == None: continue
+            for k in INDEX_INTS:
+                if j < ncol: cols[k][j] = s[k]
+                else: cols[k].append(s[k])
+            for k in INDEX_STRS:
+                v = s[k]
+                if v == None: v = '\0'
+                if j < ncol: cols[k][j] = v
+                else: cols[k].append(v)
+        idx = {'version':num.array([INDEX_VERSION], dtype=num.int64),
+               'size':num.array([self._size], dtype=num.int64),
+               'mtime':num.array([self._mtime], dtype=float)}
+        for k in INDEX_INTS:
+            idx['i_' + k] = num.array(cols[k], dtype=num.int64)
+        for k in INDEX_STRS:
+            idx['s_' + k] = _str_array('\n'.join(cols[k]))
+        (idx['state_ints'], idx['state_strs'],
+         idx['state_lens']) = _pack_state(self._state)
+        fname = self._index_file()
+        tmp   = '%s.%i.tmp' % (fname, os.getpid())
+        try:
+            f = open(os.path.join(self.path, self.fname),'rb')
+            idx['tail'] = num.array(_tail_sum(f, self._size), dtype=num.int64)
+            f.close()
+            fh = open(tmp,'wb')
+            num.savez(fh, **idx)
+            fh.close()
+            if os.name == 'nt' and os.path.exists(fname):
+                os.remove(fname)
+            os.rename(tmp, fname)
+            self._nsaved = nscan
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def _summarize(self, f):
         """
         summarize
+
+        The summary holds one entry per scan with the header
+        info and the byte offsets of the '#S' line ('offset')
+        and of the first line after '#L' ('data_offset').
+        Parsing starts from the '#S' line of the last scan
+        found on the previous pass (see self._state), entries
+        for that scan are dropped and re-made since more data
+        may have been appended to it.
         """
-        lineno = 0
-        (mnames,cmnd,date,xtime,Gvals,q,Pvals,atten,energy,lab) = (None,None,None,None,None,None,None,None,None,None)
-        (index, ncols, n_sline) = (0,0,0)
-        for i in self._lines:
+        if self._state == None:
+            (offset, lineno) = (0, 0)
+            (mnames,cmnd,date,xtime,Gvals,q,Pvals,atten,energy,lab) = (None,None,None,None,None,None,None,None,None,None)
+            (index, ncols, n_sline, s_offset) = (0,0,0,0)
+        else:
+            st = self._state
+            del self._summary[st['nsum']:]
+            (offset, lineno) = (st['offset'], st['lineno'])
+            (mnames,cmnd,date,xtime,Gvals,q,Pvals,atten,energy,lab) = st['vals']
+            (index, ncols, n_sline, s_offset) = st['idx']
+        f.seek(offset)
+        # entries since the last '#S', data lines are counted for these
+        current = []
+        for line in f:
+            pos    = offset
+            offset = offset + len(line)
             lineno = lineno + 1
-            i  = i[:-1]
+            if (line[0:1] != '#'):
+                if current and _is_data(line):
+                    for s in current:
+                        s['nl_dat'] = s['nl_dat'] + 1
+                continue
+            # a header line still being written is left for the next read
+            if (line[-1:] != '\n'): break
+            i = line.rstrip('\r\n')
             # get motor names: they should be at the top of the file
             # but they can be reset anywhere in the file
             if (i[0:2] == '#O'):
@@ -149,10 +351,20 @@ class SpecFile:
                 mnames = mnames + i[3:]
             # get scan number
             elif (i[0:3] == '#S '):
+                # parser state to resume from if the file grows
+                self._state = {'offset':pos,
+                               'line':line,
+                               'lineno':lineno - 1,
+                               'nsum':len(self._summary),
+                               'vals':(mnames,cmnd,date,xtime,Gvals,q,Pvals,atten,energy,lab),
+                               'idx':(index, ncols, n_sline, s_offset)}
+                current = []
                 v     = i[3:].split()
                 index = int(v[0])
                 cmnd  = i[4+len(v[0]):]
                 n_sline= lineno
+                s_offset = pos
+                continue
             elif (i[0:3] == '#D '):
                 date = i[3:]
             elif (i[0:3] == '#T '):
@@ -173,45 +385,55 @@ class SpecFile:
                 energy = i[8:]
             elif (i[0:3] == '#L '):
                 lab = i[3:]
-                ## count how many lines of 'data' we have
-                ## and see if the scan was aborted
-                xx = self._lines[lineno:]
-                nl_dat = 0
-                aborted = False
-                for ii in xx:
-                    if (ii[0:3] == '#S '):
-                        break
-                    elif (ii[0:1] ==  '#'):
-                        if ii.find('aborted') > -1:
-                            aborted = True
-                    elif (len(ii)  > 3):
-                        nl_dat = nl_dat + 1
-                ## append all the info...
-                self._summary.append({'index':index,
-                                     'nl_start':n_sline,
-                                     'cmd':cmnd,
-                                     'date':date,
-                                     'time':xtime,
-                                     'G':Gvals,
-                                     'Q':q,
-                                     'mot_names':mnames,
-                                     'P':Pvals,
-                                     'ncols':ncols,
-                                     'labels':lab,
-                                     'atten':atten,
-                                     'energy':energy,
-                                     'lineno':lineno,
-                                     'nl_dat':nl_dat,
-                                     'aborted':aborted})
+                ## append all the info, the data lines
+                ## are counted as we go
+                s = {'index':index,
+                     'nl_start':n_sline,
+                     'cmd':cmnd,
+                     'date':date,
+                     'time':xtime,
+                     'G':Gvals,
+                     'Q':q,
+                     'mot_names':mnames,
+                     'P':Pvals,
+                     'ncols':ncols,
+                     'labels':lab,
+                     'atten':atten,
+                     'energy':energy,
+                     'lineno':lineno,
+                     'offset':s_offset,
+                     'data_offset':offset,
+                     'nl_dat':0,
+                     'aborted':False}
+                self._summary.append(s)
+                current.append(s)
                 (cmnd,date,xtime,Gvals,q,Pvals,atten,energy,lab) = (None,None,None,None,None,None,None,None,None)
                 (index, ncols, n_sline) = (0,0,0)
+                continue
+            ## see if the scan was aborted
+            if current and i.find('aborted') > -1:
+                for s in current:
+                    s['aborted'] = True
+
+        self._update_index()
 
-        self.min_scan = self._summary[0]['index']
-        self.max_scan = self._summary[0]['index']
-        for i in self._summary:
-            k = i['index']
-            if (k > self.max_scan): self.max_scan = k
-            if (k < self.min_scan): self.min_scan = k
+    def _update_index(self):
+        """
+        map scan numbers to summary entries (the first
+        entry is used for repeated scan numbers)
+        """
+        nscan = len(self._summary)
+        if self._cols != None:
+            nums = self._cols['index'][:nscan]
+        else:
+            nums = []
+        for s in self._summary[len(nums):]:
+            nums.append(s['index'])
+        # reversed so the first entry wins
+        self._index = dict(zip(nums[::-1], range(nscan-1,-1,-1)))
+        if nscan > 0:
+            self.min_scan = min(self._index.keys())
+            self.max_scan = max(self._index.keys())
 
     def scan_min(self):
         """
@@ -243,9 +465,13 @@ class SpecFile:
         if ((i > self.max_scan) or (i < self.min_scan)): j = False
         return j
 
-    #def scan_info(self):
-    #    self.read()
-    #    return self._summary
+    def summary(self):
+        """
+        return a list of the scan info dictionaries
+        (in the order of the scans in the file)
+        """
+        self.read()
+        return [self._entry(j) for j in range(len(self._summary))]
 
     #def get_summary(self,sc_num):
     def scan_info(self,sc_num):
@@ -253,29 +479,39 @@ class SpecFile:
         return the scan info in a dictionary
         """
         self.read()
-        for s in self._summary:
-            if (sc_num == s['index']):
-                return s
-        return None
+        j = self._index.get(sc_num)
+        if j == None: return None
+        return self._entry(j)
     
     def scan_data(self, sc_num):
         """
         return just the column data from the scan 
+
+        The data block is read straight from the scan's
+        offset in the file.  Returns a (nrow x ncol) float
+        array, rows with a different number of values than
+        the first (eg a partly written last row) are skipped
         """
         self.read()
         s = self.scan_info(sc_num)
         if (s == None): return None
-        dat = []
-        nl  = s['lineno']
-        for i in (self._lines[nl:]):
-            if (i[0:3] == '#S '):
-                break
-            elif (i[0:1] ==  '#'):
-                pass
-            elif (len(i)  > 3):
-                q = i.split()
-                dat.append(map(float,q))
-        return dat
+        # the block runs to the next scan in the file
+        j = self._index[sc_num] + 1
+        while j < len(self._summary) and \
+              self._entry(j)['offset'] == s['offset']:
+            j = j + 1
+        f = open(os.path.join(self.path, self.fname),'rb')
+        f.seek(s['data_offset'])
+        if j < len(self._summary):
+            txt = f.read(self._entry(j)['offset'] - s['data_offset'])
+        else:
+            txt = f.read()
+        f.close()
+        if txt[0:3] == '#S ':
+            txt = ''
+        k = txt.find('\n#S ')
+        if k > -1: txt = txt[:k+1]
+        return _parse_data(txt)
 
     def scan_dict(self, sc_num):
         """
@@ -322,15 +558,15 @@ class SpecFile:
         sc_dict['labels'] = lbls
         ncol = len(lbls)
         nrow = len(dat)
+        if nrow == 0: dat = num.zeros((0,ncol))
         sc_dict['ncol']   = ncol
         sc_dict['nrow']   = nrow
-        # data
+        # data, the columns are views into the data array
         data_dict = {}
-        for j in range(ncol):
-            xx = []
-            for k in range(nrow):
-                xx.append(dat[k][j])
-            data_dict.update({lbls[j]:xx})
+        for j in range(min(ncol,dat.shape[1])):
+            data_dict.update({lbls[j]:dat[:,j]})
+        if dat.shape[1] < ncol:
+            print "Scan %i has fewer data columns than labels" % sc_num
         sc_dict['data'] = data_dict
         # all done
         return sc_dict
@@ -341,7 +577,8 @@ class SpecFile:
         """
         self.read()
         sc_list = [] 
-        for s in self._summary:
+        for j in range(len(self._summary)):
+            s = self._entry(j)
             line = "%s:%4.4i  (%s)\n   %s" % (self.fname,
                                               s['index'],
                                               s['date'],
@@ -350,6 +587,127 @@ class SpecFile:
         return sc_list
 
 
+#######################################################################
+def _tail_sum(f, size):
+    """
+    checksum of the INDEX_TAIL bytes of file f before size
+    """
+    start = max(0, size - INDEX_TAIL)
+    f.seek(start)
+    return (size, zlib.crc32(f.read(size - start)) & 0xffffffff)
+
+def _str_array(txt):
+    """
+    string as a uint8 array (for the index file)
+    """
+    return num.array(bytearray(txt), dtype=num.uint8)
+
+def _pack_state(state):
+    """
+    parser state (see SpecFile._summarize) as int, uint8 and
+    string length arrays, the lengths are -1 for None values
+    """
+    if state == None:
+        return (num.zeros(0, dtype=num.int64), _str_array(''),
+                num.zeros(0, dtype=num.int64))
+    ints = [state['offset'], state['lineno'], state['nsum']] + list(state['idx'])
+    strs = [state['line']] + list(state['vals'])
+    lens = [-1]*len(strs)
+    for j in range(len(strs)):
+        if strs[j] != None: lens[j] = len(strs[j])
+    txt = ''.join([v for v in strs if v != None])
+    return (num.array(ints, dtype=num.int64), _str_array(txt),
+            num.array(lens, dtype=num.int64))
+
+def _unpack_state(ints, txt, lens):
+    """
+    parser state from the arrays made by _pack_state
+    """
+    if len(ints) == 0: return None
+    ints = ints.tolist()
+    txt  = txt.tostring()
+    strs = []
+    pos  = 0
+    for n in lens.tolist():
+        if n < 0:
+            strs.append(None)
+        else:
+            strs.append(txt[pos:pos+n])
+            pos = pos + n
+    return {'offset':ints[0],
+            'lineno':ints[1],
+            'nsum':ints[2],
+            'idx':tuple(ints[3:]),
+            'line':strs[0],
+            'vals':tuple(strs[1:])}
+
+def _is_data(line):
+    """
+    check if a (non-comment) line is a line of data
+    """
+    return len(line.rstrip('\r\n')) > 2
+
+def _parse_data(txt):
+    """
+    parse a block of scan data (the lines following #L)
+    into a (nrow x ncol) array
+    """
+    lines = txt.splitlines()
+    if txt.find('#') > -1:
+        lines = [l for l in lines if l[0:1] != '#' and len(l) > 2]
+    else:
+        lines = [l for l in lines if len(l) > 2]
+    if len(lines) == 0: return num.zeros((0,0))
+    nrow = len(lines)
+    ncol = len(lines[0].split())
+    dat  = num.fromstring(' '.join(lines), dtype=float, sep=' ')
+    if dat.size == nrow*ncol:
+        return dat.reshape(nrow, ncol)
+    # ragged rows or bad values, parse row by row
+    rows = [l.split() for l in lines]
+    rows = [map(float,r) for r in rows if len(r) == ncol]
+    return num.array(rows, dtype=float).reshape(len(rows), ncol)
+
+def _bench_index(nscans=50000, nrow=10):
+    """
+    time opening a large spec file without (cold) and
+    with (warm) the sidecar index, and after an append
+    """
+    import time, tempfile, shutil
+    path = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(path, 'bench.spec')
+        f = open(fname,'w')
+        f.write("#F bench.spec\n#E 1\n#D Mon Jan 1 00:00:00 2024\n")
+        f.write("#O0 TwoTheta theta chi phi\n#O1 Nu Psi\n\n")
+        row = ' '.join(['%g' % x for x in num.arange(8)*1.5]) + '\n'
+        for j in range(1, nscans+1):
+            f.write("#S %i  ascan  theta 0 1 %i 1\n" % (j, nrow-1))
+            f.write("#D Mon Jan 1 00:00:00 2024\n#T 1  (Seconds)\n")
+            f.write("#G0 0 0 1 0 0 1\n#Q 0 0 %g\n" % (j*0.01))
+            f.write("#P0 1 2 3 4\n#P1 5 6\n#N 8\n")
+            f.write("#L theta H K L io i1 Bicron Seconds\n")
+            f.write(row*nrow)
+            f.write("\n")
+        f.close()
+        print 'file size: %.1f MB' % (os.path.getsize(fname)/1.e6)
+        t0 = time.time()
+        s = SpecFile(fname)
+        t1 = time.time()
+        s = SpecFile(fname)
+        t2 = time.time()
+        f = open(fname,'a')
+        f.write("#S %i  ascan  theta 0 1 1 1\n#N 8\n" % (nscans+1))
+        f.write("#L theta H K L io i1 Bicron Seconds\n" + row)
+        f.close()
+        s = SpecFile(fname)
+        t3 = time.time()
+        print 'cold open (%i scans): %.3f sec' % (s.nscans(), t1-t0)
+        print 'warm open: %.3f sec' % (t2-t1)
+        print 'warm open after append: %.3f sec' % (t3-t2)
+    finally:
+        shutil.rmtree(path)
+
 #######################################################################
 #######################################################################
 #######################################################################
@@ -518,3 +876,11 @@ Remember this is specific to psic geometry...
 98. CUT_KAP=-180     # Q[35], Cut point for kap circle
 99. CUT_KPHI=-180    # Q[36], Cut point for kphi circle
 """
+
+#######################################################################
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        _bench_index()
+    elif len(sys.argv) > 1:
+        print SpecFile(sys.argv[1])
@@ -15,6 +15,9 @@ Conventions for Med.get_data and Med.get_energy:
                    bad det's are zeros
  * If Med.align == True the first good detector will be used as the energy reference
  * If Med.correct == True deadtime corrections will be applied on Med.get_data()
+ * Med.get_data caches its result.  The cache is recomputed when the
+   deadtime correction, calibration, bad_mca_idx, total/align/correct
+   flags or the mca data change.
  
 """
 
@@ -23,6 +26,7 @@ Conventions for Med.get_data and Med.get_energy:
 import numpy as num
 import types
 import exceptions
+from collections import OrderedDict
 
 from tdl.modules.spectra import mca
 from tdl.modules.spectra import calibration as calib
@@ -81,6 +85,7 @@ class Med:
         self.name        = name
         self.mca         = mca
         self.n_detectors = len(self.mca)
+        self._data_cache = None   # (key, data) see get_data
 
         # med parameters
         self.bad_mca_idx = []
@@ -91,6 +96,15 @@ class Med:
         # update params
         self.init_params(params=kws)
         self.update_correction(tau=None)
+
+    ########################################################################
+    def __getstate__(self):
+        """
+        dont pickle the cached data
+        """
+        state = self.__dict__.copy()
+        state['_data_cache'] = None
+        return state
         
     ########################################################################
     def re_init(self,n_detectors=1,nchans=2048,**kws):
@@ -220,6 +234,34 @@ class Med:
           [n_detectors, nchans]
             
           If the "total" keyword is set then the array dimensions are [1,nchans]
+
+        Notes:
+        ------
+        The result is cached and only recomputed when the deadtime
+        correction, calibration, bad_mca_idx, flags or the mca data change
+        """
+        key = self._data_key()
+        # meds pickled before the cache was added dont have _data_cache
+        cache = getattr(self,'_data_cache',None)
+        if (cache == None) or (cache[0] != key):
+            self._data_cache = (key, self._calc_data())
+        return self._data_cache[1].copy()
+
+    def _data_key(self,):
+        """
+        Hashable key of all the values the result of get_data depends on
+        """
+        key = [tuple(self.bad_mca_idx), self.total, self.align, self.correct]
+        for mca in self.mca:
+            key.append((mca.cor_factor, mca.total_counts,
+                        mca.offset, mca.slope, mca.quad,
+                        hash(num.asarray(mca.channels).tostring()),
+                        hash(num.asarray(mca.data).tostring())))
+        return tuple(key)
+
+    def _calc_data(self,):
+        """
+        Compute the data array returned by get_data
         """
         # see how many channels, all mcas must be same length!!
         temp = self.mca[0].get_data()
@@ -234,15 +276,17 @@ class Med:
                 data[d,:] = self.mca[d].get_data(correct=self.correct)
 
         # align if requested.
+        # all the good detectors are aligned with one (block diagonal)
+        # sparse matrix multiply, see align_matrix
         if self.align == True and self.n_detectors > 1:
             first_good = self._get_align_idx()
             ref_energy = self.mca[first_good].get_energy()
-            for d in range(self.n_detectors):
-                if d not in self.bad_mca_idx:
-                    energy = self.mca[d].get_energy()
-                    temp   = spline_interpolate(energy, data[d,:], ref_energy)
-                    # note adding .5 rounds the data
-                    data[d,:] = (temp+.5).astype(num.int)
+            good = [d for d in range(self.n_detectors) if d not in self.bad_mca_idx]
+            energy = [self.mca[d].get_energy() for d in good]
+            matrix = align_matrix(energy, ref_energy)
+            temp   = matrix * data[good].ravel().astype(float)
+            # note adding .5 rounds the data
+            data[good] = (temp.reshape((len(good),nchans))+.5).astype(num.int)
 
         # make a total if requested. 
         if self.total == True and self.n_detectors > 1:
@@ -345,6 +389,7 @@ scipy.signal and/or scipy.interpolate
 """
 from scipy.interpolate import splrep, splev
 from scipy.signal import cspline1d, cspline1d_eval
+from scipy import sparse
 
 def spline_interpolate(oldx, oldy, newx, smoothing=0.001, **kw):
     """
@@ -363,4 +408,188 @@ def spline_interpolate_general(oldx, oldy, newx, smoothing=0.001, **kw):
     return splev(newx, rep)
 
 ################################################################################
+# cache of alignment matricies keyed by the energy arrays (see align_matrix).
+# The oldest entries are dropped once the cache holds ALIGN_CACHE_SIZE entries
+ALIGN_CACHE_SIZE = 64
+_ALIGN_CACHE = OrderedDict()
+_PREFILTER   = {}
+
+# the cubic spline prefilter falls off as (sqrt(3)-2)**n,
+# so the matrix entries more than PREFILTER_WIDTH channels
+# from the diagonal are < 1e-18 and are dropped
+PREFILTER_WIDTH = 32
+
+def align_matrix(energy, ref_energy):
+    """
+    Sparse matrix for aligning a set of spectra to a reference energy array.
+
+    Parameters:
+    -----------
+    * energy is a list of (uniform grid) energy arrays, one per spectrum
+    * ref_energy is the energy array to interpolate onto
+
+    Outputs:
+    --------
+    * block diagonal sparse matrix, M * data.ravel() gives the aligned
+      spectra (flattened) for a [len(energy), nchans] data array.  Each
+      block is spline_matrix(energy[j], ref_energy)
+
+    Notes:
+    ------
+    The matrix only depends on the calibrations so it is cached,
+    eg all the med's of a scan share the same matrix.
+    """
+    ref_energy = num.asarray(ref_energy, dtype=float)
+    key = [ref_energy.tostring()]
+    for en in energy:
+        en = num.asarray(en, dtype=float)
+        key.append((len(en), en[0], en[1] - en[0]))
+    key = tuple(key)
+    if key in _ALIGN_CACHE:
+        matrix = _ALIGN_CACHE.pop(key)
+    else:
+        blocks = [spline_matrix(en, ref_energy) for en in energy]
+        matrix = sparse.block_diag(blocks, format='csr')
+        if len(_ALIGN_CACHE) >= ALIGN_CACHE_SIZE:
+            _ALIGN_CACHE.popitem(last=False)
+    _ALIGN_CACHE[key] = matrix
+    return matrix
+
+def clear_align_cache():
+    """
+    Empty the cache of alignment matricies
+    """
+    _ALIGN_CACHE.clear()
+    _PREFILTER.clear()
+
+def spline_matrix(oldx, newx):
+    """
+    Sparse matrix M such that M * oldy = spline_interpolate(oldx, oldy, newx)
+    for float oldy.  ie the cubic spline (mirror-symmetric boundaries) on
+    a uniform grid, written as a linear map from oldy to newy.
+
+    Parameters:
+    -----------
+    * oldx is the (uniform) grid of the data
+    * newx are the points to interpolate to
+
+    Outputs:
+    --------
+    * sparse [len(newx), len(oldx)] matrix
+    """
+    oldx = num.asarray(oldx, dtype=float)
+    n    = len(oldx)
+    u    = (num.asarray(newx, dtype=float) - oldx[0]) / float(oldx[1] - oldx[0])
+    return _spline_eval_matrix(u, n) * _cubic_prefilter(n)
+
+def _cubic_prefilter(n):
+    """
+    Sparse [n,n] matrix of the cubic spline prefilter, C * y = cspline1d(y)
+    for float y (without smoothing).
+
+    The columns are the responses to unit impulses.  Impulses more than
+    2*PREFILTER_WIDTH channels apart don't interact, so they are
+    computed as a comb of impulses in 2*PREFILTER_WIDTH+1 signals.
+    """
+    if n in _PREFILTER:
+        return _PREFILTER[n]
+    zi = -2. + num.sqrt(3.)
+    h  = PREFILTER_WIDTH
+    np = min(n, 2*h + 1)
+    signal = num.zeros((n, np))
+    for p in range(np):
+        signal[p::np, p] = 1.
+    # same recursion as scipy.signal.bsplines._cubic_coeff
+    yplus = num.zeros((n, np))
+    yplus[0] = signal[0] + zi * num.dot(zi**num.arange(n), signal)
+    for k in range(1, n):
+        yplus[k] = signal[k] + zi * yplus[k-1]
+    coeff = num.zeros((n, np))
+    coeff[n-1] = zi / (zi - 1.) * yplus[n-1]
+    for k in range(n-2, -1, -1):
+        coeff[k] = zi * (coeff[k+1] - yplus[k])
+    coeff = coeff * 6.
+    # pick out the response of each impulse
+    cols = num.arange(n)[:,num.newaxis] + num.zeros(2*h + 1, dtype=int)
+    rows = cols + num.arange(-h, h + 1)
+    use  = (rows >= 0) & (rows < n)
+    vals = coeff[rows[use], cols[use] % np]
+    prefilter = sparse.csr_matrix((vals, (rows[use], cols[use])), shape=(n, n))
+    _PREFILTER[n] = prefilter
+    return prefilter
+
+def _spline_eval_matrix(u, n):
+    """
+    Sparse [len(u),n] matrix of the cubic b-spline weights for
+    evaluating a spline with n coefficients at the (grid unit)
+    points u, E * c = cspline1d_eval(c, u)
+    """
+    u = num.array(u, dtype=float)
+    # mirror-symmetric boundaries
+    while True:
+        low  = u < 0
+        high = u > (n - 1)
+        if not (low.any() or high.any()): break
+        u[low]  = -u[low]
+        u[high] = 2 * (n - 1) - u[high]
+    rows   = num.arange(len(u))
+    jlower = num.floor(u - 2).astype(int) + 1
+    r = []
+    c = []
+    v = []
+    for i in range(4):
+        thisj = jlower + i
+        ax = num.abs(u - thisj)
+        w  = num.zeros(len(u))
+        c1 = ax < 1
+        c2 = (c1 == False) & (ax < 2)
+        w[c1] = 2.0/3 - 1.0/2*ax[c1]**2*(2 - ax[c1])
+        w[c2] = 1.0/6*(2 - ax[c2])**3
+        r.append(rows)
+        c.append(thisj.clip(0, n - 1))
+        v.append(w)
+    return sparse.csr_matrix((num.concatenate(v),
+                              (num.concatenate(r), num.concatenate(c))),
+                             shape=(len(u), n))
 
+################################################################################
+def _bench_get_data(ndet=16,nchans=2048,npts=50):
+    """
+    Compare Med.get_data with aligning each detector with
+    spline_interpolate on a simulated scan of npts med's
+    that share the same calibrations
+    """
+    import time
+    chans = num.arange(nchans)
+    en    = 1.0 + 0.01*chans
+    calib_par = [{'offset':0.01*num.random.randn(),
+                  'slope':0.01*(1. + 0.002*num.random.randn())} for d in range(ndet)]
+    meds = []
+    for j in range(npts):
+        mcas = []
+        for d in range(ndet):
+            data = num.random.poisson(50. + 2000.*num.exp(-(en - 6.4)**2/0.01))
+            mcas.append(mca.Mca(data=list(data),real_time=1.,live_time=0.9,
+                                total_counts=float(data.sum()),**calib_par[d]))
+        meds.append(Med(mca=mcas,total=True))
+    t = time.time()
+    old = []
+    for m in meds:
+        ref_energy = m.mca[0].get_energy()
+        tot = num.zeros(nchans, dtype=num.int)
+        for d in range(ndet):
+            y = m.mca[d].get_data(correct=True).astype(float)
+            tot = tot + (spline_interpolate(m.mca[d].get_energy(),y,ref_energy)+.5).astype(num.int)
+        old.append(tot)
+    t_old = time.time() - t
+    t = time.time()
+    new = [m.get_data()[0] for m in meds]
+    t_new = time.time() - t
+    t = time.time()
+    new = [m.get_data()[0] for m in meds]
+    t_cache = time.time() - t
+    print "%i meds, %i detectors, %i channels" % (npts,ndet,nchans)
+    print "   spline_interpolate: %.3f sec" % t_old
+    print "   get_data:           %.3f sec" % t_new
+    print "   get_data (cached):  %.3f sec" % t_cache
+    print "   identical:          %s" % num.all(num.array(old) == num.array(new))
@@ -3,6 +3,12 @@ CTR fitting package
 This package contains modules used for
 analyzing surface diffraction data
 """
-from .pisurf import start
+try:
+    import wx
+except ImportError:
+    # the fitting modules can be used without the GUI
+    wx = None
+if wx != None:
+    from .pisurf import start
 
 
@@ -11,7 +11,7 @@ Frank Heberling (Frank.Heberling@kit.edu)
 import numpy as Num
 from pylab import *
 import random
-import wx
+import os
 
 from tdl.modules.xtal.bv_params import bv_params
 
@@ -233,7 +233,8 @@ class Fitting_Rod:
         self.Ferr = Num.array([],float)
         self.Lb = Num.array([],float)
         self.Db = Num.array([],float)
-        self.q_ang = []
+        self.q = Num.array([],float)
+        self.q_ang = Num.zeros((0,3),float)
         self.fs = {}
 
         self.re_bulk = Num.array([],float)
@@ -246,36 +247,46 @@ class Fitting_Rod:
         self.Fcalc = Num.array([],float)
         self.difference = Num.array([],float)
         #####################################################
+    def hkl(self):
+        hkl = Num.zeros((len(self.L),3),float)
+        hkl[:,0] = self.H
+        hkl[:,1] = self.K
+        hkl[:,2] = self.L
+        return hkl
+
+    def calc_q(self, g_inv):
+        hkl = self.hkl()
+        self.q = Num.sqrt((Num.dot(hkl,g_inv)*hkl).sum(axis=1))
+
     def calcFbulk(self, cell, bulk, g_inv, database):
-        self.re_bulk = Num.ndarray((len(self.L)),float)
-        self.im_bulk = Num.ndarray((len(self.L)),float)
-        for i in range(len(self.L)):
-            hkl = [self.H,self.K,self.L[i]]
-            zeta = self.L[i]+ self.H*cell[6]+ self.K*cell[7]
-            re_ctr = 0.5
-            im_ctr = -1/(2*Num.tan(Num.pi*zeta))
-            re_UC , im_UC = calc_Fuc(hkl,bulk,g_inv,database)
-            self.re_bulk[i] = re_ctr*re_UC - im_ctr*im_UC
-            self.im_bulk[i] = re_UC*im_ctr + re_ctr*im_UC
+        self.calc_q(g_inv)
+        zeta = self.L+ self.H*cell[6]+ self.K*cell[7]
+        re_ctr = 0.5
+        im_ctr = -1/(2*Num.tan(Num.pi*zeta))
+        re_UC , im_UC = calc_Fuc_rod(self.hkl(),self.q,bulk,database)
+        self.re_bulk = re_ctr*re_UC - im_ctr*im_UC
+        self.im_bulk = re_UC*im_ctr + re_ctr*im_UC
             
     def calc_q_ang(self, g_inv):
-        for l in self.L:
-            q = Num.array([self.H * Num.sqrt(g_inv[0][0]), self.K * Num.sqrt(g_inv[1][1]), l* Num.sqrt(g_inv[2][2])], float)
-            self.q_ang.append(q)
+        self.q_ang = Num.column_stack((self.H*Num.sqrt(g_inv[0][0])*Num.ones(len(self.L)),
+                                       self.K*Num.sqrt(g_inv[1][1])*Num.ones(len(self.L)),
+                                       self.L*Num.sqrt(g_inv[2][2])))
 
     def calc_fs(self, DB, g_inv):
+        if len(self.q) != len(self.L): self.calc_q(g_inv)
         for k in DB.keys():
             if k not in self.fs.keys():
-                self.fs[k] = Num.array([],float)
-                for l in self.L:
-                    hkl = [self.H, self.K, l]
-                    q = Num.sqrt(Num.dot(Num.dot(hkl,g_inv),hkl))
-                    f_par = DB[k]
-                    f = (f_par[0]*Num.exp(-(q/4/Num.pi)**2*f_par[1]) + f_par[2]*Num.exp(-(q/4/Num.pi)**2*f_par[3]) +\
-                        f_par[4]*Num.exp(-(q/4/Num.pi)**2*f_par[5]) + f_par[6]*Num.exp(-(q/4/Num.pi)**2*f_par[7]) + f_par[8])
-                    self.fs[k] = Num.append(self.fs[k] , f)            
+                self.fs[k] = form_factor(DB[k],self.q)
                 
 ####################################################################################################    
+def form_factor(f_par, q):
+    """
+    4 gaussian form factor at q (number or array)
+    """
+    s = (q/4/Num.pi)**2
+    return (f_par[0]*Num.exp(-s*f_par[1]) + f_par[2]*Num.exp(-s*f_par[3]) +\
+            f_par[4]*Num.exp(-s*f_par[5]) + f_par[6]*Num.exp(-s*f_par[7]) + f_par[8])
+
 def calc_Fuc(hkl,bulk,g_inv,database):
     a = 0
     b = 0
@@ -289,6 +300,150 @@ def calc_Fuc(hkl,bulk,g_inv,database):
         b = b + (f * Num.sin(2*Num.pi*(hkl[0]*bulk[i][1] + hkl[1]*bulk[i][2] + hkl[2]*bulk[i][3])))
     return a, b
 
+def calc_Fuc_rod(hkl,q,bulk,database):
+    """
+    unit cell F for all points of a rod, hkl is (npts,3)
+    and q the array of |q|
+    """
+    a = Num.zeros(len(q),float)
+    b = Num.zeros(len(q),float)
+    fs = {}
+    for atom in bulk:
+        key = str.lower(atom[0])
+        if key not in fs: fs[key] = form_factor(database[key],q)
+        f = fs[key] * Num.exp(-2 * Num.pi**2 * q**2 * atom[4])
+        x = 2*Num.pi*(hkl[:,0]*atom[1] + hkl[:,1]*atom[2] + hkl[:,2]*atom[3])
+        a = a + f * Num.cos(x)
+        b = b + f * Num.sin(x)
+    return a, b
+
+def precompute_rods(dat, cell, bulk, g_inv, database, runningDB,
+                    datafile='', bulkfile='', cache=False):
+    """
+    Compute q, q_ang, the form factors of the species in runningDB
+    and the bulk F for all rods.  None of these depend on the fit
+    parameters, so if cache is True they are kept in a cache file
+    next to the data file (.datafile.rods, a numpy .npz file) for
+    the given data file, bulk file and cell, and only missing form
+    factors are computed on the next load.
+    """
+    key = None
+    if cache:
+        key = _rod_cache_key(datafile, bulkfile, cell)
+    cachefile = ''
+    cached = None
+    if key != None:
+        (path, fname) = os.path.split(datafile)
+        cachefile = os.path.join(path, '.%s.rods' % fname)
+        cached = _load_rod_cache(cachefile, key, dat)
+    changed = False
+    for j in range(len(dat)):
+        rod = dat[j]
+        if cached != None:
+            c = cached[j]
+            rod.q = c['q']
+            rod.q_ang = c['q_ang']
+            rod.re_bulk = c['re_bulk']
+            rod.im_bulk = c['im_bulk']
+            rod.fs = dict(c['fs'])
+        else:
+            rod.calc_q(g_inv)
+            rod.calc_q_ang(g_inv)
+            rod.calcFbulk(cell, bulk, g_inv, database)
+            rod.fs = {}
+            changed = True
+        for k in runningDB.keys():
+            if k not in rod.fs:
+                rod.fs[k] = form_factor(runningDB[k],rod.q)
+                changed = True
+    if changed and cachefile != '':
+        _save_rod_cache(cachefile, key, dat)
+    return dat
+
+def _rod_cache_key(datafile, bulkfile, cell):
+    """
+    key for the rod cache (None if the files are not known):
+    the cell and the path, size and mtime of the files
+    """
+    key = {'cell':Num.array(cell, float),
+           'paths':[], 'sizes':[], 'mtimes':[]}
+    for fname in (datafile, bulkfile):
+        if fname == '' or not os.path.isfile(fname): return None
+        key['paths'].append(os.path.abspath(fname))
+        key['sizes'].append(os.path.getsize(fname))
+        key['mtimes'].append(os.path.getmtime(fname))
+    key['paths']  = _str_array('\n'.join(key['paths']))
+    key['sizes']  = Num.array(key['sizes'], Num.int64)
+    key['mtimes'] = Num.array(key['mtimes'], float)
+    return key
+
+def _str_array(txt):
+    """
+    string as a uint8 array (for the rod cache file)
+    """
+    return Num.array(bytearray(txt), dtype=Num.uint8)
+
+def _save_rod_cache(cachefile, key, dat):
+    """
+    write the key and the rod values to the cache file, only plain
+    arrays are written (num.savez) so loading it runs no code
+    """
+    arrs = {}
+    for k in key.keys():
+        arrs['key_' + k] = key[k]
+    arrs['H'] = Num.array([rod.H for rod in dat], float)
+    arrs['K'] = Num.array([rod.K for rod in dat], float)
+    for j in range(len(dat)):
+        rod = dat[j]
+        keys = sorted(rod.fs.keys())
+        arrs['L_%i' % j] = Num.asarray(rod.L, float)
+        arrs['q_%i' % j] = rod.q
+        arrs['q_ang_%i' % j] = rod.q_ang
+        arrs['re_bulk_%i' % j] = rod.re_bulk
+        arrs['im_bulk_%i' % j] = rod.im_bulk
+        arrs['fs_keys_%i' % j] = _str_array('\n'.join(keys))
+        arrs['fs_%i' % j] = Num.array([rod.fs[k] for k in keys], float)
+    try:
+        f = open(cachefile, 'wb')
+        try:
+            Num.savez(f, **arrs)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        print 'Could not write rod cache file ' + cachefile
+
+def _load_rod_cache(cachefile, key, dat):
+    """
+    get the list of cached rod values if they are valid for
+    key and the rods in dat, otherwise None
+    """
+    try:
+        cache = Num.load(cachefile, allow_pickle=False)
+        try:
+            for k in key.keys():
+                if not Num.array_equal(cache['key_' + k], key[k]): return None
+            if len(cache['H']) != len(dat): return None
+            rods = []
+            for j in range(len(dat)):
+                if cache['H'][j] != dat[j].H or cache['K'][j] != dat[j].K: return None
+                if not Num.array_equal(cache['L_%i' % j], dat[j].L): return None
+                keys = cache['fs_keys_%i' % j].tostring()
+                if keys == '':
+                    keys = []
+                else:
+                    keys = keys.split('\n')
+                fs = cache['fs_%i' % j]
+                rods.append({'q':cache['q_%i' % j],
+                             'q_ang':cache['q_ang_%i' % j],
+                             're_bulk':cache['re_bulk_%i' % j],
+                             'im_bulk':cache['im_bulk_%i' % j],
+                             'fs':dict(zip(keys, fs))})
+        finally:
+            cache.close()
+    except Exception:
+        return None
+    return rods
+
 def Fatom(atom,fs,U,pi,q_Ang,hkl,low,exp,dot,sinus,cosinus,sqrt):
     f = fs[low(atom[0])]
     U[0][0] = atom[4]
@@ -310,6 +465,58 @@ def calc_Fsurf(hkl,surface,exp,low,dot,pi,cosinus,sinus,sqrt,U, fs, q_Ang):
         b = b+job[1]
     return a,b
 
+def surface_arrays(surface):
+    """
+    Array form of the surface model for calc_Fsurf_rod
+
+    Returns (species, index, xyz, Uq, occ):
+    * species is a list of the (lower case) atom labels
+    * index gives the species index of each atom
+    * xyz is the (natoms,3) array of fractional coordinates
+    * Uq is the (6,natoms) array [U11,U22,U33,2U12,2U13,2U23]
+      so q.U.q = dot(qq,Uq) with qq = [q0**2,q1**2,q2**2,q0*q1,q0*q2,q1*q2]
+    * occ is the array of occupancies
+    """
+    n = len(surface)
+    species = []
+    index = Num.zeros(n,int)
+    for i in range(n):
+        label = str.lower(surface[i][0])
+        if label not in species: species.append(label)
+        index[i] = species.index(label)
+    xyz = Num.array([atom[1:4] for atom in surface],float).reshape(n,3)
+    u = Num.array([atom[4:11] for atom in surface],float).reshape(n,7)
+    Uq = Num.array([u[:,0], u[:,1], u[:,2],
+                    2*u[:,3]*Num.sqrt(u[:,0]*u[:,1]),
+                    2*u[:,4]*Num.sqrt(u[:,0]*u[:,2]),
+                    2*u[:,5]*Num.sqrt(u[:,1]*u[:,2])]).reshape(6,n)
+    return species, index, xyz, Uq, u[:,6]
+
+def calc_Fsurf_rod(hkl, surf, fs, q_Ang):
+    """
+    Surface structure factor for all points of a rod
+
+    Parameters:
+    -----------
+    * hkl is the (npts,3) array of hkl values
+    * surf is the surface model from surface_arrays
+    * fs is the (nspecies,npts) array of form factors for
+      the species in surf
+    * q_Ang is the (npts,3) array of q components
+
+    Returns the real and imaginary parts (arrays of npts)
+    """
+    species, index, xyz, Uq, occ = surf
+    if len(occ) == 0:
+        return Num.zeros(len(hkl)), Num.zeros(len(hkl))
+    q0 = q_Ang[:,0]
+    q1 = q_Ang[:,1]
+    q2 = q_Ang[:,2]
+    qq = Num.array([q0**2, q1**2, q2**2, q0*q1, q0*q2, q1*q2]).T
+    f = fs[index].T * Num.exp(-2*Num.pi**2*Num.dot(qq,Uq)) * occ
+    x = 2*Num.pi*Num.dot(hkl,xyz.T)
+    return (f*Num.cos(x)).sum(axis=1), (f*Num.sin(x)).sum(axis=1)
+
 def calc_Fwater_layered(hkl, sig, sig_bar, d,zwater, Auc, f, q):
     f = Auc * d * 0.033456 * f* Num.exp(-2 * Num.pi**2 * q**2 * sig)
     x = Num.pi * q * d
@@ -347,60 +554,53 @@ def calc_F_layered_el(hkl, occ, K, sig, sig_bar, d, d0, f, q):
     return re, im
         
 def calcF(ctr,global_parms,Auc,surface,NLayers,use_bulk_water, RMS_flag, use_lay_el, el):
+    """
+    calculate F for all points of a rod, surface is the
+    surface model (list of atoms or from surface_arrays)
+    """
     (occ_el, K,sig_el,sig_el_bar,d_el,d0_el,sig_water,sig_water_bar, d_water,zwater, Scale,specScale,beta) = global_parms
-    ctr.bulk = Num.ndarray((len(ctr.L)),float)
-    ctr.Fcalc = Num.ndarray((len(ctr.L)),float)
-    ctr.water = Num.ndarray((len(ctr.L)),float)
-    ctr.rough = Num.ndarray((len(ctr.L)),float)
-    ctr.surf = Num.ndarray((len(ctr.L)),float)
-    exp = Num.exp
-    low = str.lower
-    dot = Num.dot
-    pi = Num.pi
-    cosinus = Num.cos
-    sinus = Num.sin
-    sqrt = Num.sqrt
-    U = Num.ndarray((3,3),float)
-    for i in range(len(ctr.L)):
-        fs = {}
-        for k in ctr.fs.keys():
-            fs[k] = float(ctr.fs[k][i])
-        q_ang = ctr.q_ang[i]
-        hkl = [ctr.H,ctr.K,ctr.L[i]]
-        re_surf, im_surf = calc_Fsurf(hkl,surface,exp,low,dot,pi,cosinus,sinus,sqrt,U, fs, q_ang)
-            
-        #if ctr.L[i] > 0:
-        #    n = ctr.Lb[i] + round(ctr.L[i]/ctr.Db) * ctr.Db
-        #else:
-        #    n = - ctr.Lb[i] + round(ctr.L[i]/ctr.Db) * ctr.Db
-        #rough = (1-beta)/sqrt((1-beta)**2 + 4*beta*sinus(pi*(ctr.L[i] - n)/NLayers)**2)
-        rough = (1-beta)/sqrt((1-beta)**2 + 4*beta*sinus(pi*(ctr.L[i]-ctr.Lb[i])/ctr.Db[i])**2)
-           
-        if hkl[0] == 0.0 and hkl[1] == 0.0:
-            if not use_bulk_water:
-                re_water = 0
-                im_water = 0
-                ctr.water[i] = 0
-            else:
-                re_water, im_water = calc_Fwater_layered(hkl,sig_water,sig_water_bar,d_water,zwater,Auc, fs['o2-.'], q_ang[2])
-                ctr.water[i] = specScale * sqrt((re_water)**2 + (im_water)**2)
-            if not use_lay_el:
-                re_el = 0
-                im_el = 0
-            else:
-                re_el, im_el = calc_F_layered_el(hkl,occ_el,K, sig_el, sig_el_bar, d_el, d0_el, fs[el], q_ang[2]) 
-                    
-            ctr.bulk[i] = specScale * sqrt(ctr.re_bulk[i]**2 + ctr.im_bulk[i]**2)
-            ctr.Fcalc[i] = specScale * rough * sqrt((ctr.re_bulk[i] + re_surf + re_water+ re_el)**2 + (ctr.im_bulk[i] + im_surf + im_water+ im_el)**2)
-              
-            ctr.rough[i] = rough * specScale
-            ctr.surf[i] = sqrt(re_surf**2 + im_surf**2) * specScale
+    if type(surface) != tuple:
+        surface = surface_arrays(surface)
+    n = len(ctr.L)
+    L = Num.asarray(ctr.L,float)
+    hkl = Num.zeros((n,3),float)
+    hkl[:,0] = ctr.H
+    hkl[:,1] = ctr.K
+    hkl[:,2] = L
+    q_ang = Num.array(ctr.q_ang[:n],float).reshape(n,3)
+    fs = Num.array([ctr.fs[k] for k in surface[0]],float).reshape(len(surface[0]),n)
+    re_surf, im_surf = calc_Fsurf_rod(hkl,surface,fs,q_ang)
+
+    #if ctr.L[i] > 0:
+    #    n = ctr.Lb[i] + round(ctr.L[i]/ctr.Db) * ctr.Db
+    #else:
+    #    n = - ctr.Lb[i] + round(ctr.L[i]/ctr.Db) * ctr.Db
+    #rough = (1-beta)/sqrt((1-beta)**2 + 4*beta*sinus(pi*(ctr.L[i] - n)/NLayers)**2)
+    rough = (1-beta)/Num.sqrt((1-beta)**2 + 4*beta*Num.sin(Num.pi*(L-ctr.Lb)/ctr.Db)**2)
+
+    if ctr.H == 0.0 and ctr.K == 0.0:
+        if not use_bulk_water:
+            re_water = 0
+            im_water = 0
+            ctr.water = Num.zeros(n,float)
         else:
-            ctr.bulk[i] = Scale * Num.sqrt(ctr.re_bulk[i]**2 + ctr.im_bulk[i]**2)
-            ctr.Fcalc[i] = Scale * rough * Num.sqrt((ctr.re_bulk[i] + re_surf)**2 + (ctr.im_bulk[i] + im_surf)**2)
-            ctr.water[i] = 0
-            ctr.rough[i] = rough * Scale
-            ctr.surf[i] = sqrt(re_surf**2 + im_surf**2) * Scale                 
+            re_water, im_water = calc_Fwater_layered([ctr.H,ctr.K,L],sig_water,sig_water_bar,d_water,zwater,Auc, ctr.fs['o2-.'][:n], q_ang[:,2])
+            ctr.water = specScale * Num.sqrt((re_water)**2 + (im_water)**2)
+        if not use_lay_el:
+            re_el = 0
+            im_el = 0
+        else:
+            re_el, im_el = calc_F_layered_el([ctr.H,ctr.K,L],occ_el,K, sig_el, sig_el_bar, d_el, d0_el, ctr.fs[el][:n], q_ang[:,2])
+        ctr.bulk = specScale * Num.sqrt(ctr.re_bulk**2 + ctr.im_bulk**2)
+        ctr.Fcalc = specScale * rough * Num.sqrt((ctr.re_bulk + re_surf + re_water+ re_el)**2 + (ctr.im_bulk + im_surf + im_water+ im_el)**2)
+        ctr.rough = rough * specScale
+        ctr.surf = Num.sqrt(re_surf**2 + im_surf**2) * specScale
+    else:
+        ctr.bulk = Scale * Num.sqrt(ctr.re_bulk**2 + ctr.im_bulk**2)
+        ctr.Fcalc = Scale * rough * Num.sqrt((ctr.re_bulk + re_surf)**2 + (ctr.im_bulk + im_surf)**2)
+        ctr.water = Num.zeros(n,float)
+        ctr.rough = rough * Scale
+        ctr.surf = Num.sqrt(re_surf**2 + im_surf**2) * Scale
     ctr.difference = ((ctr.F - ctr.Fcalc)/ctr.Ferr)**2
     
     return ctr
@@ -414,17 +614,19 @@ def calc_CTRs(parameter,param_usage, dat, cell, surface_tmp, NLayers, database,\
     surface_new = RB_update(rigid_bodies, surface_new, parameter, cell)
     
     Auc = cell[0]* Num.sin(Num.radians(cell[5]))* cell[1]
+    surf = surface_arrays(surface_new)
     
     if parallel:
         jobs = [(ctr, jobserver.submit(calcF, (ctr,global_parms,Auc,\
-                 surface_new,NLayers,use_bulk_water,RMS_flag,\
-                 use_lay_el, el), (calc_Fsurf, calc_Fwater_layered,\
-                 calc_F_layered_el, Fatom),("numpy as Num",)))for ctr in dat]
+                 surf,NLayers,use_bulk_water,RMS_flag,\
+                 use_lay_el, el), (calc_Fsurf_rod, surface_arrays,\
+                 calc_Fwater_layered, calc_F_layered_el),\
+                 ("numpy as Num",)))for ctr in dat]
         dat = []
         for ctr, job in jobs:
             dat.append(job())
     else:
-        jobs = [(ctr,calcF(ctr,global_parms,Auc,surface_new,NLayers,\
+        jobs = [(ctr,calcF(ctr,global_parms,Auc,surf,NLayers,\
                         use_bulk_water,RMS_flag, use_lay_el, el)) for ctr in dat]
     RMS = 0
     n = 0
@@ -930,10 +1132,75 @@ def check_vibes(surface, param, param_use):
         print message
     return
 ################################################################################
+def _bench_calcF(nrods=10, npts=100, natoms=40, neval=20):
+    """
+    time chi**2 evaluations with the per point surface
+    structure factor (calc_Fsurf) and with calcF
+    """
+    import time
+    cell = [5.0, 5.0, 15.0, 90., 90., 90., 0., 0.]
+    g_inv = calc_g_inv(cell)
+    database = {'fe':[11.77,4.76,7.36,0.31,3.52,15.35,2.30,43.37,1.04],
+                'o2-.':[3.75,16.52,2.84,6.59,1.54,0.32,1.19,43.35,0.24]}
+    random.seed(0)
+    surface = []
+    param_usage = []
+    for i in range(natoms):
+        label = ['Fe','O2-.'][i%2]
+        surface.append([label, random.random(), random.random(),
+                        1+random.random(), 0.01, 0.01, 0.02,
+                        0.1, 0.0, 0.0, 1.0])
+        param_usage.append([0.,'None']*10)
+    parameter = {'Scale':[1.,0,10,False,0,''],
+                 'specScale':[1.,0,10,False,0,''],
+                 'beta':[0.1,0,1,False,0,'']}
+    dat = []
+    for j in range(nrods):
+        rod = Fitting_Rod()
+        rod.H = float(j%3)
+        rod.K = float(j//3)
+        rod.L = Num.linspace(0.1, 4.9, npts)
+        rod.F = Num.ones(npts)
+        rod.Ferr = Num.ones(npts)
+        rod.Lb = Num.zeros(npts)
+        rod.Db = Num.ones(npts)*2
+        rod.re_bulk = Num.ones(npts)
+        rod.im_bulk = Num.zeros(npts)
+        rod.calc_fs(database, g_inv)
+        rod.calc_q_ang(g_inv)
+        dat.append(rod)
+    weight = [1]*nrods
 
-    
-    
-    
+    # per point surface F, as calcF did before
+    U = Num.ndarray((3,3),float)
+    t0 = time.time()
+    for k in range(neval):
+        surf0 = []
+        for ctr in dat:
+            for i in range(npts):
+                fs = {}
+                for key in ctr.fs.keys():
+                    fs[key] = float(ctr.fs[key][i])
+                surf0.append(calc_Fsurf([ctr.H,ctr.K,ctr.L[i]],surface,
+                                        Num.exp,str.lower,Num.dot,Num.pi,
+                                        Num.cos,Num.sin,Num.sqrt,U,fs,
+                                        ctr.q_ang[i]))
+    t1 = time.time()
+    for k in range(neval):
+        dat, chi = calc_CTRs(parameter, param_usage, dat, cell, surface,
+                             1, database, g_inv, weight, [], False,
+                             False, [], False, False, None)
+    t2 = time.time()
+    surf0 = Num.array([Num.sqrt(a**2+b**2) for (a,b) in surf0[-nrods*npts:]])
+    surf1 = Num.concatenate([ctr.surf for ctr in dat])
+    print '%i rods x %i points, %i atoms' % (nrods, npts, natoms)
+    print 'per point: %.1f chi**2 evaluations/sec' % (neval/(t1-t0))
+    print 'calcF:     %.1f chi**2 evaluations/sec' % (neval/(t2-t1))
+    print 'max rel diff in Fsurf: %g' % Num.max(Num.abs(surf1-surf0)/surf0)
+
+################################################################################
+if __name__ == '__main__':
+    _bench_calcF()
 
 
 
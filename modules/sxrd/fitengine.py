@@ -0,0 +1,481 @@
+"""
+Headless fitting engine for the pi-surf model
+
+Runs several downhill simplex fits from random starts, or a
+differential evolution population, with the chi**2 evaluations
+spread over a multiprocessing pool.  Each worker process gets
+the model (rods, surface, bulk F, form factors, cell) once when
+the pool starts, after that only parameter vectors and results
+are passed between processes.
+
+Example:
+--------
+>>model = CtrModel(parameter, param_usage, dat, cell, surface,
+                   NLayers, database)
+>>result = multistart(model, nstarts=32, workers=32)
+>>print result
+>>parameter = model.update(result.x)
+
+"""
+###############################################################################
+
+import numpy as Num
+import random
+import multiprocessing
+import sys
+import time
+
+from tdl.modules.sxrd import ctrfitcalcs
+from tdl.modules.sxrd.ctrfitcalcs import calc_CTRs, calc_g_inv
+from tdl.modules.sxrd.simplex import insert, check_limits, calc_average,\
+                                     min_max, compression, calc_ftol,\
+                                     extract_values, start_simplex
+
+###############################################################################
+class CtrModel:
+    """
+    The pi-surf model and data, chi2(x) gives chi**2 for the
+    vector x of the values of the refined parameters
+    """
+    def __init__(self, parameter, param_usage, dat, cell, surface, NLayers,
+                 database, Rod_weight=None, rigid_bodies=[],
+                 use_bulk_water=False, use_BVC=False, BVclusters=[],
+                 RMS_flag=1, use_lay_el=False, el='h'):
+        """
+        Parameters:
+        -----------
+        * parameter, param_usage, dat, cell, surface, NLayers, database,
+          rigid_bodies, BVclusters are as read by the ctrfitcalcs read_
+          functions (dat should have had precompute_rods done)
+        * Rod_weight is a list of weights for the rods (default 1)
+        * use_bulk_water, use_BVC, RMS_flag, use_lay_el and el are the
+          pi-surf fit options
+        """
+        self.parameter = parameter
+        self.param_usage = param_usage
+        self.dat = dat
+        self.cell = cell
+        self.surface = surface
+        self.NLayers = NLayers
+        self.database = database
+        self.g_inv = calc_g_inv(cell)
+        if Rod_weight == None:
+            Rod_weight = [1]*len(dat)
+        self.Rod_weight = Rod_weight
+        self.rigid_bodies = rigid_bodies
+        self.use_bulk_water = use_bulk_water
+        self.use_BVC = use_BVC
+        self.BVclusters = BVclusters
+        self.RMS_flag = RMS_flag
+        self.use_lay_el = use_lay_el
+        self.el = el
+        self.used_params = []
+        for key in parameter.keys():
+            if parameter[key][3]:
+                self.used_params.append(key)
+        self.used_params.sort()
+
+    def start_point(self):
+        """
+        current values of the refined parameters
+        """
+        return Num.array([self.parameter[key][0] for key in self.used_params],float)
+
+    def limits(self):
+        """
+        (lower, upper) limits of the refined parameters
+        """
+        low  = Num.array([self.parameter[key][1] for key in self.used_params],float)
+        high = Num.array([self.parameter[key][2] for key in self.used_params],float)
+        return low, high
+
+    def update(self, x):
+        """
+        set the refined parameters to x and return the
+        parameter dictionary
+        """
+        return insert(self.used_params, x, self.parameter)
+
+    def calc(self, x=None):
+        """
+        calculate the rods for x (default the current parameter
+        values), returns (dat, chi**2)
+        """
+        if x is not None:
+            self.update(x)
+        dat, chi = calc_CTRs(self.parameter, self.param_usage, self.dat, self.cell,
+                             self.surface, self.NLayers, self.database,
+                             self.g_inv, self.Rod_weight, self.rigid_bodies,
+                             self.use_bulk_water, self.use_BVC, self.BVclusters,
+                             self.RMS_flag, self.use_lay_el, self.el)
+        self.dat = dat
+        return dat, chi
+
+    def chi2(self, x):
+        """
+        chi**2 for x
+        """
+        return self.calc(x)[1]
+
+###############################################################################
+class FitResult:
+    """
+    Result of a multistart or differential evolution fit
+
+    * x is the best point and chi2 its chi**2
+    * minima is the (nfits, nparams) array of the points found by
+      the fits (or the final population) and chi2s their chi**2
+    * spread is the standard deviation of minima for each parameter
+    """
+    def __init__(self, used_params, minima, chi2s, niter):
+        self.used_params = used_params
+        self.minima = Num.array(minima,float)
+        self.chi2s = Num.array(chi2s,float)
+        self.niter = niter
+        best = int(Num.argmin(self.chi2s))
+        self.x = self.minima[best]
+        self.chi2 = self.chi2s[best]
+        self.spread = self.minima.std(axis=0)
+
+    def __repr__(self):
+        lout = "best chi**2 = %g  (%i fits, chi**2 %g to %g)\n" % \
+               (self.chi2, len(self.chi2s), self.chi2s.min(), self.chi2s.max())
+        lout = lout + "%20s %14s %14s %14s\n" % ('parameter','best','mean','spread')
+        mean = self.minima.mean(axis=0)
+        for j in range(len(self.used_params)):
+            lout = lout + "%20s %14.6g %14.6g %14.6g\n" % \
+                   (self.used_params[j], self.x[j], mean[j], self.spread[j])
+        return lout
+
+###############################################################################
+class ProgressLog:
+    """
+    Callback for the optimizers, writes one line of key=value pairs
+    every 'every' iterations:
+
+    fit=start0 iter=120 chi2=1.2345 ftol=0.0012 time=3.21
+
+    time is the wall time in seconds since the first call
+    """
+    def __init__(self, label='fit', every=1):
+        self.label = label
+        self.every = every
+        self.t0 = None
+
+    def __call__(self, iteration, chi2, ftol):
+        if self.t0 == None:
+            self.t0 = time.time()
+        if self.every > 0 and iteration % self.every == 0:
+            sys.stdout.write("fit=%s iter=%i chi2=%.8g ftol=%.4g time=%.2f\n" %
+                             (self.label, iteration, chi2, ftol,
+                              time.time() - self.t0))
+            sys.stdout.flush()
+
+###############################################################################
+def run_simplex(model, points, alpha=1.0, beta=0.5, gamma=2.0, ftol=1e-6,
+                maxiter=10000, callback=None):
+    """
+    Downhill simplex (the same steps as simplex.simplex without the GUI)
+
+    Parameters:
+    -----------
+    * model is a CtrModel
+    * points is the (nparams+1, nparams) starting simplex
+    * alpha, beta, gamma are the reflection, contraction and expansion
+      coefficients
+    * ftol is the convergence limit of the spread in chi**2
+    * maxiter is the maximum number of iterations
+    * callback(iteration, best chi**2, ftol) is called after each
+      iteration (e.g. a ProgressLog)
+
+    Returns (best point, chi**2, iterations)
+    """
+    used = model.used_params
+    parameter = model.parameter
+    points = Num.array(points,float)
+    function_values = Num.array([model.chi2(x) for x in points],float)
+    mini, maxi = min_max(function_values)
+    z = 0
+    while True:
+        Xav = calc_average(points)
+        Xref = check_limits(used, (1+alpha)*Xav - alpha*points[maxi], parameter)
+        Yref = model.chi2(Xref)
+        if Yref < function_values[mini]:
+            Xexp = check_limits(used, (1+gamma)*Xref - gamma*Xav, parameter)
+            Yexp = model.chi2(Xexp)
+            if Yexp < function_values[mini]:
+                points[maxi] = Xexp
+                function_values[maxi] = Yexp
+            else:
+                points[maxi] = Xref
+                function_values[maxi] = Yref
+        else:
+            test = False
+            for i in range(len(points)):
+                if Yref < function_values[i]:
+                    if i == maxi:
+                        test = False
+                    else:
+                        test = True
+            if test:
+                points[maxi] = Xref
+                function_values[maxi] = Yref
+            else:
+                if Yref < function_values[maxi]:
+                    Xcon = beta*Xref + (1-beta)*Xav
+                else:
+                    Xcon = beta*points[maxi] + (1-beta)*Xav
+                Ycon = model.chi2(Xcon)
+                if Ycon < function_values[maxi]:
+                    points[maxi] = Xcon
+                    function_values[maxi] = Ycon
+                else:
+                    points = compression(points, mini)
+                    for i in range(len(points)):
+                        function_values[i] = model.chi2(points[i])
+        mini, maxi = min_max(function_values)
+        act_ftol = calc_ftol(function_values)
+        if callback != None:
+            callback(z, function_values[mini], act_ftol)
+        if act_ftol < ftol or z >= maxiter:
+            break
+        z = z+1
+    return points[mini].copy(), function_values[mini], z
+
+def random_simplex(model, delta=0.2, randomize_start=True, rand=random):
+    """
+    Starting simplex around the current parameter values, each
+    point is moved by a random fraction (up to delta) of the
+    distance to the limits (as the pi-surf 'random parameters'
+    option, see simplex.start_simplex).  If randomize_start is False
+    the first point is the current parameter values.
+    """
+    return start_simplex(model.used_params, model.parameter, delta,
+                         randomize_start, rand)
+
+###############################################################################
+# the model in each worker process, set by _init_worker
+_model = None
+
+def _init_worker(model):
+    global _model
+    # dont use the parallel python server inside the workers
+    ctrfitcalcs.parallel = False
+    _model = model
+
+def _chi2(x):
+    return _model.chi2(x)
+
+def _simplex_job(args):
+    points, kw = args
+    return run_simplex(_model, points, **kw)
+
+def _shift_job(args):
+    key, value = args
+    parameter = _model.parameter
+    old = parameter[key][0]
+    parameter[key][0] = value
+    try:
+        dat, chi = _model.calc()
+    finally:
+        parameter[key][0] = old
+    return extract_values(dat)
+
+def _map(model, func, args, workers):
+    """
+    map func over args in a pool of workers, or in this
+    process if workers is 1
+    """
+    global _model
+    if workers == 1:
+        _model = model
+        return map(func, args)
+    pool = multiprocessing.Pool(workers, _init_worker, (model,))
+    try:
+        return pool.map(func, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+###############################################################################
+def multistart(model, nstarts=8, workers=None, delta=0.2, seed=None,
+               alpha=1.0, beta=0.5, gamma=2.0, ftol=1e-6, maxiter=10000,
+               log_every=0, log_label='start'):
+    """
+    Run nstarts independent downhill simplex fits from random
+    starting simplexes (see random_simplex), the first start is
+    made around the current parameter values.
+
+    Parameters:
+    -----------
+    * model is a CtrModel
+    * nstarts is the number of simplex fits
+    * workers is the number of processes (default is the number
+      of cpus)
+    * delta is the random step size for the starting simplexes
+    * seed seeds the random starting points
+    * alpha, beta, gamma, ftol, maxiter are the simplex options
+    * log_every > 0 writes a ProgressLog line for each fit every
+      log_every iterations (labeled log_label0, log_label1, ...)
+
+    Returns a FitResult, the model parameters are left at the best fit
+    """
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, nstarts))
+    rand = random.Random(seed)
+    kw = {'alpha':alpha, 'beta':beta, 'gamma':gamma, 'ftol':ftol,
+          'maxiter':maxiter}
+    jobs = []
+    for j in range(nstarts):
+        if log_every > 0:
+            kw = dict(kw)
+            kw['callback'] = ProgressLog('%s%i' % (log_label, j), log_every)
+        jobs.append((random_simplex(model, delta, j > 0, rand), kw))
+    results = _map(model, _simplex_job, jobs, workers)
+    result = FitResult(model.used_params, [r[0] for r in results],
+                       [r[1] for r in results], [r[2] for r in results])
+    model.calc(result.x)
+    return result
+
+def differential_evolution(model, npop=None, F=0.7, CR=0.9, maxgen=1000,
+                           ftol=1e-6, workers=None, seed=None, callback=None):
+    """
+    Differential evolution (rand/1/bin) within the parameter limits,
+    the chi**2 of each generation is evaluated in a pool of workers
+
+    Parameters:
+    -----------
+    * model is a CtrModel
+    * npop is the population size (default 10 x number of parameters,
+      at least 10).  The population starts random within the limits
+      plus the current parameter values
+    * F is the differential weight and CR the crossover probability
+    * maxgen is the maximum number of generations
+    * ftol is the convergence limit of the spread in chi**2
+    * workers is the number of processes (default is the number
+      of cpus)
+    * seed seeds the random numbers
+    * callback(generation, best chi**2, ftol) is called after each
+      generation (e.g. a ProgressLog)
+
+    Returns a FitResult with the final population as the minima,
+    the model parameters are left at the best fit
+    """
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    rs = Num.random.RandomState(seed)
+    x0 = model.start_point()
+    low, high = model.limits()
+    n = len(x0)
+    if npop == None:
+        npop = max(10, 10*n)
+    pop = low + rs.random_sample((npop,n))*(high-low)
+    pop[0] = x0
+    if workers == 1:
+        evaluate = lambda x: Num.array(map(model.chi2, x))
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker, (model,))
+        evaluate = lambda x: Num.array(pool.map(_chi2, list(x)))
+    try:
+        fvals = evaluate(pop)
+        gen = 0
+        while gen < maxgen and calc_ftol(fvals) >= ftol:
+            trial = Num.empty_like(pop)
+            for i in range(npop):
+                choice = [j for j in range(npop) if j != i]
+                a, b, c = rs.permutation(choice)[:3]
+                mutant = pop[a] + F*(pop[b] - pop[c])
+                cross = rs.random_sample(n) < CR
+                cross[rs.randint(n)] = True
+                trial[i] = Num.where(cross, mutant, pop[i])
+            trial = Num.clip(trial, low, high)
+            ftrial = evaluate(trial)
+            better = ftrial <= fvals
+            pop[better] = trial[better]
+            fvals[better] = ftrial[better]
+            gen = gen + 1
+            if callback != None:
+                callback(gen, fvals.min(), calc_ftol(fvals))
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    result = FitResult(model.used_params, pop, fvals, gen)
+    model.calc(result.x)
+    return result
+
+def fcalc_shifts(model, shifts, workers=None):
+    """
+    Fcalc of all data points for each (key, value) in shifts, with
+    parameter key set to value and the others at their current
+    values (as used for finite difference derivatives, see
+    simplex.fd_derivatives).  Returns a list of arrays.
+    """
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(shifts)))
+    return _map(model, _shift_job, shifts, workers)
+
+###############################################################################
+def _bench_fit(workers=4, nstarts=4):
+    """
+    multistart and differential evolution on a synthetic model
+    """
+    import time
+    cell = [5.0, 5.0, 15.0, 90., 90., 90., 0., 0.]
+    g_inv = calc_g_inv(cell)
+    database = {'fe':[11.77,4.76,7.36,0.31,3.52,15.35,2.30,43.37,1.04],
+                'o2-.':[3.75,16.52,2.84,6.59,1.54,0.32,1.19,43.35,0.24]}
+    bulk = [['Fe',0.,0.,0.,0.01],['O2-.',0.5,0.5,0.5,0.01]]
+    surface = [['Fe',0.,0.,1.1,0.01,0.01,0.01,0.,0.,0.,1.],
+               ['O2-.',0.5,0.5,1.3,0.02,0.02,0.02,0.,0.,0.,1.]]
+    param_usage = [[0.,'None']*10, [0.,'None']*10]
+    param_usage[0][4:6] = [1., 'z1']
+    param_usage[1][4:6] = [1., 'z2']
+    param_usage[1][19] = 'occ2'
+    param_usage[1][18] = 1.
+    parameter = {'Scale':[1.,0.5,2.,True,0,''],
+                 'specScale':[1.,0.5,2.,False,0,''],
+                 'beta':[0.1,0.,0.5,True,0,''],
+                 'z1':[0.,-0.1,0.1,True,0,''],
+                 'z2':[0.,-0.1,0.1,True,0,''],
+                 'occ2':[1.,0.,1.,True,0,'']}
+    dat = []
+    for (H,K) in [(1,0),(1,1),(2,0),(0,2)]:
+        rod = ctrfitcalcs.Fitting_Rod()
+        rod.H = float(H)
+        rod.K = float(K)
+        rod.L = Num.linspace(0.1,3.9,80)
+        rod.F = Num.ones(80)
+        rod.Ferr = Num.ones(80)
+        rod.Lb = Num.zeros(80)
+        rod.Db = Num.ones(80)*2
+        dat.append(rod)
+    ctrfitcalcs.precompute_rods(dat, cell, bulk, g_inv, database, database)
+    model = CtrModel(parameter, param_usage, dat, cell, surface, 1, database)
+    start = model.start_point()
+    # make data from a known structure
+    values = {'Scale':1.2, 'beta':0.2, 'occ2':0.7, 'z1':0.03, 'z2':-0.02}
+    true = Num.array([values[key] for key in model.used_params])
+    dat, chi = model.calc(true)
+    for rod in dat:
+        rod.F = rod.Fcalc.copy()
+        rod.Ferr = 0.05*rod.F
+    for w in (1, workers):
+        model.update(start)
+        t0 = time.time()
+        result = multistart(model, nstarts=nstarts, workers=w, seed=1)
+        print 'multistart %i starts, %i workers: %.2f sec' % (nstarts, w, time.time()-t0)
+    print result
+    model.update(start)
+    t0 = time.time()
+    result = differential_evolution(model, maxgen=50, workers=workers, seed=1)
+    print 'differential evolution 50 generations, %i workers: %.2f sec' % (workers, time.time()-t0)
+    print result
+    print 'true values: ', true
+
+################################################################################
+if __name__ == '__main__':
+    _bench_fit()
@@ -116,13 +116,7 @@ class wxCtrFitFrame(wx.Frame):
             self.nb.MainControlPage.datafile.SetValue(self.filename[0])
             self.nb.MainControlPage.Rod_weight = []
             self.nb.MainControlPage.rodweight = []
-            if self.nb.bulk != []:
-                for x in self.nb.data:
-                    x.calcFbulk(self.nb.cell, self.nb.bulk, self.nb.g_inv, database)
-            if self.nb.surface != []:
-                for x in self.nb.data:
-                    x.calc_fs(self.nb.runningDB, self.nb.g_inv)
-                    x.calc_q_ang(self.nb.g_inv)
+            self.precompute()
    
             for i in range(len(self.nb.data)):
                 wx.StaticText(self.nb.MainControlPage, label = (str(int(self.nb.data[i].H))+' '+str(int(self.nb.data[i].K))+' L'), pos=(350,25*i+67), size=(40,20))
@@ -133,6 +127,14 @@ class wxCtrFitFrame(wx.Frame):
             self.nb.SetSelection(0)
         dlg.Destroy()
 
+    def precompute(self):
+        """ q, form factors and bulk F for the rods"""
+        if self.nb.data == [] or self.nb.bulk == []: return
+        precompute_rods(self.nb.data, self.nb.cell, self.nb.bulk, self.nb.g_inv,\
+                        database, self.nb.runningDB,\
+                        datafile = self.dirname[0]+'/'+self.filename[0],\
+                        bulkfile = self.dirname[1]+'/'+self.filename[1])
+
     def OnReadBulk(self,e):
         """ Read in bulk file"""
         dlg = wx.FileDialog(self, "Choose a bulk file", self.dirname[1], ".bul", "*.bul", wx.OPEN)
@@ -153,9 +155,7 @@ class wxCtrFitFrame(wx.Frame):
             self.nb.g_inv = calc_g_inv(self.nb.cell)
             self.nb.ResonantDataPage.allrasd.cell = self.nb.cell
             self.nb.ResonantDataPage.allrasd.g_inv = self.nb.g_inv
-            if self.nb.data != []:
-                for x in self.nb.data:
-                    x.calcFbulk(self.nb.cell, self.nb.bulk, self.nb.g_inv, database)                
+            self.precompute()
             self.nb.SetSelection(0)
         dlg.Destroy()
 
@@ -167,10 +167,7 @@ class wxCtrFitFrame(wx.Frame):
             self.dirname[2] = dlg.GetDirectory()
             self.nb.surface, self.nb.parameter_usage, self.nb.runningDB = read_surface(self.dirname[2]+'/'+self.filename[2], database)
             self.nb.MainControlPage.surfacefile.SetValue(self.filename[2])
-            if self.nb.data != []:
-                for x in self.nb.data:
-                    x.calc_fs(self.nb.runningDB, self.nb.g_inv)
-                    x.calc_q_ang(self.nb.g_inv)
+            self.precompute()
             self.nb.SetSelection(0)
         dlg.Destroy()
 
@@ -308,16 +305,10 @@ class wxCtrFitFrame(wx.Frame):
             self.nb.g_inv = calc_g_inv(self.nb.cell)
             self.nb.ResonantDataPage.allrasd.cell = self.nb.cell
             self.nb.ResonantDataPage.allrasd.g_inv = self.nb.g_inv
-            if self.nb.data != []:
-                for x in self.nb.data:
-                    x.calcFbulk(self.nb.cell, self.nb.bulk, self.nb.g_inv, database)                
             # read surface
             self.nb.surface, self.nb.parameter_usage, self.nb.runningDB = read_surface(self.dirname[2]+'/'+self.filename[2], database)
             self.nb.MainControlPage.surfacefile.SetValue(self.filename[2])
-            if self.nb.data != []:
-                for x in self.nb.data:
-                    x.calc_fs(self.nb.runningDB, self.nb.g_inv)
-                    x.calc_q_ang(self.nb.g_inv)
+            self.precompute()
             # read parameters
             self.nb.parameter, self.nb.param_labels = read_parameters(self.dirname[3]+'/'+self.filename[3])
             self.nb.MainControlPage.parameterfile.SetValue(self.filename[3])
@@ -0,0 +1,335 @@
+"""
+Headless pi-surf, CTR refinement without the GUI
+
+Reads the pi-surf input files (data, bulk, surface, parameter and
+optionally rigid body and bond valence files), runs a downhill
+simplex, multistart simplex or differential evolution fit (see
+fitengine) and writes the .par, .dat and .cif results.  Progress
+is written as lines of key=value pairs (see fitengine.ProgressLog):
+
+fit=simplex iter=120 chi2=1.2345 ftol=0.0012 time=3.21
+
+Usage:
+------
+fit one model:
+>>python -m tdl.modules.sxrd.pisurf_batch fit -d data.dat -b bulk.bul
+      -s surface.sur -p parameters.par -m multistart -n 16 -o result
+
+fit several surface models, each in its own process, and rank them
+by chi**2 (model.par is used for model.sur if it exists, otherwise
+the -p file):
+>>python -m tdl.modules.sxrd.pisurf_batch rank -d data.dat -b bulk.bul
+      -p parameters.par -o results model1.sur model2.sur model3.sur
+
+from python:
+>>model = load_model('data.dat','bulk.bul','surface.sur','parameters.par')
+>>result = fit_model(model, method='multistart', nstarts=16)
+>>write_results(model, 'result')
+
+"""
+###############################################################################
+
+import os
+import sys
+import random
+import multiprocessing
+from optparse import OptionParser
+
+from tdl.modules.sxrd import ctrfitcalcs
+from tdl.modules.sxrd.ctrfitcalcs import read_data, read_bulk, read_surface,\
+     read_parameters, read_rigid_bodies, read_BV, write_par, write_data,\
+     write_cif, precompute_rods, calc_g_inv, check_model_consistency,\
+     check_vibes
+from tdl.modules.sxrd.simplex import statistics
+from tdl.modules.sxrd.fitengine import CtrModel, FitResult, ProgressLog,\
+     run_simplex, random_simplex, multistart, differential_evolution
+from tdl.modules.xtab.atomic import f0data as database
+
+METHODS = ['simplex', 'multistart', 'de']
+
+###############################################################################
+def load_model(datafile, bulkfile, surfacefile, parameterfile,
+               rigidbodyfile=None, bvfile=None, Rod_weight=None,
+               use_bulk_water=False, use_BVC=False, use_lay_el=False,
+               el='h', rod_cache=False):
+    """
+    Read the pi-surf input files and return a fitengine.CtrModel,
+    with the parameter labels as model.param_labels
+
+    Parameters:
+    -----------
+    * datafile, bulkfile, surfacefile, parameterfile are the
+      .dat, .bul, .sur and .par files
+    * rigidbodyfile and bvfile are the optional .rbf and .bvf files
+    * Rod_weight is a list of weights for the rods (default 1)
+    * use_bulk_water, use_BVC, use_lay_el and el are the pi-surf
+      fit options
+    * rod_cache: if True the precomputed rod values are kept in a
+      file next to the data file (see ctrfitcalcs.precompute_rods)
+    """
+    dat = read_data(datafile)
+    bulk, cell, NLayers = read_bulk(bulkfile)
+    surface, param_usage, runningDB = read_surface(surfacefile, database)
+    parameter, param_labels = read_parameters(parameterfile)
+    rigid_bodies = []
+    if rigidbodyfile:
+        rigid_bodies = read_rigid_bodies(rigidbodyfile)
+    BVclusters = []
+    if bvfile:
+        BVclusters = read_BV(bvfile, cell)
+    if Rod_weight != None and len(Rod_weight) != len(dat):
+        raise ValueError("%i rod weights given for %i rods" %
+                         (len(Rod_weight), len(dat)))
+    if not check_model_consistency(param_labels, parameter, param_usage,
+                                   rigid_bodies, use_bulk_water, use_lay_el):
+        raise ValueError("Inconsistent model: %s, %s" %
+                         (surfacefile, parameterfile))
+    precompute_rods(dat, cell, bulk, calc_g_inv(cell), database, runningDB,
+                    datafile=datafile, bulkfile=bulkfile, cache=rod_cache)
+    model = CtrModel(parameter, param_usage, dat, cell, surface, NLayers,
+                     runningDB, Rod_weight, rigid_bodies, use_bulk_water,
+                     use_BVC, BVclusters, 1, use_lay_el, el)
+    model.param_labels = param_labels
+    return model
+
+def fit_model(model, method='simplex', label=None, log_every=10,
+              workers=None, seed=None, nstarts=8, alpha=1.0, beta=0.5,
+              gamma=2.0, delta=0.2, ftol=1e-6, maxiter=10000,
+              random_pars=False, npop=None, maxgen=1000, F=0.7, CR=0.9):
+    """
+    Fit the model, returns a fitengine.FitResult and leaves the
+    model at the best fit
+
+    Parameters:
+    -----------
+    * model is a CtrModel (see load_model)
+    * method is 'simplex' (one downhill simplex in this process, as
+      'start fit' in pi-surf), 'multistart' (nstarts simplex fits
+      from random starts) or 'de' (differential evolution)
+    * label labels the progress lines, log_every is the number of
+      iterations between progress lines (0 for none)
+    * workers is the number of processes for multistart and de
+      (default is the number of cpus) and seed seeds the random numbers
+    * alpha, beta, gamma, delta, ftol, maxiter and random_pars are
+      the simplex options, npop, maxgen, F and CR the differential
+      evolution options (ftol is used by both)
+    """
+    if method == 'simplex':
+        points = random_simplex(model, delta, random_pars, random.Random(seed))
+        callback = None
+        if log_every > 0:
+            callback = ProgressLog(label or 'simplex', log_every)
+        x, chi, niter = run_simplex(model, points, alpha, beta, gamma,
+                                    ftol, maxiter, callback)
+        result = FitResult(model.used_params, [x], [chi], [niter])
+        model.calc(result.x)
+    elif method == 'multistart':
+        if label:
+            label = label + '.'
+        result = multistart(model, nstarts, workers, delta, seed, alpha,
+                            beta, gamma, ftol, maxiter, log_every,
+                            label or 'start')
+    elif method == 'de':
+        callback = None
+        if log_every > 0:
+            callback = ProgressLog(label or 'de', log_every)
+        result = differential_evolution(model, npop, F, CR, maxgen, ftol,
+                                        workers, seed, callback)
+    else:
+        raise ValueError("Unknown fit method '%s', use one of %s" %
+                         (method, ', '.join(METHODS)))
+    return result
+
+def write_results(model, prefix, stats=False, fpc=0.0001, workers=1):
+    """
+    Write prefix.par, prefix.dat and prefix.cif for the current
+    parameter values of the model.  With stats=True the standard
+    deviations of the refined parameters are calculated first
+    (see simplex.statistics).
+    """
+    if stats:
+        statistics(fpc, model.parameter, model.param_usage, model.dat,
+                   model.cell, model.surface, model.NLayers, model.database,
+                   model.g_inv, model.Rod_weight, model.rigid_bodies,
+                   model.use_bulk_water, model.use_BVC, model.BVclusters,
+                   model.RMS_flag, model.use_lay_el, model.el, workers)
+    dat, chi = model.calc()
+    check_vibes(model.surface, model.parameter, model.param_usage)
+    write_par(model.parameter, model.param_labels, prefix + '.par')
+    write_data(dat, prefix + '.dat')
+    write_cif(model.cell, model.surface, model.parameter, model.param_usage,
+              model.rigid_bodies, model.use_bulk_water, model.use_lay_el,
+              prefix + '.cif')
+    return chi
+
+###############################################################################
+def _init_rank_worker():
+    # dont use the parallel python server inside the workers
+    ctrfitcalcs.parallel = False
+
+def _rank_job(args):
+    name, files, model_opts, fit_opts, prefix, stats = args
+    try:
+        model = load_model(*files, **model_opts)
+        fit_model(model, label=name, workers=1, **fit_opts)
+        chi = write_results(model, prefix, stats)
+    except Exception as e:
+        error = "%s:%s" % (e.__class__.__name__, e)
+        sys.stdout.write("fit=%s error=%s\n" % (name, error.replace(' ','_')))
+        sys.stdout.flush()
+        return name, None
+    sys.stdout.write("fit=%s done chi2=%.8g\n" % (name, chi))
+    sys.stdout.flush()
+    return name, chi
+
+def rank_models(surfacefiles, datafile, bulkfile, parameterfile, outdir='.',
+                rigidbodyfile=None, bvfile=None, workers=None, stats=False,
+                model_opts={}, fit_opts={}):
+    """
+    Fit several surface models in parallel (one process per model)
+    and rank them by chi**2
+
+    Parameters:
+    -----------
+    * surfacefiles is a list of .sur files.  If there is a .par
+      file with the same name as a surface file it is used for that
+      model, otherwise parameterfile
+    * datafile, bulkfile, rigidbodyfile and bvfile are used for all
+      models
+    * outdir is the directory for the results, name_fit.par,
+      name_fit.dat and name_fit.cif for each model and ranking.txt
+    * workers is the number of processes (default is the number of cpus)
+    * stats=True calculates the parameter standard deviations
+    * model_opts are passed to load_model and fit_opts to fit_model
+
+    Returns a list of (chi**2, name) sorted by chi**2, models that
+    could not be fitted are left out
+    """
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(surfacefiles)))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = []
+    for surfacefile in surfacefiles:
+        name = os.path.splitext(os.path.basename(surfacefile))[0]
+        parfile = os.path.splitext(surfacefile)[0] + '.par'
+        if not os.path.isfile(parfile):
+            parfile = parameterfile
+        files = (datafile, bulkfile, surfacefile, parfile, rigidbodyfile, bvfile)
+        prefix = os.path.join(outdir, name + '_fit')
+        jobs.append((name, files, model_opts, fit_opts, prefix, stats))
+    if workers == 1:
+        results = map(_rank_job, jobs)
+    else:
+        pool = multiprocessing.Pool(workers, _init_rank_worker)
+        try:
+            results = pool.map(_rank_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    ranking = [(chi, name) for (name, chi) in results if chi != None]
+    ranking.sort()
+    f = open(os.path.join(outdir, 'ranking.txt'), 'w')
+    f.write('% rank           chi**2   model\n')
+    for j in range(len(ranking)):
+        f.write("%6i %16.8g   %s\n" % (j+1, ranking[j][0], ranking[j][1]))
+    f.close()
+    return ranking
+
+###############################################################################
+def main(argv=None):
+    """
+    command line interface, see the module doc string
+    """
+    usage = "usage: %prog fit|rank [options] [surface files (rank)]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--data', help='data file (.dat)')
+    parser.add_option('-b', '--bulk', help='bulk file (.bul)')
+    parser.add_option('-s', '--surface', help='surface file (.sur), fit only')
+    parser.add_option('-p', '--parameters', help='parameter file (.par)')
+    parser.add_option('-r', '--rigid-bodies', dest='rigidbodyfile',
+                      help='rigid body file (.rbf)')
+    parser.add_option('-v', '--bond-valence', dest='bvfile',
+                      help='bond valence file (.bvf)')
+    parser.add_option('-w', '--weights',
+                      help='comma separated rod weights (default all 1)')
+    parser.add_option('--water', action='store_true', default=False,
+                      help='use the layered bulk water model')
+    parser.add_option('--layered-el', dest='el', default=None,
+                      help='use the layered element model for element EL')
+    parser.add_option('--bvc', action='store_true', default=False,
+                      help='use the bond valence constraints')
+    parser.add_option('--rod-cache', action='store_true', default=False,
+                      help='keep the precomputed rods in .DATA.rods')
+    parser.add_option('-m', '--method', default='simplex', choices=METHODS,
+                      help='simplex, multistart or de (default simplex)')
+    parser.add_option('-n', '--starts', type='int', default=8,
+                      help='number of multistart fits (default 8)')
+    parser.add_option('-j', '--workers', type='int', default=None,
+                      help='number of processes (default number of cpus)')
+    parser.add_option('--seed', type='int', default=None)
+    parser.add_option('--alpha', type='float', default=1.0)
+    parser.add_option('--beta', type='float', default=0.5)
+    parser.add_option('--gamma', type='float', default=2.0)
+    parser.add_option('--delta', type='float', default=0.2)
+    parser.add_option('--ftol', type='float', default=1e-6)
+    parser.add_option('--maxiter', type='int', default=10000)
+    parser.add_option('--random', action='store_true', default=False,
+                      help='randomize the first simplex point too')
+    parser.add_option('--npop', type='int', default=None,
+                      help='differential evolution population')
+    parser.add_option('--maxgen', type='int', default=1000,
+                      help='differential evolution generations')
+    parser.add_option('--log-every', type='int', default=10,
+                      help='iterations between progress lines (0 for none)')
+    parser.add_option('--stats', action='store_true', default=False,
+                      help='calculate the parameter standard deviations')
+    parser.add_option('-o', '--out', default=None,
+                      help='output prefix (fit) or directory (rank)')
+    (opts, args) = parser.parse_args(argv)
+    if len(args) == 0 or args[0] not in ('fit', 'rank'):
+        parser.error("give the command fit or rank")
+    command = args[0]
+    for name in ('data', 'bulk', 'parameters'):
+        if getattr(opts, name) == None:
+            parser.error("--%s is required" % name)
+    Rod_weight = None
+    if opts.weights:
+        Rod_weight = [float(w) for w in opts.weights.split(',')]
+    model_opts = {'Rod_weight':Rod_weight, 'use_bulk_water':opts.water,
+                  'use_BVC':opts.bvc, 'use_lay_el':opts.el != None,
+                  'el':opts.el or 'h', 'rod_cache':opts.rod_cache}
+    fit_opts = {'method':opts.method, 'log_every':opts.log_every,
+                'seed':opts.seed, 'nstarts':opts.starts, 'alpha':opts.alpha,
+                'beta':opts.beta, 'gamma':opts.gamma, 'delta':opts.delta,
+                'ftol':opts.ftol, 'maxiter':opts.maxiter,
+                'random_pars':opts.random, 'npop':opts.npop,
+                'maxgen':opts.maxgen}
+
+    if command == 'fit':
+        if opts.surface == None:
+            parser.error("--surface is required")
+        model = load_model(opts.data, opts.bulk, opts.surface,
+                           opts.parameters, opts.rigidbodyfile, opts.bvfile,
+                           **model_opts)
+        result = fit_model(model, workers=opts.workers, **fit_opts)
+        prefix = opts.out
+        if prefix == None:
+            prefix = os.path.splitext(opts.surface)[0] + '_fit'
+        write_results(model, prefix, opts.stats, workers=opts.workers)
+        print result
+    else:
+        if len(args) < 2:
+            parser.error("give the surface files to rank")
+        ranking = rank_models(args[1:], opts.data, opts.bulk, opts.parameters,
+                              opts.out or '.', opts.rigidbodyfile, opts.bvfile,
+                              opts.workers, opts.stats, model_opts, fit_opts)
+        print "%6s %16s   %s" % ('rank', 'chi**2', 'model')
+        for j in range(len(ranking)):
+            print "%6i %16.8g   %s" % (j+1, ranking[j][0], ranking[j][1])
+    return 0
+
+################################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -360,12 +360,15 @@ def abs_correct(allrasd):
 ########################## Fit Fourier Components ####################################################        
 def RASD_Fourier(allrasd, pnt):
     Rasd = allrasd.list[pnt]
-    for i in range(Rasd.ndata):
-        j = 0
-        for j in range(len(allrasd.E)):
-            if Rasd.E[i] == allrasd.E[j]:
-                Rasd.f1[i] = allrasd.f1[j]
-                Rasd.f2[i] = allrasd.f2[j]
+    # f1, f2 of the tabulated energies that match the data energies
+    if len(allrasd.E) > 0:
+        order = Num.argsort(allrasd.E, kind = 'mergesort')
+        E = Num.asarray(allrasd.E)[order]
+        j = Num.searchsorted(E, Rasd.E, 'right') - 1
+        j = Num.clip(j, 0, len(E)-1)
+        match = E[j] == Rasd.E
+        Rasd.f1[match] = Num.asarray(allrasd.f1)[order[j[match]]]
+        Rasd.f2[match] = Num.asarray(allrasd.f2)[order[j[match]]]
 
     vec = Num.array([Rasd.a ,Rasd.b , Rasd.AR, Rasd.PR], float)
 
@@ -439,26 +442,82 @@ def calc_rho(Fourier, r, ginv):
         rho = rho + (F_comp[3] * Num.cos(2*Num.pi*(F_comp[4] - Num.dot(r,Q))))
     return rho
 
-def Fourier_synthesis(Fourier, cell, ZR, xf, yf, zf, an, bn, cn, zmin):
-    
-    Rho = Num.ndarray((an,bn,cn),float)
+def Fourier_synthesis(Fourier, cell, ZR, xf, yf, zf, an, bn, cn, zmin, filename=None):
+    """
+    Electron density of the Fourier components (rows of H, K, L,
+    amplitude, phase) on an (an, bn, cn) grid over xf*a, yf*b, zf*c
+    starting at z = zmin*c.
+
+    The phase 2pi(P - r.Q) is a sum of x, y and z terms, so every
+    x slice of the grid is one (bn x ncomp) by (ncomp x cn) complex
+    matrix product instead of a sum over the components at every
+    voxel.  If a filename is given Rho is a .npy file (numpy memmap)
+    written slice by slice, for grids that do not fit in memory.
+
+    Returns Rho and the sample extents [sampx, sampy, sampz]
+    """
+    an = int(an)
+    bn = int(bn)
+    cn = int(cn)
     sampx = cell[0]* xf
     sampy = cell[1]* yf
     sampz = cell[2]* zf
     g_inv = calc_g_inv(cell)
     g_inv2 = calc_g_inv([sampx,sampy,sampz,cell[3],cell[4],cell[5]])
     V = Num.linalg.det(Num.linalg.inv(g_inv2))**0.5
-    
-    for i in range(int(an)):
-        x = sampx /an * float(i)
-        for j in range(int(bn)):
-            y = sampy /bn * float(j)
-            for k in range(int(cn)):
-                z = sampz /cn * float(k) + sampz/zf *zmin
-                R = Num.array([x,y,z],float)
-                Rho[i][j][k]= calc_rho(Fourier, R, g_inv)
-    Rho = Rho * ZR/(V*2*Num.pi)
+
+    Fourier = Num.reshape(Num.asarray(Fourier, float), (-1,5))
+    Q = Fourier[:,0:3] * Num.array([g_inv[0][0]**0.5, g_inv[1][1]**0.5,\
+                                    g_inv[2][2]**0.5])
+    x = sampx /an * Num.arange(an)
+    y = sampy /bn * Num.arange(bn)
+    z = sampz /cn * Num.arange(cn) + sampz/zf *zmin
+    Ex = Num.exp(-2j*Num.pi* Num.outer(x, Q[:,0]))
+    Ey = Num.exp(-2j*Num.pi* Num.outer(y, Q[:,1]))
+    EzT = Num.exp(-2j*Num.pi* Num.outer(Q[:,2], z))
+    A = Fourier[:,3] * Num.exp(2j*Num.pi* Fourier[:,4]) * ZR/(V*2*Num.pi)
+
+    if filename == None:
+        Rho = Num.ndarray((an,bn,cn),float)
+    else:
+        Rho = Num.lib.format.open_memmap(filename, mode='w+', dtype=float,
+                                         shape=(an,bn,cn))
+    for i in range(an):
+        Rho[i] = Num.dot(Ey * (A * Ex[i]), EzT).real
+    if filename != None:
+        Rho.flush()
     return Rho, [sampx,sampy,sampz]
+
+def _bench_Fourier_synthesis(ncomp=300, an=10, bn=10, cn=20):
+    """
+    time Fourier_synthesis against calc_rho at every voxel
+    """
+    import time
+    cell = [5.0, 6.0, 14.0, 90., 90., 90.]
+    Fourier = Num.zeros((ncomp,5),float)
+    Fourier[:,0] = Num.random.randint(-3,4,ncomp)
+    Fourier[:,1] = Num.random.randint(-3,4,ncomp)
+    Fourier[:,2] = Num.random.random(ncomp)*4
+    Fourier[:,3] = Num.random.random(ncomp)
+    Fourier[:,4] = Num.random.random(ncomp)
+    t0 = time.time()
+    Rho, samp = Fourier_synthesis(Fourier, cell, 26, 1, 1, 1.5, an, bn, cn, -0.2)
+    t1 = time.time()
+    g_inv = calc_g_inv(cell)
+    V = Num.linalg.det(Num.linalg.inv(calc_g_inv(samp+cell[3:])))**0.5
+    Rho0 = Num.ndarray((an,bn,cn),float)
+    for i in range(an):
+        for j in range(bn):
+            for k in range(cn):
+                R = Num.array([samp[0]/an*i, samp[1]/bn*j,\
+                               samp[2]/cn*k - 0.2*cell[2]], float)
+                Rho0[i][j][k] = calc_rho(Fourier, R, g_inv)
+    Rho0 = Rho0 * 26/(V*2*Num.pi)
+    t2 = time.time()
+    print '%i components, %ix%ix%i grid' % (ncomp, an, bn, cn)
+    print 'calc_rho per voxel: %.2f sec' % (t2-t1)
+    print 'Fourier_synthesis:  %.4f sec' % (t1-t0)
+    print 'max diff: %g (max rho %g)' % (Num.abs(Rho-Rho0).max(), Num.abs(Rho0).max())
 	
 ############################################################################################################################################	
 def calc_A_P_Q(Qmax, g_inv, surface_tmp, parameter, param_usage, use_bulk_water, use_lay_el):
@@ -645,3 +704,7 @@ def f1f2(datafile, expfile, e0, e0shift, output ='exp.f1f2', n=30):
     plot(f1f2[0],f1f2[2],'b-')
     plot(f1f2[0],f1f2[4],'r-')
     plot(f1f2[0],f1f2[5],'g-')
+
+################################################################################
+if __name__ == '__main__':
+    _bench_Fourier_synthesis()
@@ -10,10 +10,13 @@ Frank Heberling (Frank.Heberling@kit.edu)
 
 import numpy as Num
 import random
-import wx
+try:
+    import wx
+except ImportError:
+    # only needed for the GUI simplex
+    wx = None
 
-from scipy.optimize import leastsq
-from tdl.modules.sxrd.ctrfitcalcs import param_unfold
+from tdl.modules.sxrd.ctrfitcalcs import param_unfold, surface_arrays, calc_Fsurf_rod
 from tdl.modules.sxrd.simplex import insert, check_limits, calc_average, min_max, compression, calc_ftol
 
 ############################### methods used by simplex ############################################################################################
@@ -137,16 +140,30 @@ def res_simplex(StatusBar, parameter,param_usage, allrasd, surface, simplex_para
 ################################################################################################################################
 ##################  Refinement of Atom coordinates, occupancies and DW- Factors  ###################################################################
 
-def Wiggle2(vec, Rasd):
-    a, b = vec
-    delta_F = Rasd.F - ((a+b*(Rasd.E-Rasd.E0))*((Rasd.re_FNR + Rasd.re_FR)**2 + (Rasd.im_FNR + Rasd.im_FR)**2))
-    return delta_F
+def fit_background(Rasd):
+    """
+    a and b of the background (a + b(E-E0)) for the current re_FR and
+    im_FR.  F_calc is linear in a and b, so the least squares solution
+    is found directly.
+    """
+    S = (Rasd.re_FNR + Rasd.re_FR)**2 + (Rasd.im_FNR + Rasd.im_FR)**2
+    A = Num.transpose([S, (Rasd.E-Rasd.E0)*S])
+    Rasd.a, Rasd.b = Num.linalg.lstsq(A, Rasd.F, rcond = -1)[0]
+    return Rasd
 
-def Jacobi2(vec, Rasd):
-    J = Num.ndarray((2,len(Rasd.E)),float)
-    J[0][0:] = -(Rasd.re_FNR + Rasd.re_FR)**2 - (Rasd.im_FNR + Rasd.im_FR)**2
-    J[1][0:] = -(Rasd.E-Rasd.E0) * ((Rasd.re_FNR + Rasd.re_FR)**2 + (Rasd.im_FNR + Rasd.im_FR)**2)
-    return J
+def calc_Fq(Qs, surface, g_inv):
+    """
+    Partial structure factor of the (resonant) atoms in surface
+    (as returned by param_unfold) for the (nQ,3) array of Q vectors
+    in fractional reciprocal coordinates
+
+    Returns the real and imaginary parts (arrays of nQ)
+    """
+    Qs = Num.reshape(Num.asarray(Qs, float), (-1,3))
+    q_Ang = Qs * Num.array([g_inv[0][0]**0.5, g_inv[1][1]**0.5, g_inv[2][2]**0.5])
+    surf = surface_arrays(surface)
+    fs = Num.ones((len(surf[0]), len(Qs)), float)
+    return calc_Fsurf_rod(Qs, surf, fs, q_Ang)
 
 ### main function that calculates the difference between measured and calculated F**2s for a set of resonant atoms ###
 def Rasd_difference(allrasd, surface_tmp, parameter, param_usage, use_bulk_water, Refine_Data, use_lay_el, fix_bckg = False):
@@ -154,79 +171,63 @@ def Rasd_difference(allrasd, surface_tmp, parameter, param_usage, use_bulk_water
     allrasd.ndata = 0
     
     global_parms, surface = param_unfold(parameter,param_usage, surface_tmp, use_bulk_water, use_lay_el)
-    natoms = len(surface)
     occ_el, K,sig_el,sig_el_bar,d_el,d0_el,sig_water, sig_water_bar, d_water, zwater, Scale, specScale, beta= global_parms
-    
-    for Rasd in allrasd.list:
-        if Rasd.use_in_Refine:
-            Q = Num.zeros((3),float)
-            Q[0] = allrasd.g_inv[0][0]**0.5 * Rasd.Q[0]
-            Q[1] = allrasd.g_inv[1][1]**0.5 * Rasd.Q[1]
-            Q[2] = allrasd.g_inv[2][2]**0.5 * Rasd.Q[2]
-        
-            j = 0
-            re_Fq = 0
-            im_Fq = 0
-            for n in range(natoms):
-                R = Num.array([surface[n][1],surface[n][2],surface[n][3]],float)
 
-                U = Num.ndarray((3,3),float)
-                U[0][0] = surface[n][4]
-                U[0][1] = U[1][0] = surface[n][7]*(surface[n][4]*surface[n][5])**0.5
-                U[0][2] = U[2][0] = surface[n][8]*(surface[n][4]*surface[n][6])**0.5
-                U[1][1] = surface[n][5]
-                U[1][2] = U[2][1] = surface[n][9]*(surface[n][5]*surface[n][6])**0.5
-                U[2][2] = surface[n][6]
-                
-                theta = surface[n][10]
-                re_Fq = re_Fq + (theta * Num.cos(2*Num.pi*(Rasd.Q[0]*R[0]+Rasd.Q[1]*R[1]+Rasd.Q[2]*R[2])) * Num.exp(-2* Num.pi**2 * Num.dot(Num.dot(Q,U),Q)))
-                im_Fq = im_Fq + (theta * Num.sin(2*Num.pi*(Rasd.Q[0]*R[0]+Rasd.Q[1]*R[1]+Rasd.Q[2]*R[2])) * Num.exp(-2* Num.pi**2 * Num.dot(Num.dot(Q,U),Q)))
-            if use_lay_el and Q[0] == 0 and Q[1] == 0:
-                re_lay, im_lay = calc_F_lay_el(Rasd.Q, occ_el, K, sig_el, sig_el_bar, d_el, d0_el, allrasd.g_inv)
-                re_Fq = re_Fq + re_lay
-                im_Fq = im_Fq + im_lay                                    
-            Rasd.re_FR = Rasd.f1 * re_Fq - Rasd.f2 * im_Fq
-            Rasd.im_FR = Rasd.f1 * im_Fq + Rasd.f2 * re_Fq
+    # partial structure factors for all Q in one call
+    rasds = [Rasd for Rasd in allrasd.list if Rasd.use_in_Refine]
+    if len(rasds) > 0:
+        Qs = Num.array([Rasd.Q for Rasd in rasds], float)
+        re_Fqs, im_Fqs = calc_Fq(Qs, surface, allrasd.g_inv)
+        if use_lay_el:
+            spec = (Qs[:,0] == 0) & (Qs[:,1] == 0)
+            if spec.any():
+                re_lay, im_lay = calc_F_lay_el(Qs[spec].T, occ_el, K, sig_el, sig_el_bar, d_el, d0_el, allrasd.g_inv)
+                re_Fqs[spec] = re_Fqs[spec] + re_lay
+                im_Fqs[spec] = im_Fqs[spec] + im_lay
 
-            Rasd.re_Fq = re_Fq
-            Rasd.im_Fq = im_Fq
+    for j in range(len(rasds)):
+        Rasd = rasds[j]
+        re_Fq = re_Fqs[j]
+        im_Fq = im_Fqs[j]
+        Rasd.re_FR = Rasd.f1 * re_Fq - Rasd.f2 * im_Fq
+        Rasd.im_FR = Rasd.f1 * im_Fq + Rasd.f2 * re_Fq
 
-            if Refine_Data:
-                if not fix_bckg:
-                    vec = [Rasd.a, Rasd.b]
-                    result = leastsq(Wiggle2, vec, args=(Rasd), Dfun = Jacobi2, col_deriv = 1)
-                    vec = result[0]
-                    Rasd.a, Rasd.b = vec
+        Rasd.re_Fq = re_Fq
+        Rasd.im_Fq = im_Fq
 
-                Rasd.F_calc = (Rasd.a+Rasd.b*(Rasd.E - Rasd.E0))*((Rasd.re_FNR + Rasd.re_FR)**2 + (Rasd.im_FNR + Rasd.im_FR)**2) 
-                Rasd.delta_F = ((Rasd.F - Rasd.F_calc)/Rasd.Ferr)**2
-                Rasd.norm = (Rasd.a+ Rasd.b* (Rasd.E - Rasd.E0))*(Rasd.re_FNR**2 + Rasd.im_FNR**2)
-                Rasd.RMS = Num.sum(Rasd.delta_F)/Rasd.ndata
-        
-                allrasd.RMS = allrasd.RMS + Num.sum(Rasd.delta_F)
-                allrasd.ndata = allrasd.ndata + Rasd.ndata
-            else:
-                PR = Num.arctan(Rasd.im_Fq/Rasd.re_Fq)/(2*Num.pi)
-                AR = Rasd.re_Fq /Num.cos(2*Num.pi*PR)
-                if AR < 0 and PR < 0.5 and PR > 0.:
-                    PR = PR + 0.5
-                    AR = -AR
-                elif AR < 0 and PR > 0.5:
-                    PR = PR - 0.5
-                    AR = -AR
-                elif PR < 0 and AR > 0:
-                    PR = PR + 1.
-                elif AR < 0 and PR < 0 and PR > -0.5:
-                    PR = PR + 0.5
-                    AR = -AR
-                if PR > 1: PR = PR -1
-                Rasd.AR_refine = AR
-                Rasd.PR_refine = PR
+        if Refine_Data:
+            if not fix_bckg:
+                Rasd = fit_background(Rasd)
 
-                Rasd.RMS = (Rasd.re_Fq / Num.cos(2*Num.pi*Rasd.PR) - Rasd.AR)**2 + (Rasd.im_Fq / Num.sin(2*Num.pi*Rasd.PR) - Rasd.AR)**2
-                allrasd.RMS = allrasd.RMS + Rasd.RMS
-                allrasd.ndata = allrasd.ndata + 1
-        
+            Rasd.F_calc = (Rasd.a+Rasd.b*(Rasd.E - Rasd.E0))*((Rasd.re_FNR + Rasd.re_FR)**2 + (Rasd.im_FNR + Rasd.im_FR)**2) 
+            Rasd.delta_F = ((Rasd.F - Rasd.F_calc)/Rasd.Ferr)**2
+            Rasd.norm = (Rasd.a+ Rasd.b* (Rasd.E - Rasd.E0))*(Rasd.re_FNR**2 + Rasd.im_FNR**2)
+            Rasd.RMS = Num.sum(Rasd.delta_F)/Rasd.ndata
+    
+            allrasd.RMS = allrasd.RMS + Num.sum(Rasd.delta_F)
+            allrasd.ndata = allrasd.ndata + Rasd.ndata
+        else:
+            PR = Num.arctan(Rasd.im_Fq/Rasd.re_Fq)/(2*Num.pi)
+            AR = Rasd.re_Fq /Num.cos(2*Num.pi*PR)
+            if AR < 0 and PR < 0.5 and PR > 0.:
+                PR = PR + 0.5
+                AR = -AR
+            elif AR < 0 and PR > 0.5:
+                PR = PR - 0.5
+                AR = -AR
+            elif PR < 0 and AR > 0:
+                PR = PR + 1.
+            elif AR < 0 and PR < 0 and PR > -0.5:
+                PR = PR + 0.5
+                AR = -AR
+            if PR > 1: PR = PR -1
+            Rasd.AR_refine = AR
+            Rasd.PR_refine = PR
+
+            Rasd.RMS = (Rasd.re_Fq / Num.cos(2*Num.pi*Rasd.PR) - Rasd.AR)**2 + (Rasd.im_Fq / Num.sin(2*Num.pi*Rasd.PR) - Rasd.AR)**2
+            allrasd.RMS = allrasd.RMS + Rasd.RMS
+            allrasd.ndata = allrasd.ndata + 1
+    
     allrasd.RMS = allrasd.RMS/allrasd.ndata
 
     return allrasd
@@ -10,7 +10,11 @@ Frank Heberling (Frank.Heberling@kit.edu)
 
 import numpy as Num
 import random
-import wx
+try:
+    import wx
+except ImportError:
+    # only needed for the GUI simplex
+    wx = None
 
 from tdl.modules.sxrd.ctrfitcalcs import *
 ############################### methods used by simplex ############################################################################################
@@ -28,6 +32,25 @@ def check_limits(used_params, point, parameter):
         elif point[i] > parameter[key][2]: 
             point[i] = parameter[key][2]
     return point
+
+def start_simplex(used_params, parameter, delta, randomize_start=True, rand=random):
+    """
+    Starting simplex (nparams+1, nparams) around the current parameter
+    values, each point is moved by a random fraction (up to delta) of
+    the distance to the limits.  If randomize_start is False the first
+    point is the current parameter values.
+    """
+    n = len(used_params)
+    points = Num.zeros((n+1,n),float)
+    for i in range(n+1):
+        for j in range(n):
+            key = used_params[j]
+            x0 = parameter[key][0]
+            if i == 0 and not randomize_start:
+                points[i][j] = x0
+            else:
+                points[i][j] = x0 + rand.uniform(((parameter[key][1]-x0)*delta), ((parameter[key][2]-x0)*delta))
+    return points
     
 def calc_average(points):
     av_point = Num.zeros((len(points[0])),float)
@@ -118,28 +141,18 @@ def simplex(StatusBar,parameter,param_usage, dat, cell, surface_tmp, NLayers, da
     alpha, beta, gamma, delta, ftol, maxiter, random_pars = panel.simplex_params
     StatusBar.SetStatusText('Preparing Simplex',0)
     used_params = []
-    used_params_values = []
     for i in parameter.keys():
         if parameter[i][3]:
             used_params.append(i)
-            used_params_values.append(parameter[i][0])        
     
     function_values = Num.ndarray((len(used_params)+1),float)
-    points = Num.ndarray((len(used_params)+1,len(used_params)),float)
+    points = start_simplex(used_params, parameter, delta, random_pars)
     for i in range(len(used_params)+1):
         while wx.GetApp().Pending():
             wx.GetApp().Dispatch()
             wx.GetApp().Yield(True)
-        if i == 0 and not random_pars:
-            points[i] = used_params_values
-            parameter = insert(used_params, points[i], parameter)
-            dat, function_values[i] = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        else:
-            for j in range(len(points[i])):
-                key = used_params[j]
-                points[i][j] = used_params_values[j] + random.uniform(((parameter[key][1]-used_params_values[j])*delta), ((parameter[key][2]-used_params_values[j])*delta))
-            parameter = insert(used_params, points[i], parameter)    
-            dat, function_values[i] = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
+        parameter = insert(used_params, points[i], parameter)
+        dat, function_values[i] = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
             
     not_converged = True
     z = 0
@@ -224,71 +237,85 @@ def simplex(StatusBar,parameter,param_usage, dat, cell, surface_tmp, NLayers, da
 
 #################################################################################################################################
 def extract_values(data):
-    y = Num.array([])
-    for i in range(len(data)):
-        for j in range(len(data[i].L)):
-            y = Num.append(y, data[i].Fcalc[j])
-    return y
+    if len(data) == 0:
+        return Num.array([])
+    return Num.concatenate([Num.asarray(ctr.Fcalc[:len(ctr.L)],float) for ctr in data])
+
+def calc_weights(dat):
+    """
+    weights (1/Ferr)**2 of all data points as a vector
+    """
+    if len(dat) == 0:
+        return Num.array([])
+    return Num.concatenate([(1/Num.asarray(ctr.Ferr[:len(ctr.L)],float))**2 for ctr in dat])
+
+def fd_steps(key, fpc, parameter):
+    """
+    The two values of parameter key and the step h used for its finite
+    difference derivative.  The step is centred on the current value
+    unless that would cross a limit.
+    """
+    h = parameter[key][0] * fpc
+    if h == 0:
+        h = fpc
+    elif h < 0.:
+        h = -h
+    if parameter[key][0] -0.5*h >= parameter[key][1] and parameter[key][0] +0.5*h <= parameter[key][2]:
+        v1 = parameter[key][0] -0.5*h
+    elif parameter[key][0] -0.5*h < parameter[key][1]:
+        v1 = parameter[key][0]
+    else:
+        v1 = parameter[key][0] -h
+    return v1, v1 +h, h
 
-def statistics(fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el):
-    n = 0
+def fd_derivatives(keys, fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el, workers=1):
+    """
+    Finite difference derivatives of Fcalc of all data points with
+    respect to the parameters in keys, returns a (len(keys), npoints)
+    array.  If workers is not 1 the 2*len(keys) model calculations
+    are done in a pool of worker processes (see fitengine, workers=None
+    uses all cpus).  The parameter values are left unchanged.
+    """
+    shifts = []
+    steps = []
+    for key in keys:
+        v1, v2, h = fd_steps(key, fpc, parameter)
+        shifts.append((key, v1))
+        shifts.append((key, v2))
+        steps.append(h)
+    if len(keys) == 0:
+        return Num.zeros((0,len(calc_weights(dat))))
+    if workers == 1:
+        y = []
+        for key, value in shifts:
+            old = parameter[key][0]
+            parameter[key][0] = value
+            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
+            y.append(extract_values(data))
+            parameter[key][0] = old
+    else:
+        from tdl.modules.sxrd import fitengine
+        model = fitengine.CtrModel(parameter, param_usage, dat, cell, surface_tmp, NLayers, database, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
+        y = fitengine.fcalc_shifts(model, shifts, workers)
+    y = Num.array(y)
+    return (y[1::2] - y[0::2])/Num.array(steps)[:,Num.newaxis]
+
+def statistics(fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el, workers=1):
+    w = calc_weights(dat)
     used_params = []
-    for i in range(len(dat)):
-        n = n + len(dat[i].L)
-    w = Num.zeros((n,n))
-    n = 0
-    for i in range(len(dat)):
-        for j in range(len(dat[i].L)):
-            w[n][n] = (1/dat[i].Ferr[j])**2
-            n = n+1
-                   
     for i in parameter.keys():
         if parameter[i][3]:
             used_params.append(i)
     
     b = len(used_params)
-    X = Num.zeros((b,n))
-    
-    for i in range(b):
-        h = parameter[used_params[i]][0] * fpc
-        if h == 0:
-            h = fpc
-        elif h < 0.:
-            h = -h
-        if parameter[used_params[i]][0] -0.5*h >= parameter[used_params[i]][1] and parameter[used_params[i]][0] +0.5*h <= parameter[used_params[i]][2]:
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -0.5*h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -0.5*h
-            
-        elif parameter[used_params[i]][0] -0.5*h < parameter[used_params[i]][1]:
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -h
-            
-        elif parameter[used_params[i]][0] +0.5*h > parameter[used_params[i]][2]:
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] -h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y1 = extract_values(data)
-            parameter[used_params[i]][0] = parameter[used_params[i]][0] +h
-            data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-            y2 = extract_values(data)
-            y1 = (y2 - y1)/h
-            
-        for j in range(n):
-            X[i][j] = y1[j] * parameter[used_params[i]][0] * Num.sqrt(w[j][j])
+    X = fd_derivatives(used_params, fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el, workers)
+    p = Num.array([parameter[key][0] for key in used_params],float)
+    X = X * p[:,Num.newaxis] * Num.sqrt(w)
 
     data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
             
-    V = Num.dot(X, Num.dot( w, Num.transpose(X)))
+    # w is diagonal, X w X^T without the (npoints x npoints) matrix
+    V = Num.dot(X*w, Num.transpose(X))
     C = Num.zeros((b,b))
     try:
         V = R* Num.linalg.inv(V)
@@ -309,65 +336,15 @@ def statistics(fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, datab
     return parameter, X, C, used_params, R
 
 def single_param_sensitivities(param_label, fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el):
-    n = 0
-    for i in range(len(dat)):
-        n = n + len(dat[i].L)
-    w = Num.zeros((n,n))
-    n = 0
-    for i in range(len(dat)):
-        for j in range(len(dat[i].L)):
-            w[n][n] = (1/dat[i].Ferr[j])**2
-            n = n+1
-
-    X = Num.zeros((n))
-    
-    h = parameter[param_label][0] * fpc
-    if h == 0.:
-        h = fpc
-    elif h < 0.:
-        h = -h
-    if parameter[param_label][0] -0.5*h >= parameter[param_label][1] and parameter[param_label][0] +0.5*h <= parameter[param_label][2]:
-        parameter[param_label][0] = parameter[param_label][0] -0.5*h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-        parameter[param_label][0] = parameter[param_label][0] -0.5*h
-            
-    elif parameter[param_label][0] -0.5*h < parameter[param_label][1]:
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-        parameter[param_label][0] = parameter[param_label][0] -h
-            
-    elif parameter[param_label][0] +0.5*h > parameter[param_label][2]:
-        parameter[param_label][0] = parameter[param_label][0] -h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y1 = extract_values(data)
-        parameter[param_label][0] = parameter[param_label][0] +h
-        data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-        y2 = extract_values(data)
-        y1 = (y2 - y1)/h
-            
-    for j in range(n):
-        X[j] = y1[j] * parameter[param_label][0] * Num.sqrt(w[j][j])
+    w = calc_weights(dat)
+    X = fd_derivatives([param_label], fpc, parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)[0]
+    X = X * parameter[param_label][0] * Num.sqrt(w)
 
     data, R = calc_CTRs(parameter,param_usage, dat, cell,surface_tmp, NLayers, database, g_inv, Rod_weight, rigid_bodies, use_bulk_water, use_BVC, BVclusters, RMS_flag, use_lay_el, el)
-    V = Num.dot(X,Num.dot(w,Num.transpose(X)))
+    V = Num.dot(X*w,X)
     if V > 0:
         dp = Num.sqrt(R/V)
     else:
         dp = 0.
 
     return X, dp
-                              
-                              
-                              
-            
-    
-    
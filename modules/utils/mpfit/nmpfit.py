@@ -1492,9 +1492,12 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             mperr = 0
             fjac = numpy.zeros(nall, numpy.float)
             numpy.put(fjac, ifree, 1.0)  ## Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            ## The user function returns [status, f, pderiv] (see the
+            ## ANALYTIC DERIVATIVES notes above)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            fjac = numpy.array(pderiv, numpy.float)
 
-            if len(fjac) != m*nall:
+            if fjac.size != m*nall:
                 print 'ERROR: Derivative matrix was not computed properly.'
                 return(None)
 
@@ -1507,7 +1510,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             if len(ifree) < nall:
                 fjac = fjac[:,ifree]
                 fjac.shape = [m, n]
-                return(fjac)
+            return(fjac)
 
         fjac = numpy.zeros([m, n], numpy.float)
 
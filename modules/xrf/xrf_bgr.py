@@ -260,128 +260,18 @@ class Background:
 
         Parameters:
         -----------
-        * data is the spectrum
+        * data is the spectrum, or a 2D array of spectra
+          (one spectrum per row)
         * slope is the slope of conversion channels to energy
-        """
-        REFERENCE_AMPL=100.
-        TINY = 1.E-20
-        HUGE = 1.E20
-        MAX_TANGENT=2
-
-        bottom_width = self.bottom_width
-        top_width    = self.top_width
-        exponent     = self.exponent
-        tangent      = self.tangent
-        compress     = self.compress
-
-        #bgr         = copy.copy(data)
-        nchans      = len(data)
-        self.bgr    = num.zeros(nchans,dtype=num.int)
-        scratch     = copy.copy(data)
-
-        # Compress scratch spectrum
-        if (compress > 1):
-            tmp = compress_array(scratch, compress)
-            if tmp == None:
-                compress = 1
-            else:
-                scratch = tmp
-                slope = slope * compress
-                nchans = nchans / compress
-
-        # Copy scratch spectrum to background spectrum
-        bckgnd = copy.copy(scratch)
-
-        # Find maximum counts in input spectrum. This information is used to
-        # limit the size of the function lookup table
-        max_counts = max(scratch)
-
-        ####################################################
-        #  Fit functions which come down from top
-        if (top_width > 0.):
-            #   First make a lookup table of this function
-            chan_width  = top_width / (2. * slope)
-            denom       = chan_width**exponent
-            indices     = num.arange(float(nchans*2+1)) - nchans
-            power_funct = indices**exponent * (REFERENCE_AMPL / denom)
-            power_funct = num.compress((power_funct <= max_counts), power_funct)
-            max_index   = len(power_funct)/2 - 1
-
-            for center_chan in range(nchans):
-                first_chan  = max((center_chan - max_index), 0)
-                last_chan   = min((center_chan + max_index), (nchans-1))
-                f           = first_chan - center_chan + max_index
-                l           = last_chan - center_chan + max_index
-                test        = scratch[center_chan] + power_funct[f:l+1]
-                sub         = bckgnd[first_chan:last_chan+1] 
-                bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
-
-        # Copy this approximation of background to scratch
-        scratch = copy.copy(bckgnd)
-
-        # Find maximum counts in scratch spectrum. This information is used to
-        #   limit the size of the function lookup table
-        max_counts = max(scratch)
-
-        ####################################################
-        # Fit functions which come up from below
-        bckgnd = num.arange(float(nchans)) - HUGE
-
-        # First make a lookup table of this function
-        chan_width = bottom_width / (2. * slope)
-        if (chan_width == 0.):
-            denom = TINY
-        else:
-            denom = chan_width**exponent
-        
-        indices     = num.arange(float(nchans*2+1)) - nchans
-        power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
-        power_funct = num.compress((power_funct <= max_counts), power_funct)
-        max_index   = len(power_funct)/2 - 1
 
-        for center_chan in range(nchans-1):
-            tangent_slope = 0.
-            if tangent:
-                # Find slope of tangent to spectrum at this channel
-                first_chan    = max((center_chan - MAX_TANGENT), 0)
-                last_chan     = min((center_chan + MAX_TANGENT), (nchans-1))
-                denom         = center_chan - num.arange(float(last_chan - first_chan + 1))
-                # is this correct?
-                denom         = max(max(denom), 1)
-                tangent_slope = (scratch[center_chan] - scratch[first_chan:last_chan+1]) / denom
-                tangent_slope = num.sum(tangent_slope) / (last_chan - first_chan)
-
-            first_chan = max((center_chan - max_index), 0)
-            last_chan  = min((center_chan + max_index), (nchans-1))
-            last_chan  = max(last_chan, first_chan)
-            nc         = last_chan - first_chan + 1
-            lin_offset = scratch[center_chan] + (num.arange(float(nc)) - nc/2) * tangent_slope
-
-            # Find the maximum height of a function centered on this channel
-            # such that it is never higher than the counts in any channel
-
-            f      = first_chan - center_chan + max_index
-            l      = last_chan - center_chan + max_index
-            test   = scratch[first_chan:last_chan+1] - lin_offset + power_funct[f:l+1]
-            height = min(test)
-
-            # We now have the function height. Set the background to the
-            # height of the maximum function amplitude at each channel
-
-            test = height + lin_offset - power_funct[f:l+1]
-            sub  = bckgnd[first_chan:last_chan+1]
-            bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
-
-        ####################################################
-        # Expand spectrum
-        if (compress > 1):
-            bckgnd = expand_array(bckgnd, compress)
-
-        # Bgr should be positive integers??
-        bgr = bckgnd.astype(int)
-        idx = num.where(bgr <= 0)
-        bgr[idx] = 0
-        self.bgr = bgr
+        The result is stored in self.bgr (see calc_background)
+        """
+        self.bgr = calc_background(data,slope=slope,
+                                   bottom_width=self.bottom_width,
+                                   top_width=self.top_width,
+                                   exponent=self.exponent,
+                                   tangent=self.tangent,
+                                   compress=self.compress)
 
     ##################################################################################
     def _update(self,parameters):
@@ -393,6 +283,234 @@ class Background:
         self.bottom_width = parameters[0]
         self.top_width    = parameters[1]
 
+############################################################
+REFERENCE_AMPL = 100.
+TINY           = 1.E-20
+HUGE           = 1.E20
+MAX_TANGENT    = 2
+
+def calc_background(data,slope=1.0,bottom_width=4.0,top_width=0.0,
+                    exponent=2,tangent=False,compress=4):
+    """
+    Compute the background of a spectrum (see module notes)
+
+    Parameters:
+    -----------
+    * data is the spectrum, or a 2D array of spectra
+      (one spectrum per row, all with the same slope)
+    * slope is the slope of conversion channels to energy
+    * bottom_width, top_width, exponent, tangent and
+      compress are the Background parameters
+
+    Returns:
+    --------
+    * integer background array with the shape of data
+
+    Notes:
+    ------
+    Each pass of the algorithm is a sliding window max (or min)
+    of the spectrum plus the polynomial lookup table.  Rather than
+    looping over the window centers, the passes loop over the
+    window offsets and update all channels (and spectra) at once.
+    The result is the same as the channel by channel loops of
+    _calc_background_loop.
+    """
+    data = num.asarray(data)
+    one_spectrum = (data.ndim == 1)
+    scratch = num.atleast_2d(data).copy()
+    (nspec,nchans) = scratch.shape
+
+    # Compress scratch spectra
+    if (compress > 1):
+        if ((nchans % compress) != 0):
+            print 'Warning compress must be integer divisor of array length'
+            compress = 1
+        else:
+            scratch = num.array([compress_array(d,compress) for d in scratch])
+            slope   = slope * compress
+            nchans  = nchans / compress
+
+    ####################################################
+    #  Fit functions which come down from top
+    if (top_width > 0.):
+        (kern,max_index) = _power_kernels(scratch,top_width,slope,
+                                          exponent,bottom=False)
+        scratch = _top_pass(scratch,kern)
+
+    ####################################################
+    # Fit functions which come up from below
+    (kern,max_index) = _power_kernels(scratch,bottom_width,slope,
+                                      exponent,bottom=True)
+    if tangent:
+        tslope = _tangent_slopes(scratch)
+    else:
+        tslope = None
+    bckgnd = _bottom_pass(scratch,kern,max_index,tslope)
+
+    ####################################################
+    # Expand spectrum
+    if (compress > 1):
+        bckgnd = num.array([expand_array(b,compress) for b in bckgnd])
+
+    # Bgr should be positive integers??
+    bgr = bckgnd.astype(int)
+    bgr[bgr <= 0] = 0
+    if one_spectrum: bgr = bgr[0]
+    return bgr
+
+def _power_kernels(scratch,width,slope,exponent,bottom=True):
+    """
+    Polynomial lookup table for each spectrum, indexed by the
+    offset from the center channel.
+
+    Returns (kern,max_index) where kern[s,wd+k] is the table value
+    added at channel center+k for spectrum s (wd = max offset),
+    or None if that offset is outside the window.  The table of
+    each spectrum is cut where it exceeds its max counts.
+    """
+    (nspec,nchans) = scratch.shape
+    chan_width = width / (2. * slope)
+    if (chan_width == 0.):
+        denom = TINY
+    else:
+        denom = chan_width**exponent
+    indices     = num.arange(float(nchans*2+1)) - nchans
+    power_funct = indices**exponent * (REFERENCE_AMPL / denom)
+    tables    = []
+    max_index = num.zeros(nspec,dtype=int)
+    for k in range(nspec):
+        pf = num.compress((power_funct <= max(scratch[k])), power_funct)
+        tables.append(pf)
+        max_index[k] = len(pf)/2 - 1
+    # the window centered on channel c covers channels
+    # c-max_index to c+max_index and uses the table values
+    # pf[j - c + max_index].  If max_index < 0 the bottom
+    # window is only the next channel (j = c+1)
+    wd   = max(1,max_index.max())
+    kern = [[None]*(2*wd+1) for k in range(nspec)]
+    for k in range(nspec):
+        pf = tables[k]
+        mi = max_index[k]
+        if mi >= 0:
+            offsets = range(-mi,mi+1)
+        elif bottom and len(pf) > 0:
+            offsets = [1]
+        else:
+            offsets = []
+        for off in offsets:
+            kern[k][off+wd] = pf[off+mi]
+    return (kern,max_index)
+
+def _kernel_columns(kern,fill):
+    """
+    Table values for each offset as (nspec,1) columns, with
+    fill for offsets outside a window. Offsets that are
+    outside all the windows are returned as None
+    """
+    cols = []
+    for j in range(len(kern[0])):
+        col = [kern[k][j] for k in range(len(kern))]
+        if col.count(None) == len(col):
+            cols.append(None)
+        else:
+            col = [fill if v is None else v for v in col]
+            cols.append(num.array(col,dtype=float)[:,num.newaxis])
+    return cols
+
+def _top_pass(scratch,kern):
+    """
+    Concave up functions: each channel is the max of the data
+    and the tables centered on every channel within reach
+    """
+    (nspec,nchans) = scratch.shape
+    cols = _kernel_columns(kern,-num.inf)
+    wd   = (len(cols) - 1)/2
+    best = scratch.astype(float)
+    for k in range(len(cols)):
+        if cols[k] is None: continue
+        # channel j = c + off for center c
+        off = k - wd
+        cs  = slice(max(0,-off),min(nchans,nchans-off))
+        js  = slice(cs.start+off,cs.stop+off)
+        num.maximum(best[:,js],scratch[:,cs] + cols[k],best[:,js])
+    # assigning into the data array truncates int spectra
+    return best.astype(scratch.dtype)
+
+def _bottom_pass(scratch,kern,max_index,tslope=None):
+    """
+    Concave down functions: find the height of the function
+    centered on each channel that just touches the data, then
+    take the max of these functions at each channel
+    """
+    (nspec,nchans) = scratch.shape
+    cols = _kernel_columns(kern,num.inf)
+    wd   = (len(cols) - 1)/2
+    if tslope is not None:
+        # the line tangent to the data at the center channel
+        # is offset from the start of the window
+        chans = num.arange(nchans)
+        first = num.maximum(chans - max_index[:,num.newaxis],0)
+        last  = num.minimum(chans + max_index[:,num.newaxis],nchans-1)
+        last  = num.maximum(last,first)
+        half  = (last - first + 1)/2
+    def _slices(off):
+        # the last channel is not used as a center
+        cs = slice(max(0,-off),min(nchans-1,nchans-off))
+        js = slice(cs.start+off,cs.stop+off)
+        return (cs,js)
+    def _lin_offset(cs,off):
+        if tslope is None:
+            return scratch[:,cs].astype(float)
+        return (scratch[:,cs] +
+                ((chans[cs] + off - first[:,cs]).astype(float) -
+                 half[:,cs]) * tslope[:,cs])
+    # height of the function centered on each channel
+    height = num.zeros((nspec,nchans)) + num.inf
+    for k in range(len(cols)):
+        if cols[k] is None: continue
+        off = k - wd
+        (cs,js) = _slices(off)
+        test = scratch[:,js] - _lin_offset(cs,off) + cols[k]
+        num.minimum(height[:,cs],test,height[:,cs])
+    # max of the functions at each channel
+    bckgnd = num.arange(float(nchans)) - HUGE
+    bckgnd = bckgnd * num.ones((nspec,1))
+    for k in range(len(cols)):
+        if cols[k] is None: continue
+        off = k - wd
+        (cs,js) = _slices(off)
+        test = height[:,cs] + _lin_offset(cs,off) - cols[k]
+        num.maximum(bckgnd[:,js],test,bckgnd[:,js])
+    return bckgnd
+
+def _tangent_slopes(scratch):
+    """
+    Slope of the tangent to each spectrum at each channel,
+    from the MAX_TANGENT channels on either side
+    """
+    (nspec,nchans) = scratch.shape
+    chans = num.arange(nchans)
+    f     = num.maximum(chans - MAX_TANGENT,0)
+    l     = num.minimum(chans + MAX_TANGENT,nchans-1)
+    denom = num.maximum(chans.astype(float),1.)
+    k     = num.arange(2*MAX_TANGENT+1)
+    idx   = f[:,num.newaxis] + k
+    ok    = idx <= l[:,num.newaxis]
+    idx   = num.clip(idx,0,nchans-1)
+    terms = (scratch[:,:,num.newaxis] - scratch[:,idx]) / denom[:,num.newaxis]
+    terms[:,~ok] = 0.
+    # sum in the same order as num.sum over each window
+    tsum = terms[:,:,0]
+    for j in range(1,terms.shape[2]):
+        tsum = tsum + terms[:,:,j]
+    tslope = tsum / (l - f)
+    if scratch.dtype.kind in 'iu':
+        # for integer spectra the loop version uses integer
+        # division at channel 0 (the denominator is the int 1)
+        t0 = scratch[:,0,num.newaxis] - scratch[:,idx[0][ok[0]]]
+        tslope[:,0] = t0.sum(axis=1) / (l[0] - f[0])
+    return tslope
+
 ############################################################
 def compress_array(array, compress):
    """
@@ -432,6 +550,149 @@ def expand_array(array, expand, sample=0):
    for i in range(1,expand): temp[-i]=array[-1]
    return temp
 
+########################################################################
+def _calc_background_loop(data,slope=1.0,bottom_width=4.0,top_width=0.0,
+                          exponent=2,tangent=False,compress=4):
+    """
+    Channel by channel version of calc_background (single
+    spectrum), kept as a reference for _bench_calc
+    """
+    nchans      = len(data)
+    scratch     = copy.copy(data)
+
+    # Compress scratch spectrum
+    if (compress > 1):
+        tmp = compress_array(scratch, compress)
+        if tmp is None:
+            compress = 1
+        else:
+            scratch = tmp
+            slope = slope * compress
+            nchans = nchans / compress
+
+    # Copy scratch spectrum to background spectrum
+    bckgnd = copy.copy(scratch)
+
+    # Find maximum counts in input spectrum. This information is used to
+    # limit the size of the function lookup table
+    max_counts = max(scratch)
+
+    ####################################################
+    #  Fit functions which come down from top
+    if (top_width > 0.):
+        #   First make a lookup table of this function
+        chan_width  = top_width / (2. * slope)
+        denom       = chan_width**exponent
+        indices     = num.arange(float(nchans*2+1)) - nchans
+        power_funct = indices**exponent * (REFERENCE_AMPL / denom)
+        power_funct = num.compress((power_funct <= max_counts), power_funct)
+        max_index   = len(power_funct)/2 - 1
+
+        for center_chan in range(nchans):
+            first_chan  = max((center_chan - max_index), 0)
+            last_chan   = min((center_chan + max_index), (nchans-1))
+            f           = first_chan - center_chan + max_index
+            l           = last_chan - center_chan + max_index
+            test        = scratch[center_chan] + power_funct[f:l+1]
+            sub         = bckgnd[first_chan:last_chan+1] 
+            bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
+
+    # Copy this approximation of background to scratch
+    scratch = copy.copy(bckgnd)
+
+    # Find maximum counts in scratch spectrum. This information is used to
+    #   limit the size of the function lookup table
+    max_counts = max(scratch)
+
+    ####################################################
+    # Fit functions which come up from below
+    bckgnd = num.arange(float(nchans)) - HUGE
+
+    # First make a lookup table of this function
+    chan_width = bottom_width / (2. * slope)
+    if (chan_width == 0.):
+        denom = TINY
+    else:
+        denom = chan_width**exponent
+    
+    indices     = num.arange(float(nchans*2+1)) - nchans
+    power_funct = indices**exponent  * (REFERENCE_AMPL / denom)
+    power_funct = num.compress((power_funct <= max_counts), power_funct)
+    max_index   = len(power_funct)/2 - 1
+
+    for center_chan in range(nchans-1):
+        tangent_slope = 0.
+        if tangent:
+            # Find slope of tangent to spectrum at this channel
+            first_chan    = max((center_chan - MAX_TANGENT), 0)
+            last_chan     = min((center_chan + MAX_TANGENT), (nchans-1))
+            denom         = center_chan - num.arange(float(last_chan - first_chan + 1))
+            # is this correct?
+            denom         = max(max(denom), 1)
+            tangent_slope = (scratch[center_chan] - scratch[first_chan:last_chan+1]) / denom
+            tangent_slope = num.sum(tangent_slope) / (last_chan - first_chan)
+
+        first_chan = max((center_chan - max_index), 0)
+        last_chan  = min((center_chan + max_index), (nchans-1))
+        last_chan  = max(last_chan, first_chan)
+        nc         = last_chan - first_chan + 1
+        lin_offset = scratch[center_chan] + (num.arange(float(nc)) - nc/2) * tangent_slope
+
+        # Find the maximum height of a function centered on this channel
+        # such that it is never higher than the counts in any channel
+
+        f      = first_chan - center_chan + max_index
+        l      = last_chan - center_chan + max_index
+        test   = scratch[first_chan:last_chan+1] - lin_offset + power_funct[f:l+1]
+        height = min(test)
+
+        # We now have the function height. Set the background to the
+        # height of the maximum function amplitude at each channel
+
+        test = height + lin_offset - power_funct[f:l+1]
+        sub  = bckgnd[first_chan:last_chan+1]
+        bckgnd[first_chan:last_chan+1] = num.maximum(sub, test)
+
+    ####################################################
+    # Expand spectrum
+    if (compress > 1):
+        bckgnd = expand_array(bckgnd, compress)
+
+    # Bgr should be positive integers??
+    bgr = bckgnd.astype(int)
+    idx = num.where(bgr <= 0)
+    bgr[idx] = 0
+    return bgr
+
+def _bench_calc(nchans=4096,nspec=16,compress=4,tangent=False):
+    """
+    Compare calc_background with the channel loop version
+    on nspec simulated spectra
+    """
+    import time
+    import _test_data as test_dat
+    slope = 20./nchans
+    en    = 1.0 + slope*num.arange(nchans)
+    data  = num.array([test_dat.data1(en) for j in range(nspec)])
+    data  = data.astype(int)
+    kw = {'slope':slope,'compress':compress,'tangent':tangent}
+    t = time.time()
+    bgr_loop = num.array([_calc_background_loop(d,**kw) for d in data])
+    t_loop = time.time() - t
+    t = time.time()
+    bgr_vec = num.array([calc_background(d,**kw) for d in data])
+    t_vec = time.time() - t
+    t = time.time()
+    bgr_2d = calc_background(data,**kw)
+    t_2d = time.time() - t
+    print "%i spectra, %i channels, compress=%i" % (nspec,nchans,compress)
+    print "   loop:       %.3f sec" % t_loop
+    print "   vectorized: %.3f sec" % t_vec
+    print "   2D batch:   %.3f sec" % t_2d
+    print "   identical:  %s" % (num.all(bgr_loop == bgr_vec) and
+                                 num.all(bgr_loop == bgr_2d))
+    return (t_loop,t_vec,t_2d)
+
 ########################################################################
 ########################################################################
 ########################################################################
@@ -456,4 +717,5 @@ def test():
 ########################################################################
 if __name__ == "__main__":
     test()
+    _bench_calc()
 
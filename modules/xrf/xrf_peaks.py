@@ -326,6 +326,34 @@ class XrfPeak:
 
         return( counts, (idx_min,idx_max) )
 
+    ###########################################################################
+    def _calc_range_deriv(self, energy):
+        """
+        Calculate the gaussian line shape and its derivatives only within
+        energy range that it makes a significant contribution.
+
+        Parameters:
+        -----------
+        * energy is an array of energy values
+
+        Outputs:
+        --------
+        * (counts, d_energy, d_fwhm, d_ampl, (idx_min,idx_max))
+        * counts is the same as returned by _calc_range.  d_energy, d_fwhm
+          and d_ampl are the derivatives of counts with respect to the peak
+          energy, fwhm and amplitude over the same range.  Note the
+          derivative with respect to the energy array is -d_energy
+        """
+        (idx_min, idx_max) = self._en_range(energy)
+        sigma    = self.fwhm/SIGMA_TO_FWHM
+        de       = energy[idx_min:idx_max] - self.energy
+        d_ampl   = num.exp(-(de**2 / (2. * sigma**2)))
+        counts   = self.ampl * d_ampl
+        d_energy = counts * de / sigma**2
+        d_fwhm   = d_energy * de / (sigma * SIGMA_TO_FWHM)
+
+        return( counts, d_energy, d_fwhm, d_ampl, (idx_min,idx_max) )
+
     ######################################################################
     def _en_range(self, energy):
         """
@@ -514,6 +542,7 @@ class XrfSpectrum:
         self.chisqr                =  0.       # Chi-squared on output
         self.status                =  0        # Output status code
         self.err_string            =  ''       # Output error string
+        self._bgr_key              = None      # Bgr params of last fit evaluation
 
         # init
         self.init(data=data,chans=chans,params=params,guess=guess)
@@ -612,6 +641,7 @@ class XrfSpectrum:
         self.chisqr    = 0.
         self.status    = 0
         self.err_string = ''
+        self._bgr_key  = None
 
     ################################################################################
     def _initPeaks(self,guess=True):
@@ -745,9 +775,68 @@ class XrfSpectrum:
         return cnts
 
     ####################################################################################
-    def fit(self,guess=True,opt_bgr=True, quiet=1):
+    def calc_peak_basis(self,):
+        """
+        Return the predicted peak counts per unit amplitude of each
+        optimized peak amplitude (ampl_factor = 0).  With the peak energies
+        and widths fixed the model is linear in these amplitudes.
+
+        Outputs:
+        --------
+        * (basis, ampl_map, unit_area)
+        * basis is a (nfree, nchan) array.  Peaks with ampl_factor > 0
+          are included in the row of their reference peak (see _update)
+        * ampl_map is a (npeaks, nfree) array, the peak amplitudes are
+          num.dot(ampl_map, ampl_free)
+        * unit_area is the area of each peak for unit amplitude
+        """
+        npks = len(self.peaks)
+        save = [(pk.ampl, pk.area) for pk in self.peaks]
+        try:
+            for pk in self.peaks:
+                pk.ampl = 1.
+            shapes    = self.calc_peaks()
+            unit_area = num.array([pk.area for pk in self.peaks])
+        finally:
+            for (pk, (ampl, area)) in zip(self.peaks, save):
+                pk.ampl = ampl
+                pk.area = area
+
+        ampl_map = num.zeros((npks,npks), dtype=num.float)
+        free     = []
+        last_opt = None
+        for j in range(npks):
+            peak = self.peaks[j]
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                continue
+            elif (peak.ampl_factor == 0.):
+                ampl_map[j,j] = 1.
+                free.append(j)
+                last_opt = j
+            elif (peak.ampl_factor > 0.) and (last_opt != None):
+                ref = self.peaks[last_opt]
+                ampl_map[j,last_opt] = peak.ampl_factor * (ref.fwhm / max(peak.fwhm, .001))
+        ampl_map = ampl_map[:,free]
+        basis    = num.dot(ampl_map.T, shapes)
+
+        return (basis, ampl_map, unit_area)
+
+    ####################################################################################
+    def fit(self,guess=True,opt_bgr=True, quiet=1, autoderivative=0):
         """
         Fit the data
+
+        Parameters:
+        -----------
+        * guess is a flag to guess the initial peak parameters
+        * opt_bgr is a flag to include the background in the fit
+          model.  If False the background is subtracted from the
+          data before the fit
+        * quiet is passed to mpfit
+        * autoderivative = 0 uses the analytic derivatives of the
+          peak parameters (see _calc_fit).  Set to 1 for mpfit's finite
+          difference derivatives.  Finite differences are always used
+          if any background parameters are optimized
         """
         if self.bgr:
             self.bgr.calc(self.data,slope=self.energy_slope)
@@ -762,9 +851,12 @@ class XrfSpectrum:
 
         # Prep and call lsq
         self._preFit(guess=guess)
+        for par in self.parinfo[self.npeaks*3 + 4:]:
+            if not par['fixed']: autoderivative = 1
         functkw = {'fit':self}
         m = mpfit.mpfit(_fit_peaks, parinfo=self.parinfo, functkw=functkw, 
-                        quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter)
+                        quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter,
+                        autoderivative=autoderivative)
 
         # Make sure final results are updated
         self._update(m.params)
@@ -967,14 +1059,327 @@ class XrfSpectrum:
             np = np+1
             self.bgr._update(parameters[np:])
 
+    ################################################################################
+    def _param_grads(self):
+        """
+        Derivatives of each peak's energy, fwhm and amplitude with respect
+        to the lsq parameter vector (see _update for how these are tied).
+
+        Outputs:
+        --------
+        * list with a (d_energy, d_fwhm, d_ampl) tuple for each peak.
+          Each is a dictionary of {parameter index: derivative} holding
+          only the non-zero entries
+        """
+        grads = []
+        last_opt = None
+        np = 4
+        for peak in self.peaks:
+            # Peak energy
+            d_energy = {np:1.}
+
+            # Peak fwhm
+            if (peak.fwhm_flag == 1):
+                d_fwhm = {2:1., 3:num.sqrt(peak.energy)}
+                if peak.energy > 0.:
+                    d_fwhm[np] = self.fwhm_slope/(2.*num.sqrt(peak.energy))
+            else:
+                d_fwhm = {np+1:1.}
+
+            # Peak amplitude
+            d_ampl = {}
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                pass
+            elif (peak.ampl_factor == 0.):
+                d_ampl = {np+2:1.}
+                last_opt = (peak, d_ampl, d_fwhm)
+            elif (peak.ampl_factor > 0.) and (last_opt != None):
+                # ampl = ref.ampl * ampl_factor * ref.fwhm / max(fwhm, .001)
+                (ref, ref_ampl, ref_fwhm) = last_opt
+                width = max(peak.fwhm, .001)
+                terms = [(ref_ampl, peak.ampl_factor*ref.fwhm/width),
+                         (ref_fwhm, peak.ampl_factor*ref.ampl/width)]
+                if peak.fwhm > .001:
+                    terms.append((d_fwhm, -peak.ampl/width))
+                for (grad, scale) in terms:
+                    for (j, val) in grad.items():
+                        d_ampl[j] = d_ampl.get(j, 0.) + val*scale
+
+            grads.append((d_energy, d_fwhm, d_ampl))
+            np = np + 3
+        return grads
+
+    ################################################################################
+    def _calc_fit(self, free=None):
+        """
+        Compute the predicted spectrum during a fit, and optionally the
+        derivatives of the predicted spectrum with respect to the lsq
+        parameter vector.
+
+        Parameters:
+        -----------
+        * free is None or an array with one entry per fit parameter
+          that is non-zero for the parameters that need derivatives
+
+        Outputs:
+        --------
+        * None, or if free is passed an (nchan, nparams) array of
+          derivatives of self.predicted.  Each peak only fills the rows
+          of its own _en_range window, so the array is banded.
+
+        Notes:
+        ------
+        self.predicted is the same as computed by calc(compute_areas=False).
+        The background is only recomputed when the energy slope or the
+        background parameters change, and is treated as constant in the
+        derivatives.
+        """
+        self.predicted = num.zeros(self.nchan, dtype=num.float)
+        energy = self.get_energy()
+
+        if free is None:
+            for peak in self.peaks:
+                (counts, (idx_min, idx_max)) = peak._calc_range(energy, compute_area=False)
+                self.predicted[idx_min:idx_max] = self.predicted[idx_min:idx_max] + counts
+            jac = None
+        else:
+            jac   = num.zeros((self.nchan, len(free)), dtype=num.float)
+            grads = self._param_grads()
+            for j in range(len(self.peaks)):
+                (counts, d_en, d_fwhm, d_ampl, (idx_min, idx_max)) = \
+                        self.peaks[j]._calc_range_deriv(energy)
+                self.predicted[idx_min:idx_max] = self.predicted[idx_min:idx_max] + counts
+                # energy calibration: d(counts)/d(energy array) = -d_en
+                if free[0]:
+                    jac[idx_min:idx_max,0] -= d_en
+                if free[1]:
+                    jac[idx_min:idx_max,1] -= d_en*self.channels[idx_min:idx_max]
+                # peak parameters
+                for (grad, deriv) in zip(grads[j], (d_en, d_fwhm, d_ampl)):
+                    for (k, val) in grad.items():
+                        if free[k]:
+                            jac[idx_min:idx_max,k] += val*deriv
+
+        if self.bgr:
+            key = (self.energy_slope, self.bgr.bottom_width, self.bgr.top_width)
+            if key != self._bgr_key:
+                self.bgr.calc(self.data,slope=self.energy_slope)
+                self._bgr_key = key
+            self.predicted = self.predicted + self.bgr.bgr
+
+        return jac
+
 #########################################################################
 def _fit_peaks(parameters, fjac = None, fit = None):
     """ Private function """
     fit._update(parameters)
-    fit.calc(compute_areas=False)
     status = 0
-    res = (fit.predicted - fit.data) * fit.weights
-    return (status, res )
+    if fjac is None:
+        fit._calc_fit()
+        res = (fit.predicted - fit.data) * fit.weights
+        return (status, res)
+    # mpfit takes the derivatives of (data - model), see nmpfit
+    pderiv = fit._calc_fit(free=fjac)
+    res    = (fit.predicted - fit.data) * fit.weights
+    pderiv = -pderiv * fit.weights[:,num.newaxis]
+    return (status, res, pderiv)
+
+#########################################################################
+def fit_amplitudes(xspec, data, nonneg=True):
+    """
+    Fit the peak amplitudes of a block of spectra, keeping the peak
+    energies and widths, the energy calibration and the background
+    parameters of xspec fixed.
+
+    Parameters:
+    -----------
+    * xspec is an XrfSpectrum instance with the (fitted) peak shapes,
+      eg from a fit to the sum of the spectra
+    * data is an (nspectra, nchan) array of spectra with the same
+      channels as xspec
+    * nonneg: if True the amplitudes are constrained to be >= 0
+
+    Outputs:
+    --------
+    * dictionary with arrays of the peak 'ampl' and 'area'
+      (nspectra, npeaks), the 'predicted' spectra and the 'bgr'
+      (nspectra, nchan, bgr is None if xspec has no bgr), and the
+      'chisqr' of each spectrum
+
+    Notes:
+    ------
+    The peak basis is computed once (see calc_peak_basis) and the
+    amplitudes of all the spectra are found from the normal equations
+    with one batched solve.  The spectra are weighted using xspec.chi_exp
+    the same way as in XrfSpectrum.fit.
+    """
+    data = num.atleast_2d(num.asarray(data, dtype=float))
+    (basis, ampl_map, unit_area) = xspec.calc_peak_basis()
+    (nfree, nchan) = basis.shape
+    nspec = data.shape[0]
+    if data.shape[1] != nchan:
+        raise ValueError, "Data/Channels array mismatch error in fit_amplitudes"
+
+    # background
+    if xspec.bgr:
+        bgr_model = copy.copy(xspec.bgr)
+        bgr_model.calc(data, slope=xspec.energy_slope)
+        bgr = bgr_model.bgr
+        y   = data - bgr
+    else:
+        bgr = None
+        y   = data
+
+    # weights, see _preFit
+    if (xspec.chi_exp > 0.0):
+        weights = data.copy()
+        weights[weights < 1.] = 1.
+        if (xspec.chi_exp == 0.5):
+            weights = 1./num.sqrt(weights)
+        elif (xspec.chi_exp == 1.0):
+            weights = 1./weights
+        else:
+            weights = 1./(weights**xspec.chi_exp)
+    else:
+        weights = None
+
+    # normal equations.  Only use the channels where both
+    # basis vectors are non-zero for the weighted case
+    if weights is None:
+        b = num.dot(y, basis.T)
+        G = num.dot(basis, basis.T)
+    else:
+        w2 = weights**2
+        b  = num.dot(y*w2, basis.T)
+        G  = num.zeros((nspec,nfree,nfree), dtype=num.float)
+        nz = [num.nonzero(row)[0] for row in basis]
+        for p in range(nfree):
+            for q in range(p, nfree):
+                if len(nz[p]) == 0 or len(nz[q]) == 0: continue
+                lo = max(nz[p][0], nz[q][0])
+                hi = min(nz[p][-1], nz[q][-1]) + 1
+                if hi <= lo: continue
+                G[:,p,q] = num.dot(w2[:,lo:hi], basis[p,lo:hi]*basis[q,lo:hi])
+                G[:,q,p] = G[:,p,q]
+
+    if nfree == 0:
+        ampl_free = num.zeros((nspec,0), dtype=num.float)
+    elif nonneg:
+        ampl_free = _nnls_normal(G, b)
+    else:
+        ampl_free = _solve_passive(G, b, num.ones(b.shape, dtype=bool))
+
+    ampl      = num.dot(ampl_free, ampl_map.T)
+    peaks     = num.dot(ampl_free, basis)
+    if weights is None:
+        chisqr = num.sum((peaks - y)**2, axis=1)
+    else:
+        chisqr = num.sum(((peaks - y)*weights)**2, axis=1)
+    if bgr is not None:
+        predicted = peaks + bgr
+    else:
+        predicted = peaks
+
+    return {'ampl':ampl, 'area':ampl*unit_area, 'predicted':predicted,
+            'bgr':bgr, 'chisqr':chisqr}
+
+def _solve_passive(G, b, passive):
+    """
+    Solve the normal equations G x = b for each row of b using only
+    the passive (True) variables, the others are set to zero.
+    G is (k,k) or (n,k,k), b and passive are (n,k).
+    Variables with a zero diagonal in G are always set to zero
+    """
+    k = b.shape[1]
+    if G.ndim == 2:
+        G = G[num.newaxis]
+    diag = num.diagonal(G, axis1=1, axis2=2)
+    use  = passive & (diag > 0.)
+    mask = use[:,:,num.newaxis] & use[:,num.newaxis,:]
+    Gm   = num.where(mask, G, num.identity(k))
+    bm   = num.where(use, b, 0.)
+    try:
+        x = num.linalg.solve(Gm, bm[:,:,num.newaxis])[:,:,0]
+    except num.linalg.LinAlgError:
+        # singular set of basis vectors, solve one at a time
+        x = num.zeros(bm.shape, dtype=num.float)
+        for j in range(len(bm)):
+            x[j] = num.linalg.lstsq(Gm[j], bm[j])[0]
+    x[use == False] = 0.
+    return x
+
+def _nnls_normal(G, b, max_iter=None):
+    """
+    Non-negative least squares for a stack of problems given by their
+    normal equations G x = b (G = B W B^T, b = B W y).  This is the
+    Lawson-Hanson active set method, with all the problems stepped
+    together so each iteration is one batched solve.
+
+    Parameters:
+    -----------
+    * G is a (k,k) array shared by all problems or an (n,k,k) array
+    * b is an (n,k) array
+    * max_iter is the max number of iterations (default 3*k + 10)
+
+    Outputs:
+    --------
+    * x, an (n,k) array
+    """
+    (n,k) = b.shape
+    if G.ndim == 2:
+        G = num.repeat(G[num.newaxis], n, axis=0)
+    if max_iter == None:
+        max_iter = 3*k + 10
+    diag    = num.diagonal(G, axis1=1, axis2=2)
+    tol     = 1.e-10 * num.abs(b).max(axis=1)
+    rows    = num.arange(n)
+    x       = num.zeros((n,k), dtype=num.float)
+    passive = num.zeros((n,k), dtype=bool)
+    inner   = num.zeros(n, dtype=bool)   # in the inner (feasibility) loop
+    done    = num.zeros(n, dtype=bool)
+
+    for it in range(max_iter):
+        # add the variable with the largest gradient to the passive set
+        outer = (inner == False) & (done == False)
+        if outer.any():
+            w = b[outer] - num.sum(G[outer]*x[outer][:,num.newaxis,:], axis=2)
+            w[passive[outer] | (diag[outer] <= 0.)] = -num.inf
+            jmax = num.argmax(w, axis=1)
+            wmax = w[num.arange(len(w)), jmax]
+            idx  = rows[outer]
+            stop = (wmax <= tol[outer]) | (num.isfinite(wmax) == False)
+            done[idx[stop]] = True
+            passive[idx[stop == False], jmax[stop == False]] = True
+
+        act = rows[done == False]
+        if len(act) == 0:
+            break
+
+        # solve on the passive sets
+        z = _solve_passive(G[act], b[act], passive[act])
+        feas = num.all((z > 0.) | (passive[act] == False), axis=1)
+        f = act[feas]
+        x[f] = z[feas]
+        inner[f] = False
+
+        # step back to the feasible region and drop the
+        # variables that are zero
+        nf = act[feas == False]
+        if len(nf) > 0:
+            xn  = x[nf]
+            zn  = z[feas == False]
+            neg = passive[nf] & (zn <= 0.)
+            denom = num.where(neg, xn - zn, 1.)
+            denom[denom <= 0.] = 1.
+            ratio = num.where(neg, xn / denom, num.inf)
+            alpha = ratio.min(axis=1)
+            xn = xn + alpha[:,num.newaxis]*(zn - xn)
+            pn = passive[nf] & (xn > 0.)
+            xn[pn == False] = 0.
+            x[nf] = xn
+            passive[nf] = pn
+            inner[nf] = True
+    return x
 
 ########################################################################
 ########################################################################
@@ -1045,7 +1450,45 @@ def test_fit():
     #############################
     pyplot.show()
     
+########################################################################
+def _bench_fit(nchans=2048,npeaks=30,opt_bgr=False):
+    """
+    Compare the fit with finite difference and analytic
+    derivatives on a simulated spectrum with npeaks lines
+    """
+    import time
+    import _test_data as test_dat
+    chans = num.arange(nchans)
+    slope = 20./nchans
+    en    = 1.0 + slope*chans
+    lines = num.linspace(2.,19.,npeaks)
+    data  = 50. + test_dat.gauss(en,15.,100.,10.)
+    for e in lines:
+        data = data + test_dat.gauss(en,e,500.,.1+.04*num.sqrt(e))
+    data = num.random.poisson(data)
+    pk_par = [{'label':'p%i' % j,'energy':lines[j]} for j in range(npeaks)]
+    fit_par = {'energy_offset':1.01,'energy_slope':slope*1.001,
+               'fwhm_offset':.12,'fwhm_slope':.03,'chi_exp':.5}
+    result = []
+    for autoderivative in (1,0):
+        xspec = XrfSpectrum(data=data,chans=chans,guess=True,
+                            params={'fit':fit_par,'pk':pk_par,
+                                    'bgr':{'bottom_width':4,'compress':4}})
+        t = time.time()
+        xspec.fit(opt_bgr=opt_bgr,autoderivative=autoderivative)
+        result.append((time.time() - t, xspec))
+    area_fd = num.array([pk.area for pk in result[0][1].peaks])
+    area_an = num.array([pk.area for pk in result[1][1].peaks])
+    print "%i channels, %i peaks, opt_bgr=%s" % (nchans,npeaks,str(opt_bgr))
+    for (lbl,(t,xspec)) in zip(('finite diff','analytic'),result):
+        print "   %-12s %.3f sec, n_eval = %i, n_iter = %i, chisqr = %f" % \
+              (lbl,t,xspec.n_eval,xspec.n_iter,xspec.chisqr)
+    print "   max rel area difference: %g" % \
+          (num.abs(area_fd - area_an).max()/num.abs(area_fd).max())
+    return result
+
 ########################################################################
 if __name__ == "__main__":
     #test_peak()
-    test_fit()
+    #test_fit()
+    _bench_fit()
@@ -127,7 +127,7 @@ class wxScanFilter(model.Background, wxUtil):
         
         #Loops through the list of dictionaries, grabbing the desired
         # data and storing it for filtering
-        for i in specFile._summary:
+        for i in specFile.summary():
             scanIndex = str(i['index'])
             #hValD and kValD are the actual distances of H and K, respectively
             hValD = float(i['G'].split()[28])